@@ -0,0 +1,224 @@
+"""Images per second per core of the fused preprocessing stage against the
+separate per-channel steps it replaces.
+
+The separate path downscales every channel with nd2_loading.downscale,
+smooths the nuclei channel with skimage's gaussian, builds the channel
+histograms with IntensityHistogram.from_downscaled and normalizes the figure
+channels with normalize_img into a new figure image, allocating new arrays for
+every image. The fused path does the same with one FieldPreprocessor whose
+buffers are reused for all images. Both run in this process, one image at a
+time, so the rates are per core. The outputs of both paths must be identical.
+Runs on a synthetic plate, or on the .nd2 images of --directory:
+
+    python benchmarks/bench_preprocessing.py --images 8 --size 2048 2048
+    python benchmarks/bench_preprocessing.py --directory /data/plate --repeat 5
+
+Exits with status 1 if any output differs.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, os.pardir, "src"))
+
+from skimage.filters import gaussian
+
+from bench_senolysis import git_commit, machine_info
+from intensity_histogram import IntensityHistogram
+from nd2_loading import ND2File, downscale
+from parameters import AnalysisParameters
+from preprocessing import FieldPreprocessor
+from senolysis_functions import find_images, normalize_img
+from synthetic_plate import add_image_arguments, image_options, make_plate
+
+
+def separate(planes, factor, dtype):
+    """Preprocessing of one field with a separate call per channel and step.
+
+    Returns
+    -------
+    downscaled, smoothed, histograms and RGB of the field
+    """
+    downscaled = [downscale(plane, factor, dtype) for plane in planes]
+    smoothed = gaussian(downscaled[2], 1, preserve_range=True)
+    histograms = [IntensityHistogram.from_downscaled(img, factor) for img in downscaled]
+    normalized = [
+        normalize_img(img, high_per=98, histogram=histogram)
+        for img, histogram in zip(downscaled[:2], histograms)
+    ]
+    zeros = np.zeros(downscaled[0].shape, dtype=normalized[0].dtype)
+    return downscaled, smoothed, histograms, np.dstack(normalized + [zeros])
+
+
+def fused(preprocessor, planes):
+    """The same preprocessing with the buffers of a FieldPreprocessor."""
+    downscaled = preprocessor.downscale(planes)
+    smoothed = preprocessor.smooth(downscaled[2])
+    histograms = [preprocessor.histogram(img) for img in downscaled]
+    rgb = preprocessor.rgb(downscaled[0], downscaled[1], *histograms[:2])
+    return downscaled, smoothed, histograms, rgb
+
+
+def same_outputs(a, b):
+    downscaled_a, smoothed_a, histograms_a, rgb_a = a
+    downscaled_b, smoothed_b, histograms_b, rgb_b = b
+    return (
+        all(np.array_equal(x, y) for x, y in zip(downscaled_a, downscaled_b))
+        and np.array_equal(smoothed_a, smoothed_b)
+        and all(
+            np.array_equal(x.counts, y.counts) and x.mean == y.mean
+            for x, y in zip(histograms_a, histograms_b)
+        )
+        and np.array_equal(rgb_a, rgb_b)
+    )
+
+
+def field_planes(nd2_file, channels, field):
+    return [nd2_file.plane(channel, field) for channel in channels]
+
+
+def benchmark(img_paths, params, repeat):
+    """Times both paths over all fields of img_paths, repeat times, and
+    checks their outputs.
+
+    Returns
+    -------
+    results: dict with the images per second per core, the peak traced memory
+        of one field and the number of fields of both paths, and whether the
+        outputs are identical
+    """
+    factor = params.downscale_factor
+    dtype = np.dtype(params.intensity_dtype)
+    channels = (
+        params.scenescent_channel,
+        params.quiescent_channel,
+        params.nuclei_chanel,
+    )
+    files = [ND2File(img_path) for img_path in img_paths]
+    try:
+        fields = [(f, field) for f in files for field in f.fields]
+        shapes = {(f.height, f.width) for f in files}
+        assert len(shapes) == 1, "All images of the plate should have the same size"
+        preprocessor = FieldPreprocessor(shapes.pop(), factor, len(channels), dtype)
+
+        identical = all(
+            same_outputs(
+                separate(field_planes(f, channels, field), factor, dtype),
+                fused(preprocessor, field_planes(f, channels, field)),
+            )
+            for f, field in fields
+        )
+
+        paths = {
+            "separate": lambda planes: separate(planes, factor, dtype),
+            "fused": lambda planes: fused(preprocessor, planes),
+        }
+        results = {"fields": len(fields), "identical": identical}
+        for name, path in paths.items():
+            # Peak memory of one field, once the reused buffers exist
+            first, field = fields[0]
+            tracemalloc.start()
+            path(field_planes(first, channels, field))
+            results[f"{name}_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+            rates = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for f, field in fields:
+                    path(field_planes(f, channels, field))
+                rates.append(len(fields) / (time.perf_counter() - start))
+            results[f"{name}_images_per_s"] = max(rates)
+        return results
+    finally:
+        for f in files:
+            f.close()
+
+
+def print_results(results):
+    print(f"{'path':<10} {'images/s/core':>14} {'peak MB':>9}")
+    for name in ("separate", "fused"):
+        print(
+            f"{name:<10} {results[f'{name}_images_per_s']:>14.2f} "
+            f"{results[f'{name}_peak_mb']:>9.1f}"
+        )
+    print(
+        f"Fused preprocessing: "
+        f"{results['fused_images_per_s'] / results['separate_images_per_s']:.2f}x "
+        f"the images per second of the separate steps, over "
+        f"{results['fields']} fields"
+    )
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_image_arguments(parser)
+    parser.add_argument(
+        "--images", type=int, default=8, help="Number of synthetic images"
+    )
+    parser.add_argument("--directory", help="Benchmark the images of this folder")
+    parser.add_argument(
+        "--config", help="TOML file with analysis parameters (default: defaults)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Passes over the images, best is kept"
+    )
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    # nd2reader warns about the missing z-levels of the synthetic files
+    warnings.filterwarnings("ignore", category=UserWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.directory or temporary
+        if args.config:
+            params = AnalysisParameters.from_toml(args.config, directory=directory)
+        else:
+            params = AnalysisParameters(directory=directory)
+
+        if args.directory:
+            img_paths = find_images(args.directory)
+        else:
+            print(f"Writing {args.images} synthetic images to {temporary}")
+            img_paths = make_plate(
+                temporary, args.images, seed=args.seed, **image_options(args)
+            )
+        if not img_paths:
+            print("No images found")
+            return 1
+        results = benchmark(img_paths, params, args.repeat)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "machine": machine_info(),
+                    "downscale_factor": params.downscale_factor,
+                    "dtype": params.intensity_dtype,
+                    **results,
+                },
+                f,
+                indent=2,
+            )
+    if not results["identical"]:
+        print("The fused preprocessing differs from the separate steps")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
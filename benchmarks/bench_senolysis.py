@@ -0,0 +1,418 @@
+"""Per-stage timings and end-to-end throughput of the senolysis analysis on
+synthetic images.
+
+Every stage of field_analysis is timed on its own (best and median of
+--repeat runs), followed by the throughput of senolysis_analysis over a plate
+of synthetic images at each --jobs value and the startup time of the program
+and its workers. Results are written as JSON together
+with the git commit and machine they were measured on, so runs of different
+commits can be compared with --compare:
+
+    python benchmarks/bench_senolysis.py --output before.json
+    git checkout <other commit>
+    python benchmarks/bench_senolysis.py --output after.json --compare before.json
+"""
+import argparse
+from dataclasses import asdict, replace
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, os.pardir, "src"))
+
+import skimage
+from skimage import io
+from skimage.filters import gaussian
+from skimage.morphology import remove_small_holes
+from skimage.transform import downscale_local_mean
+
+from nd2_loading import ND2File
+from nuclei_table import NucleiTable, upscale_mask
+from overlay import save_overlay
+from parameters import AnalysisParameters
+from results_sink import merge_results
+from senolysis_analysis import measure_nuclei, segment_nuclei, senolysis_analysis
+from senolysis_functions import (
+    analyze_nuclei,
+    classify_nuclei,
+    create_figure,
+    discard_otsu_noise,
+    normalize_img,
+    nuclei_thresholder,
+    remove_well_rings,
+    scale_area,
+)
+from synthetic_plate import add_image_arguments, image_options, make_plate
+from well_mask import ring_margin
+from worker_pool import WorkerPool
+
+# Version of the JSON layout
+RESULTS_VERSION = 2
+
+
+def time_stage(function, repeat):
+    """Best and median wall time of repeat calls of function, and its result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times)}, result
+
+
+def stage_timings(img_path, params, repeat, save_path):
+    """Times the stages of field_analysis one after another on one image. Each
+    stage gets the output of the previous stages as input."""
+    factor = params.downscale_factor
+    channels = (
+        params.scenescent_channel,
+        params.quiescent_channel,
+        params.nuclei_chanel,
+    )
+    timings = {}
+
+    def run(name, function):
+        timings[name], result = time_stage(function, repeat)
+        return result
+
+    def nd2_import():
+        with ND2File(img_path) as nd2_file:
+            return [np.array(nd2_file.plane(channel)) for channel in channels]
+
+    red, green, blue = run("nd2_import", nd2_import)
+    full_shape = blue.shape
+    red_small, green_small, blue_small = run(
+        "downscale",
+        lambda: [
+            downscale_local_mean(plane, factors=(factor, factor))
+            for plane in (red, green, blue)
+        ],
+    )
+    run(
+        "normalize_img",
+        lambda: (
+            normalize_img(red_small, high_per=98),
+            normalize_img(green_small, high_per=98),
+        ),
+    )
+    smoothed = run("gaussian", lambda: gaussian(blue_small, 1, preserve_range=True))
+    if params.remove_well_ring == 1:
+        smoothed = run(
+            "remove_well_rings",
+            lambda: remove_well_rings(
+                smoothed,
+                max_size=scale_area(params.max_nuclei_size, factor),
+                margin=ring_margin(factor),
+            ),
+        )
+    thresholded = run(
+        "threshold",
+        lambda: nuclei_thresholder(
+            smoothed, params.thresholding_method, params.nuclei_threshold
+        )(smoothed),
+    )
+    filled = run(
+        "remove_small_holes",
+        lambda: remove_small_holes(thresholded, area_threshold=scale_area(100, factor)),
+    )
+
+    def label():
+        min_area = int(params.min_nuclei_size / factor**2)
+        nuclei = NucleiTable(filled, min_area=min_area)
+        if params.thresholding_method == "Otsu":
+            nuclei = discard_otsu_noise(nuclei)
+        return nuclei.filter_by_area(
+            min_area=min_area, max_area=int(params.max_nuclei_size / factor**2)
+        )
+
+    run("label", label)
+    nuclei, is_nucleus = run(
+        "segment_nuclei", lambda: segment_nuclei(blue_small, factor, params)
+    )
+
+    def classify():
+        means, areas, _ = measure_nuclei(
+            nuclei, is_nucleus, red_small, green_small, full_shape, factor, params
+        )
+        return classify_nuclei(means, params.scenescent_threshold), areas
+
+    is_scenescent, areas = run("classify_nuclei", classify)
+    run(
+        "analyze_nuclei",
+        lambda: analyze_nuclei(areas[is_scenescent], areas[~is_scenescent], img_path),
+    )
+
+    scenescent = nuclei.mask(is_scenescent)
+    quiescent = nuclei.mask(~is_scenescent)
+    RGB = np.dstack(
+        [
+            normalize_img(red_small, high_per=98),
+            normalize_img(green_small, high_per=98),
+            np.zeros(blue_small.shape),
+        ]
+    )
+    run(
+        "create_figure",
+        lambda: create_figure(
+            RGB,
+            scenescent,
+            quiescent,
+            save_path,
+            "figure",
+            params.scenescent_threshold,
+        ),
+    )
+    run(
+        "save_overlay",
+        lambda: save_overlay(
+            RGB,
+            scenescent,
+            quiescent,
+            os.path.join(save_path, "overlay.png"),
+            params.scenescent_threshold,
+            mode="Thumbnail",
+        ),
+    )
+
+    def save_masks():
+        for name, mask in (("scenescent", scenescent), ("quiescent", quiescent)):
+            io.imsave(
+                os.path.join(save_path, f"{name}_mask.png"),
+                np.uint8(upscale_mask(mask, full_shape)) * 255,
+                check_contrast=False,
+            )
+
+    run("save_masks", save_masks)
+    run(
+        "senolysis_analysis",
+        lambda: senolysis_analysis(img_path, "stages", params),
+    )
+    return timings
+
+
+def throughput(img_paths, params, jobs_values):
+    """Images per second of senolysis_analysis over all images, for each
+    number of parallel jobs, including starting the workers."""
+    results = []
+    for num_jobs in jobs_values:
+        run_name = f"throughput_{num_jobs}"
+        start = time.perf_counter()
+        pool = WorkerPool(num_jobs)
+        pool.run(
+            senolysis_analysis,
+            [(img_path, run_name, params) for img_path in img_paths],
+        )
+        pool.shutdown()
+        merge_results(
+            os.path.join(os.path.dirname(img_paths[0]), "Results_" + run_name)
+        )
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "num_jobs": num_jobs,
+                "images": len(img_paths),
+                "seconds": seconds,
+                "images_per_second": len(img_paths) / seconds,
+            }
+        )
+    return results
+
+
+def startup_timings(repeat):
+    """Time to import the main program in a new interpreter, and to start one
+    warm worker in a new interpreter (as on Windows and macOS, forked workers
+    inherit the modules of the main process)."""
+
+    def import_main():
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import time; start = time.perf_counter(); import senolysis_main; "
+                "print(time.perf_counter() - start)",
+            ],
+            cwd=os.path.join(BENCHMARK_DIR, os.pardir, "src"),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return float(output.split()[-1])
+
+    def spawn_worker():
+        pool = WorkerPool(1, mp_context=multiprocessing.get_context("spawn"))
+        seconds = pool.wait_ready()
+        pool.shutdown()
+        return seconds
+
+    timings = {}
+    for name, function in (
+        ("import_main", import_main),
+        ("spawn_worker", spawn_worker),
+    ):
+        # Timed inside the new process, without the interpreter start
+        times = [function() for _ in range(repeat)]
+        timings[name] = {"best": min(times), "median": statistics.median(times)}
+    return timings
+
+
+def git_commit():
+    """Commit of the benchmarked source tree, with -dirty for local changes."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=BENCHMARK_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scikit-image": skimage.__version__,
+    }
+
+
+def compare(results, baseline):
+    """Prints the timings of results relative to those of a baseline run."""
+    print(f"\nCompared to {baseline['commit']} (ratio < 1 is faster)")
+    for name, timing in results["stages"].items():
+        if name in baseline["stages"]:
+            ratio = timing["best"] / baseline["stages"][name]["best"]
+            print(f"  {name:<22}{ratio:8.2f}")
+    # Results of older versions have no startup timings
+    for name, timing in results["startup"].items():
+        if name in baseline.get("startup", {}):
+            ratio = timing["best"] / baseline["startup"][name]["best"]
+            print(f"  {name:<22}{ratio:8.2f}")
+    baseline_throughput = {
+        row["num_jobs"]: row["images_per_second"] for row in baseline["throughput"]
+    }
+    for row in results["throughput"]:
+        if row["num_jobs"] in baseline_throughput:
+            ratio = baseline_throughput[row["num_jobs"]] / row["images_per_second"]
+            print(f"  {'num_jobs=' + str(row['num_jobs']):<22}{ratio:8.2f}")
+
+
+def print_results(results):
+    print(f"Stage timings ({results['config']['repeat']} repeats)")
+    for name, timing in results["stages"].items():
+        print(
+            f"  {name:<22}{timing['best'] * 1000:10.1f} ms"
+            f"{timing['median'] * 1000:10.1f} ms (median)"
+        )
+    print("Startup")
+    for name, timing in results["startup"].items():
+        print(
+            f"  {name:<22}{timing['best'] * 1000:10.1f} ms"
+            f"{timing['median'] * 1000:10.1f} ms (median)"
+        )
+    print("Throughput")
+    for row in results["throughput"]:
+        print(
+            f"  num_jobs={row['num_jobs']:<13}{row['images_per_second']:10.2f} images/s"
+            f"{row['seconds']:10.1f} s"
+        )
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_image_arguments(parser)
+    parser.add_argument(
+        "--images", type=int, default=8, help="Images for the throughput runs"
+    )
+    parser.add_argument(
+        "--jobs",
+        default="1,2,4",
+        help="Comma separated numbers of parallel jobs for the throughput runs",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Repeats of every timed stage"
+    )
+    parser.add_argument(
+        "--config", help="TOML file with analysis parameters (default: defaults)"
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a baseline run")
+    parser.add_argument(
+        "--workdir", help="Folder for the synthetic images (default: temporary)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    jobs_values = sorted(
+        {min(int(jobs), os.cpu_count()) for jobs in args.jobs.split(",") if jobs}
+    )
+    # nd2reader warns about the missing z-levels of the synthetic files, and
+    # deprecation warnings would be repeated for every timed call
+    warnings.filterwarnings("ignore", category=UserWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        workdir = args.workdir or temporary
+        if args.config:
+            params = AnalysisParameters.from_toml(args.config, directory=workdir)
+        else:
+            params = AnalysisParameters(directory=workdir)
+        params = replace(params, num_jobs=1)
+
+        print(f"Writing {args.images} synthetic images to {workdir}")
+        img_paths = make_plate(
+            workdir, max(args.images, 1), seed=args.seed, **image_options(args)
+        )
+        stage_dir = os.path.join(workdir, "stages")
+        os.makedirs(stage_dir, exist_ok=True)
+
+        results = {
+            "version": RESULTS_VERSION,
+            "commit": git_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine": machine_info(),
+            "config": {
+                "image": image_options(args),
+                "seed": args.seed,
+                "images": len(img_paths),
+                "repeat": args.repeat,
+                "parameters": {
+                    name: value
+                    for name, value in asdict(params).items()
+                    if name != "directory"
+                },
+            },
+            "stages": stage_timings(img_paths[0], params, args.repeat, stage_dir),
+            "throughput": throughput(img_paths, params, jobs_values),
+            "startup": startup_timings(args.repeat),
+        }
+
+    print_results(results)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Checks that the compact float32 mode gives the same results as the default
+float64 analysis and measures the memory it saves.
+
+Every field is read and analyzed in both modes without writing anything. The
+per-image result rows, the senescent classification of every nucleus and the
+senescent and quiescent masks must be identical. The peak memory (traced by
+tracemalloc) and time of both modes are reported. Runs on a synthetic plate,
+or on the .nd2 images of --directory:
+
+    python benchmarks/check_compact.py --images 4 --size 2048 2048
+    python benchmarks/check_compact.py --directory /data/plate --config run.toml
+
+Exits with status 1 if any field differs.
+"""
+import argparse
+from dataclasses import replace
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, os.pardir, "src"))
+
+from nd2_loading import ND2File
+from parameters import AnalysisParameters
+from senolysis_analysis import compute_field, full_resolution_planes
+from senolysis_functions import find_images
+from synthetic_plate import add_image_arguments, image_options, make_plate
+
+
+def analyze(img_path, field, result_field, params):
+    """FieldOutput of one field, with the peak traced memory and wall time of
+    reading and analyzing it."""
+    channels = (
+        params.scenescent_channel,
+        params.quiescent_channel,
+        params.nuclei_chanel,
+    )
+    tracemalloc.start()
+    start = time.perf_counter()
+    with ND2File(img_path) as nd2_file:
+        planes = nd2_file.downscaled_planes(
+            channels, params.downscale_factor, field, params.intensity_dtype
+        )
+        full_planes = None
+        if params.refine_nuclei == 1:
+            full_planes = full_resolution_planes(nd2_file, channels, field)
+        output = compute_field(
+            *planes,
+            (nd2_file.height, nd2_file.width),
+            params.downscale_factor,
+            img_path,
+            params,
+            field=result_field,
+            full_planes=full_planes,
+        )
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return output, peak, wall
+
+
+def differences(default, compact):
+    """Names of the results of compact that differ from default."""
+    different = []
+    if not default.results_dataframe.equals(compact.results_dataframe):
+        different.append("result row")
+    if not np.array_equal(default.is_scenescent, compact.is_scenescent):
+        different.append("classification")
+    for name in ("scenescent_downscaled", "quiescent_downscaled"):
+        if not np.array_equal(getattr(default, name), getattr(compact, name)):
+            different.append(name)
+    return different
+
+
+def check_images(img_paths, params):
+    """Analyzes every field of img_paths in both modes.
+
+    Returns
+    -------
+    rows: one dict per field with the differences, peak memory and time of
+        both modes
+    """
+    modes = {
+        "float64": replace(params, compact_dtypes=0),
+        "float32": replace(params, compact_dtypes=1),
+    }
+    rows = []
+    for img_path in img_paths:
+        with ND2File(img_path) as nd2_file:
+            all_fields = nd2_file.fields
+        for field in all_fields:
+            result_field = field if len(all_fields) > 1 else None
+            outputs = {}
+            row = {"image": os.path.basename(img_path), "field": result_field}
+            for mode, mode_params in modes.items():
+                outputs[mode], peak, wall = analyze(
+                    img_path, field, result_field, mode_params
+                )
+                row[f"{mode}_peak_mb"] = peak / 2**20
+                row[f"{mode}_s"] = wall
+            row["differences"] = differences(outputs["float64"], outputs["float32"])
+            rows.append(row)
+    return rows
+
+
+def print_rows(rows):
+    print(
+        f"{'image':<24} {'float64 MB':>10} {'float32 MB':>10} "
+        f"{'float64 s':>9} {'float32 s':>9}  result"
+    )
+    for row in rows:
+        name = (
+            row["image"] if row["field"] is None else f"{row['image']} {row['field']}"
+        )
+        result = ", ".join(row["differences"]) or "identical"
+        print(
+            f"{name:<24} {row['float64_peak_mb']:>10.1f} "
+            f"{row['float32_peak_mb']:>10.1f} {row['float64_s']:>9.3f} "
+            f"{row['float32_s']:>9.3f}  {result}"
+        )
+    peak64 = max(row["float64_peak_mb"] for row in rows)
+    peak32 = max(row["float32_peak_mb"] for row in rows)
+    print(
+        f"Largest peak memory: {peak64:.1f} MB (float64), {peak32:.1f} MB "
+        f"(float32), {peak32 / peak64:.0%}"
+    )
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_image_arguments(parser)
+    parser.add_argument(
+        "--images", type=int, default=4, help="Number of synthetic images"
+    )
+    parser.add_argument("--directory", help="Check the images of this folder instead")
+    parser.add_argument(
+        "--config", help="TOML file with analysis parameters (default: defaults)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    # nd2reader warns about the missing z-levels of the synthetic files
+    warnings.filterwarnings("ignore", category=UserWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.directory or temporary
+        if args.config:
+            params = AnalysisParameters.from_toml(args.config, directory=directory)
+        else:
+            params = AnalysisParameters(directory=directory)
+
+        if args.directory:
+            img_paths = find_images(args.directory)
+        else:
+            print(f"Writing {args.images} synthetic images to {temporary}")
+            img_paths = make_plate(
+                temporary, args.images, seed=args.seed, **image_options(args)
+            )
+        rows = check_images(img_paths, params)
+
+    if not rows:
+        print("No images found")
+        return 1
+    print_rows(rows)
+    different = [row for row in rows if row["differences"]]
+    if different:
+        print(f"{len(different)} of {len(rows)} fields differ in compact mode")
+        return 1
+    print(f"All {len(rows)} fields are identical in compact mode")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
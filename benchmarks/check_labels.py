@@ -0,0 +1,166 @@
+"""Checks that the compact label outputs expand to exactly the mask PNGs and
+reports how much smaller they are.
+
+Every image is analyzed once with the PNG mask format and once with the
+Labels format, into two temporary results folders next to the images. The
+masks expanded from every <image>_labels.npz must equal the senescent and
+quiescent mask PNGs pixel for pixel. Runs on a synthetic plate, or on the .nd2
+images of --directory (use --config to check refined or tiled analyses):
+
+    python benchmarks/check_labels.py --images 4 --size 2048 2048
+    python benchmarks/check_labels.py --directory /data/plate --config run.toml
+
+Exits with status 1 if any mask differs.
+"""
+import argparse
+from dataclasses import replace
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+from skimage import io
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, os.pardir, "src"))
+
+from label_outputs import LABELS_SUFFIX, MASK_SUFFIXES, LabelImage
+from parameters import AnalysisParameters
+from senolysis_analysis import senolysis_analysis
+from senolysis_functions import find_images, get_save_path
+from synthetic_plate import add_image_arguments, image_options, make_plate
+
+# Results folder names of the two analyses of every image
+RUNS = {"PNG": "check-labels-png", "Labels": "check-labels-npz"}
+
+
+def compare_field(npz_path, png_folder):
+    """Compares the masks expanded from one label file with the PNGs of the
+    same field.
+
+    Returns
+    -------
+    row: dict with the field name, the file sizes of both formats and the
+        names of the masks that differ
+    """
+    img_name = os.path.basename(npz_path)[: -len(LABELS_SUFFIX)]
+    png_paths = [
+        os.path.join(png_folder, img_name + suffix) for suffix in MASK_SUFFIXES
+    ]
+    different = []
+    for suffix, png_path, mask in zip(
+        MASK_SUFFIXES, png_paths, LabelImage(npz_path).masks()
+    ):
+        if not np.array_equal(io.imread(png_path), np.uint8(mask) * 255):
+            different.append(suffix.strip("_").split(".")[0])
+    return {
+        "field": img_name,
+        "png_bytes": sum(os.path.getsize(path) for path in png_paths),
+        "labels_bytes": os.path.getsize(npz_path),
+        "differences": different,
+    }
+
+
+def check_images(img_paths, params, keep=False):
+    """Analyzes img_paths with both mask formats and compares every field."""
+    folders = {}
+    try:
+        for mask_format, run_name in RUNS.items():
+            for img_path in img_paths:
+                senolysis_analysis(
+                    img_path,
+                    run_name,
+                    replace(params, mask_format=mask_format, profile=0),
+                )
+            folders[mask_format] = {
+                get_save_path(img_path, run_name) for img_path in img_paths
+            }
+
+        rows = []
+        for png_folder, npz_folder in zip(
+            sorted(folders["PNG"]), sorted(folders["Labels"])
+        ):
+            for name in sorted(os.listdir(npz_folder)):
+                if name.endswith(LABELS_SUFFIX):
+                    rows.append(
+                        compare_field(os.path.join(npz_folder, name), png_folder)
+                    )
+        return rows
+    finally:
+        if not keep:
+            for run_name in RUNS.values():
+                for img_path in img_paths:
+                    shutil.rmtree(get_save_path(img_path, run_name), ignore_errors=True)
+
+
+def print_rows(rows):
+    print(f"{'field':<32} {'PNG kB':>10} {'labels kB':>10}  result")
+    for row in rows:
+        result = ", ".join(row["differences"]) or "identical"
+        print(
+            f"{row['field']:<32} {row['png_bytes'] / 1024:>10.1f} "
+            f"{row['labels_bytes'] / 1024:>10.1f}  {result}"
+        )
+    png_bytes = sum(row["png_bytes"] for row in rows)
+    labels_bytes = sum(row["labels_bytes"] for row in rows)
+    print(
+        f"Total: {png_bytes / 2**20:.2f} MB of PNG masks, "
+        f"{labels_bytes / 2**20:.2f} MB of label files "
+        f"({labels_bytes / png_bytes:.1%})"
+    )
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    add_image_arguments(parser)
+    parser.add_argument(
+        "--images", type=int, default=4, help="Number of synthetic images"
+    )
+    parser.add_argument("--directory", help="Check the images of this folder instead")
+    parser.add_argument(
+        "--config", help="TOML file with analysis parameters (default: defaults)"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the results folders of the check"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    # nd2reader warns about the missing z-levels of the synthetic files
+    warnings.filterwarnings("ignore", category=UserWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+
+    with tempfile.TemporaryDirectory() as temporary:
+        directory = args.directory or temporary
+        if args.config:
+            params = AnalysisParameters.from_toml(args.config, directory=directory)
+        else:
+            params = AnalysisParameters(directory=directory)
+
+        if args.directory:
+            img_paths = find_images(args.directory)
+        else:
+            print(f"Writing {args.images} synthetic images to {temporary}")
+            img_paths = make_plate(
+                temporary, args.images, seed=args.seed, **image_options(args)
+            )
+        rows = check_images(img_paths, params, keep=args.keep and bool(args.directory))
+
+    if not rows:
+        print("No images found")
+        return 1
+    print_rows(rows)
+    different = [row for row in rows if row["differences"]]
+    if different:
+        print(f"{len(different)} of {len(rows)} fields differ from the PNG masks")
+        return 1
+    print(f"All {len(rows)} fields expand to the PNG masks exactly")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""Synthetic three channel .nd2 images and plates for benchmarking.
+
+The images mimic a plate well: a noisy background, round nuclei of random
+size in the nuclei channel, senescent / quiescent staining in the other two
+channels and optionally a bright well ring. They are written as real .nd2
+files, so the whole analysis including nd2 reading can be timed.
+
+    python benchmarks/synthetic_plate.py OUTPUT_DIR --images 8 --size 2048 2048
+"""
+import argparse
+import os
+import struct
+
+import numpy as np
+from nd2reader.artificial import ArtificialND2, global_file_labels, global_labels
+
+# Mean background and foreground levels (uint16) of the synthetic channels
+BACKGROUND = {"scenescent": 150, "quiescent": 150, "nuclei": 200}
+BACKGROUND_NOISE = 20
+NUCLEUS_INTENSITY = 3000
+SENESCENT_INTENSITY = 600
+RING_INTENSITY = 4000
+
+
+def synthetic_channels(
+    shape=(2048, 2048),
+    nuclei_density=200,
+    radius_range=(6, 30),
+    senescent_fraction=0.5,
+    well_ring=True,
+    seed=0,
+):
+    """Senescent, quiescent and nuclei channels of one synthetic well image.
+
+    Parameters
+    ----------
+    shape: (height, width) of the image
+    nuclei_density: number of nuclei per megapixel
+    radius_range: smallest and largest nucleus radius in pixels
+    senescent_fraction: fraction of the nuclei that are bright in the
+        senescent channel
+    well_ring: if True, a bright ring like a well outline is added to the
+        nuclei channel
+    seed: seed of the random generator
+
+    Returns
+    -------
+    red, green, blue: uint16 images of the senescent, quiescent and nuclei
+        channel
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    channels = {
+        name: rng.normal(level, BACKGROUND_NOISE, shape).astype(np.float32)
+        for name, level in BACKGROUND.items()
+    }
+
+    num_nuclei = int(round(nuclei_density * height * width / 1e6))
+    for _ in range(num_nuclei):
+        row, col = rng.integers(0, height), rng.integers(0, width)
+        radius = rng.integers(radius_range[0], radius_range[1] + 1)
+        rows = slice(max(row - radius, 0), min(row + radius + 1, height))
+        cols = slice(max(col - radius, 0), min(col + radius + 1, width))
+        disk = (np.arange(rows.start, rows.stop)[:, None] - row) ** 2 + (
+            np.arange(cols.start, cols.stop)[None, :] - col
+        ) ** 2 <= radius**2
+
+        channels["nuclei"][rows, cols][disk] += NUCLEUS_INTENSITY
+        if rng.random() < senescent_fraction:
+            channels["scenescent"][rows, cols][disk] += SENESCENT_INTENSITY
+        else:
+            channels["quiescent"][rows, cols][disk] += SENESCENT_INTENSITY
+
+    if well_ring:
+        radius = np.hypot(
+            np.arange(height)[:, None] - height / 2,
+            np.arange(width)[None, :] - width / 2,
+        )
+        ring = (radius > 0.40 * min(shape)) & (radius < 0.47 * min(shape))
+        channels["nuclei"][ring] += RING_INTENSITY
+
+    return tuple(
+        np.clip(channels[name], 0, 65535).astype(np.uint16)
+        for name in ("scenescent", "quiescent", "nuclei")
+    )
+
+
+class SyntheticND2(ArtificialND2):
+    """Single field .nd2 file with interleaved uint16 channels, built on the
+    test file writer of nd2reader.
+
+    Parameters
+    ----------
+    path: output file
+    planes: (channels, height, width) uint16 array
+    """
+
+    def __init__(self, path, planes):
+        self.planes = np.asarray(planes, dtype=np.uint16)
+        super().__init__(path)
+
+    def _get_slx_img_attrib(self):
+        num_channels, height, width = self.planes.shape
+        return {
+            "uiWidth": width,
+            "uiWidthBytes": width * 2 * num_channels,
+            "uiHeight": height,
+            "uiComp": num_channels,
+            "uiBpcInMemory": 16,
+            "uiBpcSignificant": 16,
+            "uiSequenceCount": 1,
+            "uiTileWidth": width,
+            "uiTileHeight": height,
+            "eCompression": 2,
+            "dCompressionParam": -1.0,
+            "ePixelType": 1,
+            "uiVirtualComponents": num_channels,
+        }
+
+    def _get_slx_picture_metadata(self):
+        num_channels = len(self.planes)
+        return {
+            "sPicturePlanes": {
+                "uiCount": num_channels,
+                "uiCompCount": num_channels,
+                "sPlaneNew": {
+                    f"a{i}": {"sDescription": f"channel {i}"}
+                    for i in range(num_channels)
+                },
+            }
+        }
+
+    def _pack_raw_data_with_metadata(self, data):
+        if isinstance(data, bytes):
+            return data
+        return super()._pack_raw_data_with_metadata(data)
+
+    def _pack_dict_with_metadata(self, data):
+        # As ArtificialND2, but with the offset of nested dicts measured from
+        # the start of the item, which is what nd2reader expects when reading
+        raw_data = b""
+        for key, value in data.items():
+            item = struct.pack("BB", self._get_data_type(value), len(key) + 1)
+            item += self._str_to_padded_bytes(key)
+            sub_data = self._pack_raw_data_with_metadata(value)
+            if isinstance(value, dict):
+                item += struct.pack("<IQ", len(value), len(item) + 12 + len(sub_data))
+                item += sub_data + bytes(8 * len(value))
+            else:
+                item += sub_data
+            raw_data += item
+        return raw_data
+
+    def _get_file_data(self, labels):
+        file_data, data_dict = super()._get_file_data(labels)
+        # Image group: 8 byte timestamp followed by the interleaved pixels
+        interleaved = np.ascontiguousarray(np.moveaxis(self.planes, 0, -1))
+        file_data[-1] = self._pack_data_with_metadata(
+            struct.pack("d", 0.0) + interleaved.astype("<u2").tobytes()
+        )
+        return file_data, data_dict
+
+    def create_label_map_bytes(self):
+        file_data, data_dict = self._get_file_data(global_labels)
+        label_length = sum(len(label) + 16 for label in global_file_labels)
+        position = self._get_version_byte_length() + label_length
+
+        label_map = b""
+        locations = {}
+        for label, file_label, data in zip(
+            global_labels, global_file_labels, file_data
+        ):
+            label_map += file_label.encode() + struct.pack("QQ", position, len(data))
+            locations[label] = (position, len(data))
+            position += len(data)
+        return label_map + b"".join(file_data), locations, data_dict
+
+
+def write_nd2(path, red, green, blue):
+    """Writes the three channels to a single field .nd2 file."""
+    with SyntheticND2(path, np.stack([red, green, blue])):
+        pass
+    return path
+
+
+def make_plate(directory, num_images=8, seed=0, **image_options):
+    """Writes num_images synthetic .nd2 images to directory, each with its own
+    seed. image_options are passed to synthetic_channels.
+
+    Returns
+    -------
+    paths: paths of the written images
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(num_images):
+        path = os.path.join(directory, f"well_{i:03d}.nd2")
+        write_nd2(path, *synthetic_channels(seed=seed + i, **image_options))
+        paths.append(path)
+    return paths
+
+
+def add_image_arguments(parser):
+    """Options of synthetic_channels, shared with the benchmark script."""
+    parser.add_argument(
+        "--size",
+        nargs=2,
+        type=int,
+        default=(2048, 2048),
+        metavar=("HEIGHT", "WIDTH"),
+        help="Image size in pixels",
+    )
+    parser.add_argument(
+        "--density", type=float, default=200, help="Nuclei per megapixel"
+    )
+    parser.add_argument(
+        "--radius",
+        nargs=2,
+        type=int,
+        default=(6, 30),
+        metavar=("MIN", "MAX"),
+        help="Range of nucleus radii in pixels",
+    )
+    parser.add_argument(
+        "--no-ring", action="store_true", help="Leave out the well ring"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+
+def image_options(args):
+    return dict(
+        shape=tuple(args.size),
+        nuclei_density=args.density,
+        radius_range=tuple(args.radius),
+        well_ring=not args.no_ring,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write a plate of synthetic .nd2 images"
+    )
+    parser.add_argument("directory", help="Output folder")
+    parser.add_argument("--images", type=int, default=8, help="Number of images")
+    add_image_arguments(parser)
+    args = parser.parse_args(argv)
+
+    paths = make_plate(
+        args.directory, args.images, seed=args.seed, **image_options(args)
+    )
+    print(f"Wrote {len(paths)} images to {args.directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,31 @@ setup(
     description="Senolysis quantification using nuclei segmentation",
     py_modules=[
         "gui_senolysis",
+        "incremental",
+        "intensity_histogram",
+        "job_queue",
+        "label_outputs",
+        "nd2_loading",
+        "nuclei_features",
+        "nuclei_table",
+        "overlay",
+        "parameters",
+        "pipeline",
+        "preprocessing",
+        "profiling",
+        "refinement",
+        "results_sink",
+        "scheduling",
         "senolysis_analysis",
         "senolysis_functions",
         "senolysis_main",
+        "telemetry",
+        "threshold_sweep",
+        "tiled_analysis",
+        "tiling",
+        "watch_folder",
+        "worker_pool",
+        "well_mask",
     ],
     package_dir={"": "src"},
     author_email="robert.welch@scilifelab.se",
@@ -25,9 +47,13 @@ setup(
         "tk",
         "slicerator",
         "openpyxl",
-        "tqdm_joblib",
-        "joblib",
+        "tqdm",
+        "tomli; python_version < '3.11'",
     ],
+    extras_require={
+        "features": ["pyarrow"],
+        "watch": ["watchdog"],
+    },
     entry_points={
         "console_scripts": [
             "senolysisprogram=senolysis_main:main",
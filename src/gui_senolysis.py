@@ -2,6 +2,10 @@ from dataclasses import dataclass
 import tkinter as tk
 from tkinter.filedialog import askdirectory
 import os
+from label_outputs import MASK_FORMATS
+from nuclei_features import FEATURE_FORMATS
+from overlay import FIGURE_MODES
+from parameters import parse_nuclei_threshold, parse_num_jobs
 
 
 class GUI(tk.Tk):
@@ -49,10 +53,10 @@ class GUI(tk.Tk):
          # Get Number of jobs
         self.num_jobs_label = tk.Label(
             self.frame,
-            text=f"Enter number of images to run in parallel (max: {os.cpu_count()})",
+            text=f"Enter number of images to run in parallel (max: {os.cpu_count()}, or auto)",
         )
         self.num_jobs_label.grid(row=1, column=2)
-        self.num_jobs_entry = tk.Entry(self.frame, textvariable=tk.IntVar(value=1))
+        self.num_jobs_entry = tk.Entry(self.frame, textvariable=tk.StringVar(value="1"))
         self.num_jobs_entry.insert(tk.END, "")
         self.num_jobs_entry.grid(row=2, column=2)
 
@@ -112,6 +116,30 @@ class GUI(tk.Tk):
         self.nuclei_max_entry.insert(tk.END, "")
         self.nuclei_max_entry.grid(row=6, column=2)
 
+        # Figure output option, Matplotlib is slow for large batches
+        self.figure_mode_label = tk.Label(
+            self.frame,
+            text=f"Segmentation figure",
+        )
+        self.figure_mode_label.grid(row=5, column=0)
+        self.figure_mode = tk.StringVar(value=FIGURE_MODES[0])
+        self.figure_mode_menu = tk.OptionMenu(
+            self.frame, self.figure_mode, *FIGURE_MODES
+        )
+        self.figure_mode_menu.grid(row=6, column=0)
+
+        # Per-nucleus feature table output option
+        self.feature_export_label = tk.Label(
+            self.frame,
+            text=f"Nuclei feature table",
+        )
+        self.feature_export_label.grid(row=7, column=2)
+        self.feature_export = tk.StringVar(value=FEATURE_FORMATS[0])
+        self.feature_export_menu = tk.OptionMenu(
+            self.frame, self.feature_export, *FEATURE_FORMATS
+        )
+        self.feature_export_menu.grid(row=8, column=2)
+
         # Remove Well-Ring option
         self.remove_well_ring = tk.IntVar()
         self.well_ring_checkbox = tk.Checkbutton(
@@ -122,6 +150,85 @@ class GUI(tk.Tk):
         self.well_ring_checkbox.select()
         self.well_ring_checkbox.grid(row=7, column=1)
 
+        # Reuse the well outline of earlier images at the same stage position
+        self.reuse_well_mask = tk.IntVar()
+        self.reuse_well_mask_checkbox = tk.Checkbutton(
+            self.frame,
+            text="Reuse well outline between images",
+            variable=self.reuse_well_mask,
+        )
+        self.reuse_well_mask_checkbox.grid(row=7, column=0)
+
+        # Memory budget per image, large images are then analyzed in tiles
+        self.memory_budget_label = tk.Label(
+            self.frame,
+            text=f"Memory budget per image (MB, 0 = no limit)",
+        )
+        self.memory_budget_label.grid(row=9, column=1)
+        self.memory_budget_entry = tk.Entry(self.frame, textvariable=tk.IntVar(value=0))
+        self.memory_budget_entry.insert(tk.END, "")
+        self.memory_budget_entry.grid(row=10, column=1)
+
+        # Segment on images downscaled by this factor
+        self.downscale_factor_label = tk.Label(
+            self.frame,
+            text=f"Downscale factor for segmentation",
+        )
+        self.downscale_factor_label.grid(row=9, column=2)
+        self.downscale_factor_entry = tk.Entry(
+            self.frame, textvariable=tk.IntVar(value=4)
+        )
+        self.downscale_factor_entry.insert(tk.END, "")
+        self.downscale_factor_entry.grid(row=10, column=2)
+
+        # Segment nuclei again at full resolution around the downscaled nuclei
+        self.refine_nuclei = tk.IntVar()
+        self.refine_nuclei_checkbox = tk.Checkbutton(
+            self.frame,
+            text="Refine nuclei at full resolution",
+            variable=self.refine_nuclei,
+        )
+        self.refine_nuclei_checkbox.grid(row=9, column=0)
+
+        # Read, analyze and save images in overlapping stages
+        self.pipelined = tk.IntVar()
+        self.pipelined_checkbox = tk.Checkbutton(
+            self.frame,
+            text="Overlap reading, analysis and saving",
+            variable=self.pipelined,
+        )
+        self.pipelined_checkbox.grid(row=11, column=0)
+
+        # Keep intensities in float32 instead of float64
+        self.compact_dtypes = tk.IntVar()
+        self.compact_dtypes_checkbox = tk.Checkbutton(
+            self.frame,
+            text="Compact (float32) intensities",
+            variable=self.compact_dtypes,
+        )
+        self.compact_dtypes_checkbox.grid(row=12, column=0)
+
+        # Save the intensity histogram of every channel for quality control
+        self.qc_export = tk.IntVar()
+        self.qc_export_checkbox = tk.Checkbutton(
+            self.frame,
+            text="Save intensity QC",
+            variable=self.qc_export,
+        )
+        self.qc_export_checkbox.grid(row=12, column=1)
+
+        # Masks as full resolution PNGs or as one compressed label image
+        self.mask_format_label = tk.Label(
+            self.frame,
+            text=f"Mask output",
+        )
+        self.mask_format_label.grid(row=11, column=2)
+        self.mask_format = tk.StringVar(value=MASK_FORMATS[0])
+        self.mask_format_menu = tk.OptionMenu(
+            self.frame, self.mask_format, *MASK_FORMATS
+        )
+        self.mask_format_menu.grid(row=12, column=2)
+
         # Run Analysis Button
         run_text = tk.StringVar()
         run_text.set("Run Analysis")
@@ -132,7 +239,7 @@ class GUI(tk.Tk):
             height=2,
             width=10,
         )
-        run_btun.grid(row=8, column=1)
+        run_btun.grid(row=11, column=1)
 
     # Choose Image Directory
     def select_directory(self):
@@ -142,24 +249,28 @@ class GUI(tk.Tk):
 
     # Save inputs and close GUI
     def quit(self):
-        self.num_jobs = int(self.num_jobs_entry.get())
+        self.num_jobs = parse_num_jobs(self.num_jobs_entry.get())
         self.scenescent_threshold = int(self.red_threshold_entry.get())
         self.remove_well_ring = int(self.remove_well_ring.get())
+        self.reuse_well_mask = int(self.reuse_well_mask.get())
+        self.figure_mode = str(self.figure_mode.get())
+        self.feature_export = str(self.feature_export.get())
+        self.mask_format = str(self.mask_format.get())
         self.min_nuclei_size = int(self.nuclei_min_entry.get())
         self.max_nuclei_size = int(self.nuclei_max_entry.get())
+        self.memory_budget = int(self.memory_budget_entry.get())
+        self.downscale_factor = int(self.downscale_factor_entry.get())
+        self.refine_nuclei = int(self.refine_nuclei.get())
+        self.pipelined = int(self.pipelined.get())
+        self.compact_dtypes = int(self.compact_dtypes.get())
+        self.qc_export = int(self.qc_export.get())
         self.scenescent_channel = int(self.scenescent_channel_entry.get())
         self.quiescent_channel = int(self.quiescent_channel_entry.get())
         self.nuclei_chanel = int(self.nuclei_chanel_entry.get())
 
         #get the nuclei threshold as Otsu or global threshold value for uint16
-        if self.nuclei_threshold_entry.get().lower() == 'otsu':
-            self.nuclei_threshold = str(self.nuclei_threshold_entry.get())
-            self.thresholding_method = 'Otsu'
-        else:
-            try:
-                self.nuclei_threshold = float(self.nuclei_threshold_entry.get())
-                self.thresholding_method = 'Global'
-            except:
-                raise ValueError(f'You entered {self.nuclei_threshold_entry.get()} for the nuclei threshold. This is not a valid nuclei threshold. The value should be Otsu for automatic segmentation of nuclei or a manual global threshold (0-65535)')
+        self.nuclei_threshold, self.thresholding_method = parse_nuclei_threshold(
+            self.nuclei_threshold_entry.get()
+        )
 
         self.after(100, self.destroy())
@@ -0,0 +1,345 @@
+from dataclasses import asdict
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import traceback
+import uuid
+
+import pandas as pd
+
+from profiling import profiler
+from results_sink import ResultsSink, shard_name
+from senolysis_analysis import senolysis_analysis
+from senolysis_functions import get_save_path
+from telemetry import task_stats
+
+CACHE_DIRNAME = ".senolysis_cache"
+RUNS_DIRNAME = ".senolysis_runs"
+
+# Parameters that do not change the results of an image
+RUN_ONLY_PARAMETERS = ("directory", "num_jobs", "profile", "pipelined")
+
+
+def _code_version():
+    # Any change to the program source invalidates previously cached results
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+CODE_VERSION = _code_version()
+
+
+def result_parameters(params):
+    """The analysis parameters that determine the results of an image."""
+    return {
+        name: value
+        for name, value in asdict(params).items()
+        if name not in RUN_ONLY_PARAMETERS
+    }
+
+
+def _link_or_copy(source, destination):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ResultCache:
+    """Persistent cache of per-image results, stored next to the images.
+
+    Entries are keyed on the image path, size and modification time, the
+    analysis parameters, the analyzed fields and the program version, so an
+    unchanged image analyzed with the same settings costs a stat call plus
+    linking its saved outputs into the new results folder.
+
+    Parameters
+    ----------
+    img_path: path to the .nd2 file
+    params: AnalysisParameters of the run
+    fields: analyzed fields, None for all fields of the file
+    """
+
+    def __init__(self, img_path, params, fields=None):
+        self.img_path = img_path
+        stat = os.stat(img_path)
+        key = json.dumps(
+            {
+                "path": os.path.abspath(img_path),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "parameters": result_parameters(params),
+                "fields": None if fields is None else [list(f) for f in fields],
+                "code_version": CODE_VERSION,
+            },
+            sort_keys=True,
+        )
+        self.key = hashlib.sha256(key.encode()).hexdigest()
+        self.entry = os.path.join(os.path.dirname(img_path), CACHE_DIRNAME, self.key)
+
+    def restore(self, save_path):
+        """Links the cached outputs into save_path and appends the cached rows to
+        the results. Returns False if there is no cache entry."""
+        if not os.path.isdir(self.entry):
+            return False
+
+        os.makedirs(save_path, exist_ok=True)
+        for name in os.listdir(self.entry):
+            if name != "rows.jsonl":
+                _link_or_copy(
+                    os.path.join(self.entry, name), os.path.join(save_path, name)
+                )
+
+        with open(os.path.join(self.entry, "rows.jsonl"), encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        if records:
+            ResultsSink(save_path).append(pd.DataFrame.from_records(records))
+
+        return True
+
+    def store(self, results, output_paths):
+        """Saves the results dataframes and output images of an analysis."""
+        if os.path.isdir(self.entry):
+            return
+
+        # Build the entry in a temporary folder and move it in place at once, so
+        # an interrupted write never leaves a partial entry behind
+        temporary = f"{self.entry}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(temporary)
+        for path in output_paths:
+            _link_or_copy(path, os.path.join(temporary, os.path.basename(path)))
+
+        with open(os.path.join(temporary, "rows.jsonl"), "w", encoding="utf-8") as f:
+            for results_dataframe in results:
+                lines = results_dataframe.to_json(
+                    orient="records", lines=True, force_ascii=False
+                ).rstrip("\n")
+                f.write(lines + "\n")
+
+        try:
+            os.rename(temporary, self.entry)
+        except OSError:
+            # Another worker stored the same entry first
+            shutil.rmtree(temporary, ignore_errors=True)
+
+
+class RunManifest:
+    """Record of an analysis run, used to resume it after an interruption.
+
+    The manifest is a folder in the analyzed directory holding the run
+    parameters and, per worker process, the list of completed tasks. Result rows
+    of completed tasks are already in the results shards, so a resumed run only
+    analyzes the remaining tasks and then merges everything.
+
+    Parameters
+    ----------
+    path: manifest folder
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, params, program_start_time):
+        path = os.path.join(params.directory, RUNS_DIRNAME, program_start_time)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "run.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "program_start_time": program_start_time,
+                    "parameters": result_parameters(params),
+                    "code_version": CODE_VERSION,
+                },
+                f,
+                indent=2,
+            )
+        return cls(path)
+
+    @classmethod
+    def find_unfinished(cls, params):
+        """Most recent unfinished run in params.directory with the same
+        parameters and program version, or None."""
+        runs_dir = os.path.join(params.directory, RUNS_DIRNAME)
+        if not os.path.isdir(runs_dir):
+            return None
+
+        for name in sorted(os.listdir(runs_dir), reverse=True):
+            run = cls(os.path.join(runs_dir, name))
+            try:
+                info = run.info
+            except (OSError, ValueError):
+                continue
+            if (
+                not info.get("finished", False)
+                and info["parameters"] == result_parameters(params)
+                and info["code_version"] == CODE_VERSION
+            ):
+                return run
+        return None
+
+    @property
+    def info(self):
+        with open(os.path.join(self.path, "run.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    @property
+    def program_start_time(self):
+        return self.info["program_start_time"]
+
+    def completed(self):
+        """Set of (img_path, field) completed so far, field is None when all
+        fields of the image were analyzed together."""
+        done = set()
+        for shard in glob.glob(os.path.join(self.path, "done_*.jsonl")):
+            with open(shard, encoding="utf-8") as lines:
+                for line in lines:
+                    try:
+                        task = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if task["fields"] is None:
+                        done.add((task["image"], None))
+                    else:
+                        done.update(
+                            (task["image"], tuple(field)) for field in task["fields"]
+                        )
+        return done
+
+    def _append(self, kind, img_path, fields, **record):
+        shard = os.path.join(self.path, shard_name(kind))
+        with open(shard, "a", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "image": img_path,
+                        "fields": None
+                        if fields is None
+                        else [list(field) for field in fields],
+                        **record,
+                    }
+                )
+                + "\n"
+            )
+
+    def mark_done(self, img_path, fields, stats=None):
+        """Records a completed task, with its telemetry.task_stats if given."""
+        self._append("done", img_path, fields, **(stats or {}))
+
+    def mark_failed(self, img_path, fields, error, stats=None):
+        """Records a task whose analysis raised an error, with the traceback
+        of the error."""
+        self._append("failed", img_path, fields, error=error, **(stats or {}))
+
+    def failures(self):
+        """Records of the failed tasks that were not completed since, e.g. by
+        a resumed run, in the order they failed."""
+        completed = self.completed()
+        failures = []
+        for shard in sorted(glob.glob(os.path.join(self.path, "failed_*.jsonl"))):
+            with open(shard, encoding="utf-8") as lines:
+                for line in lines:
+                    try:
+                        task = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if task["fields"] is None:
+                        keys = [(task["image"], None)]
+                    else:
+                        keys = [(task["image"], tuple(f)) for f in task["fields"]]
+                    if not all(key in completed for key in keys):
+                        failures.append(task)
+        failures.sort(key=lambda task: task.get("end", 0))
+        return failures
+
+    def finish(self):
+        info = self.info
+        info["finished"] = True
+        with open(os.path.join(self.path, "run.json"), "w", encoding="utf-8") as f:
+            json.dump(info, f, indent=2)
+
+
+def image_tasks(img_path, params, list_fields, split_fields=None):
+    """(img_path, fields) tasks of one image. Fields (positions / timepoints) of
+    multi-field files are separate tasks when images are analyzed in parallel
+    (or split_fields is True), so they run in parallel too."""
+    if split_fields is None:
+        split_fields = params.num_jobs > 1
+    if split_fields:
+        try:
+            fields = list_fields(img_path)
+        except Exception:
+            # An unreadable file is one task, whose analysis reports the error
+            return [(img_path, None)]
+        if len(fields) > 1:
+            return [(img_path, [field]) for field in fields]
+    return [(img_path, None)]
+
+
+def remaining_tasks(tasks, completed, list_fields):
+    """Drops the (img_path, fields) tasks, or the fields of tasks, that are in
+    completed. list_fields(img_path) lists the fields of an image."""
+    remaining = []
+    for img_path, fields in tasks:
+        if (img_path, None) in completed:
+            continue
+        done_fields = {field for path, field in completed if path == img_path}
+        if not done_fields:
+            remaining.append((img_path, fields))
+            continue
+        fields = list_fields(img_path) if fields is None else fields
+        fields = [field for field in fields if tuple(field) not in done_fields]
+        if fields:
+            remaining.append((img_path, fields))
+    return remaining
+
+
+def run_task(
+    img_path,
+    program_start_time,
+    params,
+    fields=None,
+    manifest_path=None,
+    use_cache=True,
+):
+    """Analyzes one task, reusing cached results when possible, and records it
+    as completed in the run manifest.
+
+    With a run manifest, an error of the analysis is recorded there as a failed
+    task (see RunManifest.failures) and the run goes on with the next task.
+    Without one the error is raised.
+    """
+    save_path = get_save_path(img_path, program_start_time)
+
+    start = time.time()
+    try:
+        with profiler.timed() as stage_times:
+            cache = ResultCache(img_path, params, fields) if use_cache else None
+            cached = cache is not None and cache.restore(save_path)
+            if not cached:
+                results, output_paths = senolysis_analysis(
+                    img_path, program_start_time, params, fields=fields
+                )
+                if cache is not None:
+                    cache.store(results, output_paths)
+    except Exception:
+        if manifest_path is None:
+            raise
+        RunManifest(manifest_path).mark_failed(
+            img_path, fields, traceback.format_exc(), task_stats(start, stage_times)
+        )
+        return
+
+    if manifest_path is not None:
+        RunManifest(manifest_path).mark_done(
+            img_path, fields, task_stats(start, stage_times, cached=cached)
+        )
+
+    return
@@ -0,0 +1,236 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from skimage.filters import threshold_otsu
+
+# Bins of the histograms of continuous images, as threshold_otsu uses
+NBINS = 256
+QC_SUFFIX = "_intensity_qc.json"
+RUN_QC_NAME = "Senolysis_intensity_qc.xlsx"
+
+
+def _lerp(a, b, t):
+    # Linear interpolation as numpy computes it for percentiles, so results
+    # are identical to np.percentile
+    difference = b - a
+    if t >= 0.5:
+        return b - difference * (1 - t)
+    return a + difference * t
+
+
+def _block_means(first, num_bins, scale, dtype):
+    # Values of consecutive block sums divided in the image dtype, as
+    # nd2_loading.downscale divides them
+    dtype = np.dtype(dtype)
+    return (first + np.arange(num_bins)).astype(dtype) / dtype.type(scale)
+
+
+class IntensityHistogram:
+    """Fixed-bin histogram of one channel image, built in a single pass, from
+    which its percentiles, mean and Otsu threshold are derived.
+
+    Images downscaled by local means of uint16 pixels only hold multiples of
+    1 / downscale_factor**2, so from_downscaled gives them one bin per possible
+    value and their percentiles equal np.percentile exactly. Other images use
+    NBINS equal bins between their minimum and maximum, as threshold_otsu does,
+    so their Otsu threshold equals threshold_otsu and their percentiles are
+    interpolated within a bin. The mean is accumulated while the histogram is
+    built and equals np.mean.
+
+    Parameters
+    ----------
+    counts: number of pixels in every bin
+    bin_centers: value of every bin, in the dtype of the image
+    mean: mean of the image
+    exact: True if every pixel lies exactly on its bin center
+    block_sums: (first block sum, downscale_factor**2) of exact histograms of
+        downscaled images, which have a bin for every block sum from the first
+    """
+
+    def __init__(self, counts, bin_centers, mean, exact=False, block_sums=None):
+        self.counts = counts
+        self.bin_centers = bin_centers
+        self.mean = mean
+        self.exact = exact
+        self.block_sums = block_sums
+
+    @classmethod
+    def from_downscaled(cls, img, downscale_factor):
+        """Exact histogram of an image downscaled with local means (see
+        nd2_loading.downscale)."""
+        scale = downscale_factor**2
+        # Block sums, the integers the image was divided from
+        sums = np.rint(img * scale).astype(np.int64)
+        return cls.from_block_sums(sums, scale, np.mean(img), img.dtype)
+
+    @classmethod
+    def from_block_sums(cls, sums, scale, mean, dtype):
+        """Exact histogram of the downscaled image sums / scale in dtype, from
+        its integer block sums."""
+        sums = sums.ravel()
+        first = int(sums.min())
+        counts = np.bincount(sums - first)
+        return cls(
+            counts,
+            _block_means(first, len(counts), scale, dtype),
+            mean,
+            exact=True,
+            block_sums=(first, scale),
+        )
+
+    @classmethod
+    def from_image(cls, img, nbins=NBINS, value_range=None):
+        """Histogram of nbins equal bins over value_range, by default the
+        range of img."""
+        if value_range is None:
+            value_range = (img.min(), img.max())
+        low, high = value_range
+        if low == high:
+            # A single value, threshold_otsu returns it
+            return cls(np.array([img.size]), np.array([low]), np.mean(img), True)
+        counts, bin_edges = np.histogram(img, bins=nbins, range=(low, high))
+        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2.0
+        return cls(counts, bin_centers, np.mean(img))
+
+    def __add__(self, other):
+        """Histogram of two images, e.g. two tiles, with the same bins or both
+        downscaled by the same factor."""
+        total = self.num_pixels + other.num_pixels
+        mean = (self.mean * self.num_pixels + other.mean * other.num_pixels) / total
+        if self.block_sums is None or other.block_sums is None:
+            return IntensityHistogram(
+                self.counts + other.counts,
+                self.bin_centers,
+                mean,
+                self.exact and other.exact,
+            )
+
+        (first, scale), (other_first, _) = self.block_sums, other.block_sums
+        start = min(first, other_first)
+        stop = max(first + len(self.counts), other_first + len(other.counts))
+        counts = np.zeros(stop - start, dtype=np.intp)
+        counts[first - start : first - start + len(self.counts)] += self.counts
+        counts[
+            other_first - start : other_first - start + len(other.counts)
+        ] += other.counts
+        return IntensityHistogram(
+            counts,
+            _block_means(start, len(counts), scale, self.bin_centers.dtype),
+            mean,
+            exact=True,
+            block_sums=(start, scale),
+        )
+
+    @property
+    def num_pixels(self):
+        return int(self.counts.sum())
+
+    def _value(self, cumulative, rank):
+        # Value of the pixel at rank in sorted order
+        return self.bin_centers[np.searchsorted(cumulative, rank, side="right")]
+
+    def percentile(self, q):
+        """q-th percentile of the image, with numpy's default linear
+        interpolation."""
+        cumulative = np.cumsum(self.counts)
+        n = int(cumulative[-1])
+        # Position in the sorted pixels as np.percentile computes it
+        index = (n - 1) * np.true_divide(q, 100)
+        below = int(np.floor(index))
+        fraction = float(index - below)
+        above = min(below + 1, n - 1)
+        a, b = (self._value(cumulative, rank) for rank in (below, above))
+        return _lerp(a, b, fraction)
+
+    def otsu(self):
+        """Otsu threshold of the image."""
+        if len(self.counts) == 1:
+            return self.bin_centers[0]
+        return threshold_otsu(hist=(self.counts, self.bin_centers))
+
+    def summary(self, percentiles=(1, 50, 98, 99)):
+        """Quality control statistics of the image."""
+        nonzero = np.flatnonzero(self.counts)
+        centers = self.bin_centers
+        stats = {
+            "pixels": self.num_pixels,
+            "min": float(centers[nonzero[0]]),
+            "max": float(centers[nonzero[-1]]),
+            "mean": float(self.mean),
+        }
+        for q in percentiles:
+            stats[f"p{q}"] = float(self.percentile(q))
+        stats["otsu"] = float(self.otsu())
+        # Pixels at the largest value, e.g. saturated areas
+        stats["max_fraction"] = float(self.counts[nonzero[-1]] / self.num_pixels)
+        return stats
+
+    def to_dict(self):
+        """The summary and the pixel counts of every value in the histogram,
+        for saving as JSON."""
+        nonzero = np.flatnonzero(self.counts)
+        return {
+            **self.summary(),
+            "exact": self.exact,
+            # Only the bins that hold pixels, exact histograms have many
+            "values": self.bin_centers[nonzero].tolist(),
+            "counts": self.counts[nonzero].tolist(),
+        }
+
+
+def save_qc(histograms, img_path, path, field=None):
+    """Writes the channel histograms of one analyzed field and their summary
+    statistics to a JSON file.
+
+    Parameters
+    ----------
+    histograms: dict of channel name to IntensityHistogram
+    img_path: path to the analyzed image
+    path: path of the JSON file, ending in QC_SUFFIX
+    field: (timepoint, position) of multi-field files, None otherwise
+    """
+    qc = {"Image": os.path.basename(img_path)}
+    if field is not None:
+        qc["Timepoint"], qc["Position"] = (int(index) for index in field)
+    qc["channels"] = {name: hist.to_dict() for name, hist in histograms.items()}
+    with open(path, "w") as f:
+        json.dump(qc, f)
+    return path
+
+
+def merge_qc(save_path, image_order=None):
+    """Combines the summary statistics of the intensity QC files in save_path
+    into one workbook with a row per field and a column per channel and
+    statistic.
+
+    Returns
+    -------
+    merged: the combined table, None if there are no QC files
+    """
+    rows = []
+    for path in sorted(glob.glob(os.path.join(save_path, "*" + QC_SUFFIX))):
+        with open(path) as f:
+            qc = json.load(f)
+        row = {key: value for key, value in qc.items() if key != "channels"}
+        for name, channel in qc["channels"].items():
+            for statistic, value in channel.items():
+                if statistic not in ("exact", "values", "counts"):
+                    row[f"{name} {statistic}"] = value
+        rows.append(row)
+    if not rows:
+        return None
+
+    merged = pd.DataFrame.from_records(rows)
+    if image_order is not None:
+        order = {name: i for i, name in enumerate(image_order)}
+        field_columns = [c for c in ("Timepoint", "Position") if c in merged]
+        merged = merged.sort_values(
+            ["Image"] + field_columns,
+            key=lambda column: column.map(order) if column.name == "Image" else column,
+            kind="stable",
+        ).reset_index(drop=True)
+    merged.to_excel(os.path.join(save_path, RUN_QC_NAME), index=False)
+    return merged
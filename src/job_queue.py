@@ -0,0 +1,335 @@
+from contextlib import contextmanager
+from dataclasses import asdict
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from incremental import run_task
+from parameters import AnalysisParameters
+
+QUEUE_DIRNAME = ".senolysis_queue"
+# Seconds without a heartbeat after which the task of a worker is considered
+# abandoned (e.g. the worker or its node was killed) and is analyzed again
+LEASE_TIME = 300.0
+# Seconds between checks for tasks of other workers whose lease expired
+POLL_INTERVAL = 5.0
+
+
+def worker_name():
+    return f"{socket.gethostname()}_{os.getpid()}"
+
+
+def _write_atomic(path, text):
+    # Readers on other hosts see either no file or the whole file
+    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+class JobQueue:
+    """File-based queue of the tasks of one analysis run, shared by worker
+    processes on any number of hosts that mount the image directory.
+
+    The queue is a folder in the image directory. queue.json holds the run
+    parameters and the (image, fields) tasks, with image paths relative to the
+    image directory so hosts may mount it at different paths. A worker claims
+    a task by creating its lease file, which fails if another worker created
+    it first, and renews the lease while it analyzes the task. Leases that
+    have not been renewed for lease_time seconds, because their worker was
+    killed, are taken over by the next worker looking for a task. Finished
+    and failed tasks are recorded with a marker file each. Times are compared
+    on the clock of the shared file system, so the clocks of the hosts do not
+    need to agree.
+
+    Parameters
+    ----------
+    path: queue folder
+    lease_time: seconds after which a lease that was not renewed expires
+    """
+
+    def __init__(self, path, lease_time=LEASE_TIME):
+        self.path = path
+        self.lease_time = lease_time
+        self.directory = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+        with open(os.path.join(path, "queue.json"), encoding="utf-8") as f:
+            info = json.load(f)
+        self.program_start_time = info["program_start_time"]
+        self.params = AnalysisParameters(
+            **{**info["parameters"], "directory": self.directory}
+        )
+        # Images of the run in their original order, for the results workbook
+        self.img_paths = [
+            os.path.join(self.directory, image) for image in info["images"]
+        ]
+        self.tasks = [
+            (
+                os.path.join(self.directory, task["image"]),
+                None
+                if task["fields"] is None
+                else [tuple(field) for field in task["fields"]],
+            )
+            for task in info["tasks"]
+        ]
+
+    @classmethod
+    def create(cls, params, program_start_time, img_paths, tasks):
+        """Queues the (img_path, fields) tasks of the images of a new run in
+        params.directory."""
+        path = os.path.join(params.directory, QUEUE_DIRNAME, program_start_time)
+        for name in ("leases", "done", "failed", "clock"):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+        parameters = asdict(params)
+        del parameters["directory"]
+        info = {
+            "program_start_time": program_start_time,
+            "parameters": parameters,
+            "images": [
+                os.path.relpath(img_path, params.directory) for img_path in img_paths
+            ],
+            "tasks": [
+                {
+                    "image": os.path.relpath(img_path, params.directory),
+                    "fields": None
+                    if fields is None
+                    else [list(field) for field in fields],
+                }
+                for img_path, fields in tasks
+            ],
+        }
+        _write_atomic(os.path.join(path, "queue.json"), json.dumps(info, indent=2))
+        return cls(path)
+
+    @classmethod
+    def latest(cls, directory):
+        """Most recent queue in directory that was not finalized, or None."""
+        queues_dir = os.path.join(directory, QUEUE_DIRNAME)
+        if not os.path.isdir(queues_dir):
+            return None
+        for name in sorted(os.listdir(queues_dir), reverse=True):
+            path = os.path.join(queues_dir, name)
+            if os.path.isfile(os.path.join(path, "queue.json")):
+                queue = cls(path)
+                if not queue.finished:
+                    return queue
+        return None
+
+    def _marker(self, kind, task_id):
+        return os.path.join(self.path, kind, f"{task_id}")
+
+    def _lease(self, task_id):
+        return os.path.join(self.path, "leases", f"{task_id}.lease")
+
+    def now(self):
+        """Current time of the shared file system's clock."""
+        clock = os.path.join(self.path, "clock", worker_name())
+        with open(clock, "w"):
+            pass
+        return os.stat(clock).st_mtime
+
+    def _expired(self, lease, now):
+        try:
+            return now - os.stat(lease).st_mtime > self.lease_time
+        except FileNotFoundError:
+            return False
+
+    def _create_lease(self, task_id):
+        try:
+            fd = os.open(self._lease(task_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(worker_name())
+        return True
+
+    def claim(self):
+        """Claims the first task that is neither finished nor leased by a live
+        worker.
+
+        Returns
+        -------
+        task_id: index of the claimed task in tasks, None if there is none
+        """
+        now = None
+        for task_id in range(len(self.tasks)):
+            if self.is_finished(task_id):
+                continue
+            if self._create_lease(task_id):
+                if self.is_finished(task_id):
+                    # Finished since it was checked above
+                    self.release(task_id)
+                    continue
+                return task_id
+
+            now = self.now() if now is None else now
+            lease = self._lease(task_id)
+            if self._expired(lease, now):
+                # Only one worker can move the abandoned lease away
+                expired = f"{lease}.{uuid.uuid4().hex}.expired"
+                try:
+                    os.rename(lease, expired)
+                except FileNotFoundError:
+                    continue
+                claimed = self._create_lease(task_id)
+                os.remove(expired)
+                if claimed:
+                    return task_id
+        return None
+
+    @contextmanager
+    def heartbeat(self, task_id):
+        """Renews the lease of task_id in a background thread while the with
+        block runs."""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_time / 4):
+                try:
+                    os.utime(self._lease(task_id))
+                except FileNotFoundError:
+                    # Taken over by another worker after a long stall
+                    pass
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, task_id):
+        try:
+            os.remove(self._lease(task_id))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task_id):
+        _write_atomic(self._marker("done", task_id), worker_name())
+        self.release(task_id)
+
+    def fail(self, task_id, error):
+        """Records a task whose analysis raised, it is not analyzed again."""
+        _write_atomic(self._marker("failed", task_id), f"{worker_name()}\n{error}")
+        self.release(task_id)
+
+    def is_finished(self, task_id):
+        return os.path.exists(self._marker("done", task_id)) or os.path.exists(
+            self._marker("failed", task_id)
+        )
+
+    def status(self):
+        """Number of tasks that are done, failed, being analyzed and waiting."""
+        done = set(os.listdir(os.path.join(self.path, "done")))
+        failed = set(os.listdir(os.path.join(self.path, "failed")))
+        leased = {
+            name.split(".")[0]
+            for name in os.listdir(os.path.join(self.path, "leases"))
+            if name.endswith(".lease")
+        }
+        task_ids = {f"{task_id}" for task_id in range(len(self.tasks))}
+        finished = (done | failed) & task_ids
+        return {
+            "done": len(done & task_ids),
+            "failed": len(failed & task_ids),
+            "running": len((leased & task_ids) - finished),
+            "waiting": len(task_ids - finished - leased),
+        }
+
+    def failures(self):
+        """(img_path, fields, error) of every failed task."""
+        failures = []
+        for task_id, (img_path, fields) in enumerate(self.tasks):
+            try:
+                with open(self._marker("failed", task_id), encoding="utf-8") as f:
+                    failures.append((img_path, fields, f.read()))
+            except FileNotFoundError:
+                continue
+        return failures
+
+    def all_finished(self):
+        return all(self.is_finished(task_id) for task_id in range(len(self.tasks)))
+
+    def claim_finalization(self):
+        """True for exactly one caller once all tasks are finished, which then
+        merges the results of the run and calls finish."""
+        if not self.all_finished():
+            return False
+        try:
+            fd = os.open(
+                os.path.join(self.path, "finalizing"),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+            )
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write(worker_name())
+        return True
+
+    def finish(self):
+        _write_atomic(os.path.join(self.path, "finalized"), worker_name())
+
+    @property
+    def finished(self):
+        return os.path.exists(os.path.join(self.path, "finalized"))
+
+
+def work(
+    queue_path,
+    use_cache=True,
+    stop_path=None,
+    on_task_done=None,
+    poll_interval=POLL_INTERVAL,
+):
+    """Worker loop: claims and analyzes tasks of the queue until all tasks are
+    finished. While the remaining tasks are leased by other workers it keeps
+    polling, to take over the tasks of workers that were killed.
+
+    Parameters
+    ----------
+    queue_path: folder of the JobQueue
+    use_cache: reuse and store cached results
+    stop_path: the worker stops after its current task once this file exists
+    on_task_done: called with every finished (img_path, fields) task
+    poll_interval: seconds between looking for abandoned tasks
+
+    Returns
+    -------
+    analyzed: number of tasks this worker finished
+    """
+    queue = JobQueue(queue_path)
+    analyzed = 0
+    while stop_path is None or not os.path.exists(stop_path):
+        task_id = queue.claim()
+        if task_id is None:
+            if queue.all_finished():
+                break
+            time.sleep(poll_interval)
+            continue
+
+        img_path, fields = queue.tasks[task_id]
+        try:
+            with queue.heartbeat(task_id):
+                run_task(
+                    img_path,
+                    queue.program_start_time,
+                    queue.params,
+                    fields,
+                    use_cache=use_cache,
+                )
+        except Exception:
+            queue.fail(task_id, traceback.format_exc())
+        except BaseException:
+            # Interrupted, the task is left for the next worker right away
+            queue.release(task_id)
+            raise
+        else:
+            queue.complete(task_id)
+        analyzed += 1
+        if on_task_done is not None:
+            on_task_done(img_path, fields)
+    return analyzed
@@ -0,0 +1,158 @@
+import os
+import zipfile
+
+import numpy as np
+from skimage import io
+
+from nuclei_table import nearest_indices
+
+MASK_FORMATS = ("PNG", "Labels")
+LABELS_SUFFIX = "_labels.npz"
+MASK_SUFFIXES = ("_scenescent_mask.png", "_quiescent_mask.png")
+
+
+def label_dtype(num_labels):
+    """Smallest unsigned integer type holding every label id."""
+    return np.min_scalar_type(num_labels)
+
+
+def write_label_image(path, label_blocks, label_shape, num_labels, **arrays):
+    """Writes a compressed .npz file with the label image, given as row blocks
+    from top to bottom, and the other arrays, without holding the whole label
+    image in memory.
+
+    Parameters
+    ----------
+    path: output file, ending in LABELS_SUFFIX
+    label_blocks: consecutive row blocks of the label image
+    label_shape: (height, width) of the label image
+    num_labels: highest label id
+    arrays: further arrays of the file, by name
+    """
+    dtype = label_dtype(num_labels)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, array in arrays.items():
+            with archive.open(name + ".npy", "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asarray(array), allow_pickle=False)
+
+        with archive.open("labels.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array_header_2_0(
+                f,
+                {
+                    "descr": np.lib.format.dtype_to_descr(dtype),
+                    "fortran_order": False,
+                    "shape": tuple(label_shape),
+                },
+            )
+            for block in label_blocks:
+                f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+    return path
+
+
+def save_labels(path, labels, label_ids, is_scenescent, full_shape, refined=None):
+    """Saves the masks of one field as its label image at the analysis
+    resolution and the classification of every nucleus.
+
+    Parameters
+    ----------
+    path: output file, ending in LABELS_SUFFIX
+    labels: label image of the NucleiTable the field was classified with
+    label_ids: label id of every nucleus of the NucleiTable
+    is_scenescent: boolean array, True for the senescent nuclei
+    full_shape: (height, width) of the original image
+    refined: RefinedNuclei of the field, whose full resolution nuclei masks are
+        then saved as well
+    """
+    arrays = {
+        "label_ids": label_ids,
+        "is_scenescent": is_scenescent,
+        "full_shape": np.array(full_shape),
+    }
+    if refined is not None:
+        arrays["windows"] = np.array(
+            [
+                (rows.start, rows.stop, cols.start, cols.stop)
+                for rows, cols in refined.windows
+            ],
+            dtype=np.int64,
+        ).reshape(-1, 4)
+        # One bit per pixel of every window, in the order of the windows
+        arrays["refined_masks"] = np.packbits(
+            np.concatenate(
+                [mask.ravel() for mask in refined.masks] + [np.zeros(0, bool)]
+            )
+        )
+    return write_label_image(
+        path, [labels], labels.shape, int(labels.max(initial=0)), **arrays
+    )
+
+
+class LabelImage:
+    """Masks of one analyzed field saved with save_labels, expanded to full
+    resolution on demand.
+
+    The senescent and quiescent masks are the upsampled lookups of the label
+    image, or the union of the full resolution nuclei masks of refined fields,
+    so they equal the mask PNGs of the PNG mask format pixel for pixel.
+
+    Parameters
+    ----------
+    path: .npz file written by save_labels
+    """
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.labels = data["labels"]
+            self.label_ids = data["label_ids"]
+            self.is_scenescent = data["is_scenescent"]
+            self.full_shape = tuple(int(size) for size in data["full_shape"])
+            self.windows = data["windows"] if "windows" in data else None
+            refined_masks = data["refined_masks"] if "refined_masks" in data else None
+
+        self.refined_masks = None
+        if self.windows is not None:
+            sizes = (self.windows[:, 1] - self.windows[:, 0]) * (
+                self.windows[:, 3] - self.windows[:, 2]
+            )
+            bits = np.unpackbits(refined_masks, count=int(sizes.sum())).astype(bool)
+            self.refined_masks = [
+                bits[start : start + size].reshape(r1 - r0, c1 - c0)
+                for start, size, (r0, r1, c0, c1) in zip(
+                    np.cumsum(sizes) - sizes, sizes, self.windows
+                )
+            ]
+
+    def lookup_table(self, selection):
+        """Boolean lookup table from label id to membership of the selected
+        nuclei."""
+        lut = np.zeros(int(self.labels.max(initial=0)) + 1, dtype=bool)
+        lut[self.label_ids[selection]] = True
+        return lut
+
+    def mask(self, selection):
+        """Full resolution boolean mask of the selected nuclei."""
+        if self.refined_masks is None:
+            rows = nearest_indices(self.labels.shape[0], self.full_shape[0])
+            cols = nearest_indices(self.labels.shape[1], self.full_shape[1])
+            return self.lookup_table(selection)[self.labels][np.ix_(rows, cols)]
+
+        mask = np.zeros(self.full_shape, dtype=bool)
+        for (r0, r1, c0, c1), nucleus_mask, selected in zip(
+            self.windows, self.refined_masks, selection
+        ):
+            if selected:
+                mask[r0:r1, c0:c1] |= nucleus_mask
+        return mask
+
+    def masks(self):
+        """Full resolution senescent and quiescent masks."""
+        return self.mask(self.is_scenescent), self.mask(~self.is_scenescent)
+
+    def save_pngs(self, save_path, img_name):
+        """Writes the senescent and quiescent mask PNGs of the PNG mask
+        format, returns their paths."""
+        paths = []
+        for suffix, mask in zip(MASK_SUFFIXES, self.masks()):
+            paths.append(os.path.join(save_path, img_name + suffix))
+            io.imsave(paths[-1], np.uint8(mask) * 255, check_contrast=False)
+        return paths
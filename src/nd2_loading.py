@@ -0,0 +1,170 @@
+import struct
+
+import numpy as np
+from skimage.transform import downscale_local_mean
+
+CHUNK_HEADER = 0xABECEDA
+# Every image group starts with an 8 byte acquisition timestamp
+TIMESTAMP_BYTES = 8
+
+
+class ND2File:
+    """Channel-selective access to the image planes of an .nd2 file.
+
+    The metadata is parsed once when the file is opened. Planes are returned as
+    read-only memory-mapped views into the file, so only the pixels that are
+    actually used are read from disk and nothing is copied into memory up front.
+    Files whose image data does not have the expected layout (e.g. stitched
+    files with padded rows) fall back to reading through nd2reader.
+
+    Parameters
+    ----------
+    image_path: path to the .nd2 file
+    """
+
+    def __init__(self, image_path):
+        # nd2reader imports matplotlib through pims, so it is only imported
+        # once an image is opened
+        from nd2reader import ND2Reader
+
+        self.image_path = image_path
+        self._reader = ND2Reader(image_path)
+        self.metadata = self._reader.metadata
+        self.height = self.metadata["height"]
+        self.width = self.metadata["width"]
+        self._group_layouts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._reader.close()
+
+    @property
+    def fields(self):
+        """(timepoint, position) of every field in the file, in acquisition order."""
+        sizes = self._reader.sizes
+        return [
+            (timepoint, position)
+            for timepoint in range(sizes.get("t", 1))
+            for position in range(sizes.get("v", 1))
+        ]
+
+    def _group_layout(self, image_group):
+        """File offset and number of interleaved channels of an image group, or
+        None if the data can not be memory-mapped."""
+        if image_group not in self._group_layouts:
+            # nd2reader does not expose the chunk locations publicly
+            location = self._reader.parser._label_map.get_image_data_location(
+                image_group
+            )
+            fh = self._reader._fh
+            fh.seek(location)
+            header, relative_offset, data_length = struct.unpack("IIQ", fh.read(16))
+            if header != CHUNK_HEADER:
+                raise ValueError("The ND2 file seems to be corrupted.")
+
+            num_values = (data_length - TIMESTAMP_BYTES) // 2
+            plane_size = self.height * self.width
+            num_channels = num_values // plane_size
+            if num_channels > 0 and num_values == num_channels * plane_size:
+                offset = location + 16 + relative_offset + TIMESTAMP_BYTES
+                self._group_layouts[image_group] = (offset, num_channels)
+            else:
+                self._group_layouts[image_group] = None
+
+        return self._group_layouts[image_group]
+
+    def plane(self, channel, field=(0, 0)):
+        """Returns one channel of a (timepoint, position) field as a
+        (height, width) uint16 array."""
+        timepoint, position = field
+        image_group = self._reader.parser._calculate_image_group_number(
+            timepoint, position, 0
+        )
+        layout = self._group_layout(image_group)
+        if layout is None:
+            return np.asarray(
+                self._reader.get_frame_2D(c=channel, t=timepoint, v=position),
+                dtype=np.uint16,
+            )
+
+        offset, num_channels = layout
+        interleaved = np.memmap(
+            self.image_path,
+            dtype="<u2",
+            mode="r",
+            offset=offset,
+            shape=(self.height, self.width, num_channels),
+        )
+        return interleaved[:, :, channel]
+
+    def downscaled_planes(
+        self, channels, downscale_factor, field=(0, 0), dtype=np.float64
+    ):
+        """Reads the requested channels of a field and downscales them one at a
+        time, so at most one full resolution plane is held in memory.
+
+        Parameters
+        ----------
+        channels: channel numbers to read, in the order they are returned
+        downscale_factor: block size of the local mean downscaling
+        field: (timepoint, position) to read
+        dtype: float type of the downscaled images, see downscale
+
+        Returns
+        -------
+        downscaled: list with one downscaled float image per channel
+        """
+        return [
+            downscale(self.plane(channel, field), downscale_factor, dtype)
+            for channel in channels
+        ]
+
+    def downscaled_window(
+        self, channel, downscale_factor, window, field=(0, 0), dtype=np.float64
+    ):
+        """Reads and downscales only a window of one channel.
+
+        window is a (rows, cols) pair of slices in downscaled coordinates. The
+        result equals the same window of downscaled_planes, as the window starts
+        on whole downscaling blocks.
+        """
+        rows, cols = window
+        full_window = self.plane(channel, field)[
+            rows.start * downscale_factor : rows.stop * downscale_factor,
+            cols.start * downscale_factor : cols.stop * downscale_factor,
+        ]
+        return downscale(full_window, downscale_factor, dtype)
+
+
+def block_mean(plane, factor, dtype=np.float32):
+    """Mean of every factor x factor block of a uint16 plane, as
+    downscale_local_mean with zero padding, but summed in uint32 and returned
+    as dtype without float64 intermediates."""
+    height, width = plane.shape
+    pad_rows, pad_cols = -height % factor, -width % factor
+    if pad_rows or pad_cols:
+        plane = np.pad(plane, ((0, pad_rows), (0, pad_cols)))
+    height, width = plane.shape
+    sums = plane.reshape(height // factor, factor, width // factor, factor).sum(
+        axis=(1, 3), dtype=np.uint32
+    )
+    return sums.astype(dtype) / dtype(factor * factor)
+
+
+def downscale(plane, downscale_factor, dtype=np.float64):
+    """Local mean downscaling of a uint16 plane. float64 uses scikit-image's
+    downscale_local_mean, any other float type block_mean."""
+    if np.dtype(dtype) == np.float64:
+        return downscale_local_mean(plane, factors=(downscale_factor, downscale_factor))
+    return block_mean(plane, downscale_factor, np.dtype(dtype).type)
+
+
+def list_fields(image_path):
+    """(timepoint, position) of every field in an .nd2 file."""
+    with ND2File(image_path) as nd2_file:
+        return nd2_file.fields
@@ -0,0 +1,160 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from nuclei_table import upscale_coordinates, upscale_weights
+
+FEATURE_FORMATS = ("Off", "Parquet", "Feather")
+FEATURE_EXTENSIONS = {"Parquet": ".parquet", "Feather": ".feather"}
+FEATURES_SUFFIX = "_nuclei_features"
+RUN_FEATURES_NAME = "Senolysis_nuclei_features"
+
+# NucleiTable channel names and the column prefix they are exported under
+CHANNEL_COLUMNS = {
+    "scenescent": "senescent channel",
+    "quiescent": "quiescent channel",
+    "nuclei": "nuclei channel",
+}
+
+
+def feature_table(nuclei, is_scenescent, channels, full_shape, img_path, field=None):
+    """Per-nucleus features of one analyzed field, one row per nucleus.
+
+    All features are computed with label reductions over the label image of the
+    NucleiTable, so the cost does not depend on the number of nuclei. Areas,
+    centroids and integrated intensities are given at the original image
+    resolution, mean intensities are the values used for classification.
+
+    Parameters
+    ----------
+    nuclei: size filtered NucleiTable the field was classified with
+    is_scenescent: boolean array, True for the senescent rows of nuclei
+    channels: dict of NucleiTable channel name to downscaled intensity image
+    full_shape: (height, width) of the original image
+    img_path: path to the analyzed image
+    field: (timepoint, position) of multi-field files, None otherwise
+
+    Returns
+    -------
+    features: pandas dataframe
+    """
+    small_shape = nuclei.labels.shape
+    weights = upscale_weights(small_shape, full_shape)
+    centroids = nuclei.centroids(
+        weights,
+        row_coords=upscale_coordinates(small_shape[0], full_shape[0]),
+        col_coords=upscale_coordinates(small_shape[1], full_shape[1]),
+    )
+
+    means = {}
+    integrated_intensities = {}
+    for name, img in channels.items():
+        if name not in nuclei.means:
+            nuclei.add_channel(name, img)
+        means[name] = nuclei.means[name]
+        # Downscaled pixels hold the mean of the full resolution pixels they cover
+        integrated_intensities[name] = nuclei.weighted_areas(weights * img)
+
+    return features_dataframe(
+        nuclei.label_ids,
+        centroids,
+        nuclei.weighted_areas(weights),
+        means,
+        integrated_intensities,
+        is_scenescent,
+        img_path,
+        field=field,
+    )
+
+
+def features_dataframe(
+    label_ids,
+    centroids,
+    areas,
+    means,
+    integrated_intensities,
+    is_scenescent,
+    img_path,
+    field=None,
+):
+    """Assembles the per-nucleus feature columns into the exported table. means
+    and integrated_intensities map NucleiTable channel names to one value per
+    nucleus."""
+    features = pd.DataFrame(
+        {"Image": os.path.basename(img_path)}, index=range(len(label_ids))
+    )
+    if field is not None:
+        features["Timepoint"], features["Position"] = field
+    features["Nucleus"] = label_ids
+    features["Centroid row"] = centroids[:, 0]
+    features["Centroid column"] = centroids[:, 1]
+    features["Area (pixels^2)"] = areas
+
+    for name in means:
+        column = CHANNEL_COLUMNS.get(name, name)
+        features[f"{column} mean intensity"] = means[name]
+        features[f"{column} integrated intensity"] = integrated_intensities[name]
+
+    features["Classification"] = pd.Categorical.from_codes(
+        np.where(is_scenescent, 0, 1), categories=["senescent", "quiescent"]
+    )
+    return features
+
+
+def save_features(features, path, export_format):
+    """Writes a feature table to path + the extension of export_format and
+    returns the written path."""
+    path += FEATURE_EXTENSIONS[export_format]
+    if export_format == "Parquet":
+        features.to_parquet(path, index=False)
+    else:
+        features.reset_index(drop=True).to_feather(path)
+    return path
+
+
+def read_features(path):
+    if path.endswith(FEATURE_EXTENSIONS["Parquet"]):
+        return pd.read_parquet(path)
+    return pd.read_feather(path)
+
+
+def merge_features(save_path, export_format, image_order=None):
+    """Combines the per-image feature tables in save_path into one table for the
+    whole run, written next to the measures workbook.
+
+    Returns
+    -------
+    merged: the combined feature table, None if there are no feature tables
+    """
+    extension = FEATURE_EXTENSIONS[export_format]
+    run_path = os.path.join(save_path, RUN_FEATURES_NAME + extension)
+    paths = [
+        path
+        for path in sorted(
+            glob.glob(os.path.join(save_path, f"*{FEATURES_SUFFIX}{extension}"))
+        )
+        if path != run_path
+    ]
+    if not paths:
+        return None
+
+    merged = pd.concat([read_features(path) for path in paths], ignore_index=True)
+    # Single and multi-field images may be combined, keep the field columns first
+    field_columns = [c for c in ("Timepoint", "Position") if c in merged]
+    merged = merged[
+        ["Image"]
+        + field_columns
+        + [c for c in merged if c not in ["Image"] + field_columns]
+    ]
+    if image_order is not None:
+        order = {name: i for i, name in enumerate(image_order)}
+        merged = merged.sort_values(
+            ["Image"] + field_columns + ["Nucleus"],
+            key=lambda column: column.map(order) if column.name == "Image" else column,
+            kind="stable",
+        ).reset_index(drop=True)
+
+    save_features(merged, os.path.join(save_path, RUN_FEATURES_NAME), export_format)
+    return merged
@@ -0,0 +1,176 @@
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.measure import label
+
+
+def label_means(labelled, num_labels, img):
+    """Mean intensity of img within every label of a labelled image.
+
+    Parameters
+    ----------
+    labelled: integer label image, 0 is background
+    num_labels: highest label id in labelled
+    img: intensity image with the same shape as labelled
+
+    Returns
+    -------
+    means: array of length num_labels + 1, indexed by label id. Entry 0 holds the
+        background mean.
+    """
+    flat_labels = labelled.ravel()
+    areas = np.bincount(flat_labels, minlength=num_labels + 1)
+    sums = np.bincount(flat_labels, weights=img.ravel(), minlength=num_labels + 1)
+    return sums / np.maximum(areas, 1)
+
+
+def nearest_indices(small_size, full_size):
+    """Source index of every output pixel when upsampling one axis from small_size
+    to full_size with nearest-neighbour interpolation (as skimage resize does for
+    boolean images)."""
+    scale = small_size / full_size
+    indices = np.floor((np.arange(full_size) + 0.5) * scale).astype(np.intp)
+    return np.minimum(indices, small_size - 1)
+
+
+def upscale_mask(mask, output_shape):
+    """Nearest-neighbour upsampling of a 2D mask, matching
+    skimage.transform.resize(mask, output_shape) for boolean masks."""
+    rows = nearest_indices(mask.shape[0], output_shape[0])
+    cols = nearest_indices(mask.shape[1], output_shape[1])
+    return mask[np.ix_(rows, cols)]
+
+
+def upscale_coordinates(small_size, full_size):
+    """Mean full resolution index of the pixels each downscaled index covers after
+    upscale_mask, e.g. to report centroids in original image coordinates."""
+    indices = nearest_indices(small_size, full_size)
+    counts = np.bincount(indices, minlength=small_size)
+    sums = np.bincount(indices, weights=np.arange(full_size), minlength=small_size)
+    return sums / np.maximum(counts, 1)
+
+
+def upscale_weights(small_shape, output_shape):
+    """Number of full resolution pixels each downscaled pixel covers after
+    upscale_mask. Equal to downscale_factor**2 away from padded image edges."""
+    row_counts = np.bincount(
+        nearest_indices(small_shape[0], output_shape[0]), minlength=small_shape[0]
+    )
+    col_counts = np.bincount(
+        nearest_indices(small_shape[1], output_shape[1]), minlength=small_shape[1]
+    )
+    return np.outer(row_counts, col_counts)
+
+
+def small_fragments(mask, min_area):
+    """Pixels of the 4-connected components of mask smaller than min_area, the
+    pixels remove_small_objects(mask, min_size=min_area) removes with
+    scikit-image 0.19. Diagonally touching fragments are measured separately,
+    although nuclei are labelled 8-connected."""
+    fragments = label(mask, connectivity=1)
+    is_small = np.bincount(fragments.ravel()) < min_area
+    is_small[0] = False
+    return is_small[fragments]
+
+
+class NucleiTable:
+    """Per-image table of nuclei built from a single labelling of the nuclei mask.
+
+    Every per-nucleus measure is stored as an array with one row per nucleus, and
+    label_ids maps each row back to its id in the label image. Filtering only drops
+    rows, so size filtering, classification, counting and area statistics all read
+    from the same labelling.
+
+    Fragments smaller than min_area are removed from the mask before the
+    nuclei are labelled (see small_fragments), so the smallest nuclei that
+    remain are filtered on their 8-connected areas as before.
+
+    Parameters
+    ----------
+    mask: boolean nuclei mask (usually at the downscaled analysis resolution)
+    min_area: smallest fragment kept, in pixels of mask
+    """
+
+    def __init__(self, mask, min_area=0):
+        self.labels = label(mask)
+        # Objects of the mask before small fragments are removed, see
+        # discard_otsu_noise
+        self.num_objects = int(self.labels.max())
+        if min_area > 1:
+            small = small_fragments(mask, min_area)
+            if small.any():
+                self.labels = label(mask & ~small)
+        self.num_labels = int(self.labels.max())
+        self.label_ids = np.arange(1, self.num_labels + 1)
+        self.areas = np.bincount(self.labels.ravel(), minlength=self.num_labels + 1)[1:]
+
+        # Bounding boxes as (min_row, min_col, max_row, max_col)
+        self.bboxes = np.array(
+            [
+                (s[0].start, s[1].start, s[0].stop, s[1].stop)
+                for s in ndi.find_objects(self.labels)
+            ],
+            dtype=np.intp,
+        ).reshape(-1, 4)
+
+        self.means = {}
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def select(self, keep):
+        """Keep only the rows where keep is True."""
+        self.label_ids = self.label_ids[keep]
+        self.areas = self.areas[keep]
+        self.bboxes = self.bboxes[keep]
+        self.means = {name: values[keep] for name, values in self.means.items()}
+        return self
+
+    def filter_by_area(self, min_area=0, max_area=np.inf):
+        """Drop nuclei with an area outside [min_area, max_area]."""
+        return self.select((self.areas >= min_area) & (self.areas <= max_area))
+
+    def add_channel(self, name, img):
+        """Store the mean intensity of img within every nucleus under name."""
+        means = label_means(self.labels, self.num_labels, img)
+        self.means[name] = means[self.label_ids]
+        return self.means[name]
+
+    def lookup_table(self, selection=None):
+        """Boolean lookup table from label id to membership of the selected rows."""
+        lut = np.zeros(self.num_labels + 1, dtype=bool)
+        if selection is None:
+            lut[self.label_ids] = True
+        else:
+            lut[self.label_ids[selection]] = True
+        return lut
+
+    def mask(self, selection=None):
+        """Boolean mask of the selected rows (all rows if selection is None)."""
+        return self.lookup_table(selection)[self.labels]
+
+    def weighted_areas(self, weights):
+        """Per-nucleus sum of weights, e.g. full resolution areas from
+        upscale_weights."""
+        sums = np.bincount(
+            self.labels.ravel(),
+            weights=np.broadcast_to(weights, self.labels.shape).ravel(),
+            minlength=self.num_labels + 1,
+        )
+        return sums[self.label_ids]
+
+    def centroids(self, weights=1, row_coords=None, col_coords=None):
+        """Per-nucleus weighted centroid as an array of (row, col).
+
+        row_coords and col_coords give the coordinate of every row and column of
+        the label image (default: their indices), e.g. from upscale_coordinates
+        together with upscale_weights for full resolution centroids.
+        """
+        num_rows, num_cols = self.labels.shape
+        row_coords = np.arange(num_rows) if row_coords is None else row_coords
+        col_coords = np.arange(num_cols) if col_coords is None else col_coords
+        weights = np.broadcast_to(weights, self.labels.shape)
+
+        total = self.weighted_areas(weights)
+        row_sums = self.weighted_areas(weights * row_coords[:, np.newaxis])
+        col_sums = self.weighted_areas(weights * col_coords[np.newaxis, :])
+        return np.column_stack([row_sums, col_sums]) / total[:, np.newaxis]
@@ -0,0 +1,109 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Figure output options shown in the GUI. Matplotlib is the original (slow)
+# figure, Full and Thumbnail use the NumPy renderer below, Off saves no figure.
+FIGURE_MODES = ("Matplotlib", "Full", "Thumbnail", "Off")
+
+SCENESCENT_COLOR = (255, 255, 255)
+QUIESCENT_COLOR = (0, 0, 255)
+# Longest side of "Thumbnail" figures
+THUMBNAIL_SIZE = 512
+
+
+def thick_boundaries(mask):
+    """Boundary pixels on both sides of the mask edge, equivalent to
+    skimage.segmentation.find_boundaries(mask, mode="thick")."""
+    padded = np.pad(mask, 1, mode="edge")
+    center = padded[1:-1, 1:-1]
+    boundaries = np.zeros(mask.shape, dtype=bool)
+    for shifted in (
+        padded[:-2, 1:-1],
+        padded[2:, 1:-1],
+        padded[1:-1, :-2],
+        padded[1:-1, 2:],
+    ):
+        boundaries |= shifted != center
+    return boundaries
+
+
+def render_overlay(RGB, scenescent, quiescent, max_size=None):
+    """Draws senescent and quiescent nuclei outlines into a uint8 RGB buffer.
+
+    Parameters
+    ----------
+    RGB: float image in the range 0 - 1 with shape (rows, cols, 3)
+    scenescent, quiescent: boolean masks with shape (rows, cols)
+    max_size: if given, the image is subsampled so its longest side is at most
+        max_size pixels before the outlines are drawn
+
+    Returns
+    -------
+    rendered: uint8 RGB image
+    """
+    if max_size is not None and max(RGB.shape[:2]) > max_size:
+        step = int(np.ceil(max(RGB.shape[:2]) / max_size))
+        RGB = RGB[::step, ::step]
+        scenescent = scenescent[::step, ::step]
+        quiescent = quiescent[::step, ::step]
+
+    rendered = np.empty(RGB.shape, dtype=np.uint8)
+    np.multiply(np.clip(RGB, 0, 1), 255, out=rendered, casting="unsafe")
+
+    rendered[thick_boundaries(scenescent)] = SCENESCENT_COLOR
+    rendered[thick_boundaries(quiescent)] = QUIESCENT_COLOR
+
+    return rendered
+
+
+def stamp_legend(rendered, scenescent_threshold):
+    """Adds a compact legend with the senescent threshold above the image. Legend
+    entries wrap onto a new line when the image is too narrow."""
+    font = ImageFont.load_default()
+    line_height = 14
+    swatch = line_height - 6
+    entries = (
+        ("Senescent", SCENESCENT_COLOR),
+        ("Quiescent", QUIESCENT_COLOR),
+        (f"Scenescent threshold: {scenescent_threshold}", None),
+    )
+
+    # Lay out entries left to right, wrapping at the image width
+    measure = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    positions = []
+    x, y = 3, 0
+    for text, color in entries:
+        width = int(measure.textlength(text, font=font))
+        width += swatch + 3 if color is not None else 0
+        if x > 3 and x + width > rendered.shape[1]:
+            x, y = 3, y + line_height
+        positions.append((x, y))
+        x += width + 10
+
+    band_height = y + line_height
+    image = Image.new(
+        "RGB", (rendered.shape[1], rendered.shape[0] + band_height), (0, 0, 0)
+    )
+    image.paste(Image.fromarray(rendered), (0, band_height))
+
+    draw = ImageDraw.Draw(image)
+    for (text, color), (x, y) in zip(entries, positions):
+        if color is not None:
+            draw.rectangle([x, y + 3, x + swatch, y + 3 + swatch], fill=color)
+            x += swatch + 3
+        draw.text((x, y + 1), text, fill=(255, 255, 255), font=font)
+
+    return image
+
+
+def save_overlay(
+    RGB, scenescent, quiescent, save_path, scenescent_threshold, mode="Full"
+):
+    """Renders and saves the segmentation overlay without matplotlib.
+
+    mode is "Full" (analysis resolution) or "Thumbnail" (longest side 512 px).
+    """
+    max_size = THUMBNAIL_SIZE if mode == "Thumbnail" else None
+    rendered = render_overlay(RGB, scenescent, quiescent, max_size=max_size)
+    stamp_legend(rendered, scenescent_threshold).save(save_path, compress_level=1)
+    return
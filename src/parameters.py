@@ -0,0 +1,164 @@
+from dataclasses import dataclass, fields
+from importlib.util import find_spec
+import os
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+
+from label_outputs import MASK_FORMATS
+from nuclei_features import FEATURE_FORMATS
+from overlay import FIGURE_MODES
+
+
+def parse_nuclei_threshold(value):
+    """Interprets the nuclei threshold entry as Otsu or a global uint16 threshold.
+
+    Returns
+    -------
+    nuclei_threshold: "Otsu" or the global threshold as a float
+    thresholding_method: "Otsu" or "Global"
+    """
+    if str(value).strip().lower() == "otsu":
+        return "Otsu", "Otsu"
+    try:
+        return float(value), "Global"
+    except (TypeError, ValueError):
+        raise ValueError(
+            f"You entered {value} for the nuclei threshold. This is not a valid nuclei threshold. The value should be Otsu for automatic segmentation of nuclei or a manual global threshold (0-65535)"
+        )
+
+
+def parse_num_jobs(value):
+    """Interprets the number of jobs entry as "auto" or a number of images.
+
+    Returns
+    -------
+    num_jobs: "auto" or the number of images analyzed in parallel
+    """
+    if str(value).strip().lower() == "auto":
+        return "auto"
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            f"You entered {value} for the number of jobs. This should be the number of images to run in parallel, or auto to choose it from the image sizes and available memory"
+        )
+
+
+@dataclass(frozen=True)
+class AnalysisParameters:
+    """User parameters of one analysis run.
+
+    Small and picklable, so it is what gets sent to the parallel workers instead
+    of the GUI window. Field names match the attributes set by GUI.quit.
+    """
+
+    directory: str = None
+    scenescent_threshold: int = 300
+    nuclei_threshold: object = "Otsu"
+    thresholding_method: str = "Otsu"
+    num_jobs: object = 1
+    scenescent_channel: int = 0
+    quiescent_channel: int = 1
+    nuclei_chanel: int = 2
+    min_nuclei_size: int = 100
+    max_nuclei_size: int = 10000
+    remove_well_ring: int = 1
+    reuse_well_mask: int = 0
+    figure_mode: str = FIGURE_MODES[0]
+    feature_export: str = FEATURE_FORMATS[0]
+    mask_format: str = MASK_FORMATS[0]
+    memory_budget: int = 0
+    downscale_factor: int = 4
+    refine_nuclei: int = 0
+    profile: int = 0
+    pipelined: int = 0
+    compact_dtypes: int = 0
+    qc_export: int = 0
+
+    @property
+    def intensity_dtype(self):
+        """Float type of the downscaled intensities and everything computed
+        from them: float32 in compact mode, float64 otherwise."""
+        return "float32" if self.compact_dtypes == 1 else "float64"
+
+    @classmethod
+    def from_gui(cls, gui):
+        """Copies the values entered in a closed GUI window."""
+        return cls(
+            **{
+                field.name: getattr(gui, field.name)
+                for field in fields(cls)
+                if hasattr(gui, field.name)
+            }
+        )
+
+    @classmethod
+    def from_toml(cls, config_path, directory=None):
+        """Reads parameters from a TOML file with the same keys as the fields.
+
+        The nuclei threshold can be given as "Otsu" or a number, the thresholding
+        method is derived from it. directory overrides the value in the file.
+        """
+        with open(config_path, "rb") as f:
+            config = tomllib.load(f)
+
+        known = {field.name for field in fields(cls)}
+        unknown = set(config) - known
+        if unknown:
+            raise ValueError(
+                f"Unknown parameter(s) in {config_path}: {', '.join(sorted(unknown))}"
+            )
+
+        if "nuclei_threshold" in config:
+            (
+                config["nuclei_threshold"],
+                config["thresholding_method"],
+            ) = parse_nuclei_threshold(config["nuclei_threshold"])
+        if "num_jobs" in config:
+            config["num_jobs"] = parse_num_jobs(config["num_jobs"])
+        for option in (
+            "remove_well_ring",
+            "reuse_well_mask",
+            "refine_nuclei",
+            "profile",
+            "pipelined",
+            "compact_dtypes",
+            "qc_export",
+        ):
+            if option in config:
+                config[option] = int(config[option])
+        if directory is not None:
+            config["directory"] = directory
+
+        return cls(**config)
+
+    def validate(self):
+        assert self.directory, "No image directory selected"
+        assert (
+            self.max_nuclei_size > self.min_nuclei_size
+        ), "Maximum nuclei area must be larger than minimum nuclei area"
+        assert self.num_jobs == "auto" or (
+            self.num_jobs > 0 and self.num_jobs <= os.cpu_count()
+        ), f"Number of jobs shoulder be integer value be between 1 and {os.cpu_count()}, or auto"
+        assert (
+            self.figure_mode in FIGURE_MODES
+        ), f"Segmentation figure should be one of {', '.join(FIGURE_MODES)}"
+        assert (
+            isinstance(self.downscale_factor, int) and self.downscale_factor >= 1
+        ), "Downscale factor should be a whole number of at least 1"
+        assert (
+            self.memory_budget >= 0
+        ), "Memory budget should be a number of MB, or 0 for no limit"
+        assert (
+            self.feature_export in FEATURE_FORMATS
+        ), f"Nuclei feature export should be one of {', '.join(FEATURE_FORMATS)}"
+        assert (
+            self.feature_export == "Off" or find_spec("pyarrow") is not None
+        ), "Exporting nuclei features requires pyarrow (pip install pyarrow)"
+        assert (
+            self.mask_format in MASK_FORMATS
+        ), f"Mask output should be one of {', '.join(MASK_FORMATS)}"
+        return self
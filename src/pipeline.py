@@ -0,0 +1,370 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import os
+import time
+import traceback
+
+from incremental import ResultCache, RunManifest
+from nd2_loading import ND2File
+from preprocessing import field_preprocessor
+from profiling import profiler
+from senolysis_analysis import (
+    compute_field,
+    full_resolution_planes,
+    write_field,
+)
+from senolysis_functions import get_save_path
+from telemetry import task_stats, worker_stats
+from tiled_analysis import needs_tiling, tiled_field_analysis
+from worker_pool import worker_pool
+
+# Threads reading and downscaling fields, and writing their outputs
+READ_THREADS = 2
+WRITE_THREADS = 2
+
+
+class _Task:
+    # Progress of one (img_path, fields) task through the pipeline
+    def __init__(self, img_path, fields):
+        self.img_path = img_path
+        self.fields = fields
+        self.remaining = None
+        self.results = []
+        self.output_paths = []
+        # Telemetry of the task, see telemetry.task_stats
+        self.start = time.time()
+        self.stage_times = {}
+        self.worker = None
+        # Traceback of the first error of any of its fields
+        self.error = None
+
+    def add_times(self, stage_times):
+        for name, seconds in stage_times.items():
+            self.stage_times[name] = self.stage_times.get(name, 0.0) + seconds
+
+
+def _timed(function, *args):
+    # Runs a reader or writer stage with its wall time and that of its
+    # profiler stages measured, in the thread that runs it
+    start = time.perf_counter()
+    with profiler.timed() as stage_times:
+        result = function(*args)
+    stage_times[function.__name__] = time.perf_counter() - start
+    return result, stage_times
+
+
+@contextmanager
+def _profiled(stage, img_path, result_field, program_start_time, params):
+    # Records a stage of one field to the trace of its results folder, from
+    # the reader or writer thread or the worker that runs it
+    if params.profile == 1:
+        profiler.start(get_save_path(img_path, program_start_time))
+    try:
+        with profiler.stage(
+            stage, image=os.path.basename(img_path), field=result_field
+        ):
+            yield
+    finally:
+        profiler.stop()
+
+
+def read_field(img_path, field, result_field, program_start_time, params):
+    """Reader stage: reads and downscales the channels of one field.
+
+    Returns
+    -------
+    planes: downscaled senescent, quiescent and nuclei channel, or None if the
+        field is too large for the memory budget and is read tile by tile by
+        the compute stage instead
+    full_shape: (height, width) of the field
+    """
+    with _profiled("read_field", img_path, result_field, program_start_time, params):
+        with ND2File(img_path) as nd2_file:
+            full_shape = (nd2_file.height, nd2_file.width)
+            if needs_tiling(full_shape, params.memory_budget):
+                return None, full_shape
+            channels = (
+                params.scenescent_channel,
+                params.quiescent_channel,
+                params.nuclei_chanel,
+            )
+            preprocessor = field_preprocessor(
+                full_shape,
+                params.downscale_factor,
+                len(channels),
+                params.intensity_dtype,
+            )
+            # Copied out of the reader's buffers, the field waits for a worker
+            # while the next fields are read
+            planes = [
+                downscaled.copy()
+                for downscaled in preprocessor.downscale(
+                    (nd2_file.plane(channel, field) for channel in channels)
+                )
+            ]
+        return planes, full_shape
+
+
+def compute_field_task(
+    img_path, field, result_field, planes, full_shape, program_start_time, params
+):
+    """Compute stage, run in a worker process: analyzes one field read by
+    read_field.
+
+    Returns
+    -------
+    output: FieldOutput for the writer stage, or the (results_dataframe,
+        output_paths) of a tiled field, which writes its own outputs
+    stats: seconds per profiler stage of the field and the worker_stats of the
+        worker
+    """
+    with profiler.timed() as stage_times:
+        output = _compute_field(
+            img_path,
+            field,
+            result_field,
+            planes,
+            full_shape,
+            program_start_time,
+            params,
+        )
+    return output, {"stages": stage_times, **worker_stats()}
+
+
+def _compute_field(
+    img_path, field, result_field, planes, full_shape, program_start_time, params
+):
+    with _profiled("compute_field", img_path, result_field, program_start_time, params):
+        if planes is None:
+            with ND2File(img_path) as nd2_file:
+                return tiled_field_analysis(
+                    nd2_file,
+                    field,
+                    params.downscale_factor,
+                    img_path=img_path,
+                    program_start_time=program_start_time,
+                    params=params,
+                    result_field=result_field,
+                )
+
+        # The worker's buffers for the smoothing and figure of its fields
+        preprocessor = field_preprocessor(
+            full_shape,
+            params.downscale_factor,
+            len(planes),
+            params.intensity_dtype,
+        )
+        if params.refine_nuclei != 1:
+            return compute_field(
+                *planes,
+                full_shape,
+                params.downscale_factor,
+                img_path,
+                params,
+                field=result_field,
+                preprocessor=preprocessor,
+            )
+
+        # Full resolution windows are read from the worker's own memory map
+        with ND2File(img_path) as nd2_file:
+            channels = (
+                params.scenescent_channel,
+                params.quiescent_channel,
+                params.nuclei_chanel,
+            )
+            return compute_field(
+                *planes,
+                full_shape,
+                params.downscale_factor,
+                img_path,
+                params,
+                field=result_field,
+                full_planes=full_resolution_planes(nd2_file, channels, field),
+                preprocessor=preprocessor,
+            )
+
+
+def write_field_task(output, program_start_time, params):
+    """Writer stage: saves the outputs of one computed field."""
+    if isinstance(output, tuple):
+        return output
+    with _profiled(
+        "write_field_task", output.img_path, output.field, program_start_time, params
+    ):
+        return write_field(output, program_start_time, params)
+
+
+def run_pipelined(
+    tasks,
+    program_start_time,
+    params,
+    manifest_path=None,
+    use_cache=True,
+    max_in_flight=None,
+    on_task_done=None,
+):
+    """Analyzes (img_path, fields) tasks in three overlapping stages.
+
+    Fields are read and downscaled by a thread pool, analyzed by the
+    worker_pool of params.num_jobs processes and their outputs written by a
+    second thread pool, so reading the next fields and writing the previous
+    ones overlaps with the analysis. At most max_in_flight fields (default: two per
+    worker plus one per thread) are between reading and writing at any time,
+    which bounds the memory used for fields waiting on a slower stage. Cached
+    tasks are restored instead of analyzed, and completed tasks are recorded
+    in the run manifest, as with run_task. With a run manifest, a task with an
+    error in any stage of any of its fields is recorded as failed instead and
+    the run goes on.
+
+    Parameters
+    ----------
+    tasks: list of (img_path, fields), fields None for all fields of the image
+    program_start_time: name of the run
+    params: AnalysisParameters of the run
+    manifest_path: run manifest completed tasks are recorded in
+    use_cache: reuse and store cached results
+    max_in_flight: most fields read but not yet written
+    on_task_done: called with every finished (img_path, fields) task, failed
+        or not
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * params.num_jobs + READ_THREADS + WRITE_THREADS
+
+    def finish(task):
+        if task.error is not None:
+            RunManifest(manifest_path).mark_failed(
+                task.img_path,
+                task.fields,
+                task.error,
+                task_stats(task.start, task.stage_times, worker=task.worker),
+            )
+        else:
+            cached = task.remaining is None
+            if use_cache and not cached:
+                ResultCache(task.img_path, params, task.fields).store(
+                    task.results, task.output_paths
+                )
+            if manifest_path is not None:
+                RunManifest(manifest_path).mark_done(
+                    task.img_path,
+                    task.fields,
+                    task_stats(
+                        task.start, task.stage_times, cached=cached, worker=task.worker
+                    ),
+                )
+        if on_task_done is not None:
+            on_task_done(task.img_path, task.fields)
+
+    def field_done(task):
+        task.remaining -= 1
+        if task.remaining == 0:
+            finish(task)
+
+    def field_items():
+        # Fields to read, in task order. Cached tasks finish right away.
+        for img_path, fields in tasks:
+            task = _Task(img_path, fields)
+            save_path = get_save_path(img_path, program_start_time)
+            try:
+                if use_cache and ResultCache(img_path, params, fields).restore(
+                    save_path
+                ):
+                    finish(task)
+                    continue
+
+                with ND2File(img_path) as nd2_file:
+                    all_fields = nd2_file.fields
+            except Exception:
+                if manifest_path is None:
+                    raise
+                task.error = traceback.format_exc()
+                finish(task)
+                continue
+            task_fields = all_fields if fields is None else fields
+            task.remaining = len(task_fields)
+            for field in task_fields:
+                # Single field files keep the plain per-image output
+                result_field = field if len(all_fields) > 1 else None
+                yield task, field, result_field
+
+    items = field_items()
+    in_flight = {}
+    workers = worker_pool(params.num_jobs)
+    with ThreadPoolExecutor(READ_THREADS) as readers, ThreadPoolExecutor(
+        WRITE_THREADS
+    ) as writers:
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    item = next(items, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    task, field, result_field = item
+                    future = readers.submit(
+                        _timed,
+                        read_field,
+                        task.img_path,
+                        field,
+                        result_field,
+                        program_start_time,
+                        params,
+                    )
+                    in_flight[future] = ("read", item)
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, item = in_flight.pop(future)
+                    task, field, result_field = item
+                    try:
+                        result, stats = future.result()
+                    except Exception:
+                        if manifest_path is None:
+                            raise
+                        # The other fields of the task still run, so the
+                        # fields in flight are accounted for
+                        if task.error is None:
+                            task.error = traceback.format_exc()
+                        field_done(task)
+                        continue
+
+                    if stage == "compute":
+                        task.add_times(stats.pop("stages"))
+                        task.worker = stats
+                    else:
+                        task.add_times(stats)
+                    if task.error is not None:
+                        # Later stages of a failed task are skipped
+                        field_done(task)
+                    elif stage == "read":
+                        planes, full_shape = result
+                        next_future = workers.submit(
+                            compute_field_task,
+                            task.img_path,
+                            field,
+                            result_field,
+                            planes,
+                            full_shape,
+                            program_start_time,
+                            params,
+                        )
+                        in_flight[next_future] = ("compute", item)
+                    elif stage == "compute":
+                        next_future = writers.submit(
+                            _timed, write_field_task, result, program_start_time, params
+                        )
+                        in_flight[next_future] = ("write", item)
+                    else:
+                        results_dataframe, output_paths = result
+                        task.results.append(results_dataframe)
+                        task.output_paths.extend(output_paths)
+                        field_done(task)
+        except BaseException:
+            # Without a run manifest, errors of any stage end the run, as in
+            # the serial executor, and interrupts always do
+            for future in in_flight:
+                future.cancel()
+            raise
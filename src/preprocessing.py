@@ -0,0 +1,159 @@
+import threading
+
+import numpy as np
+from skimage.filters import gaussian
+
+from intensity_histogram import IntensityHistogram
+
+
+class FieldPreprocessor:
+    """Downscaling, channel histograms, nuclei smoothing and figure
+    normalization of the fields of one plate, into buffers that are allocated
+    for the first field and reused for every later field of the same size.
+
+    The full resolution planes (an iterable of planes, e.g. a generator
+    reading one plane at a time, or a channels x height x width array) are
+    downscaled one plane at a time by summing every block as integers, one pass
+    over the rows and one over the columns of the blocks, without a padded or
+    float copy of the full resolution plane. The block sums also give the
+    exact channel histograms without rounding the downscaled images back to
+    integers. The results equal nd2_loading.downscale,
+    IntensityHistogram.from_downscaled, skimage's gaussian and normalize_img
+    exactly.
+
+    The images returned are views of the buffers and are overwritten by the
+    next field, so they must be used (or copied) before the next field is
+    downscaled.
+
+    Parameters
+    ----------
+    full_shape: (height, width) of the fields
+    downscale_factor: block size of the local mean downscaling
+    num_channels: number of planes downscaled per field
+    dtype: float type of the downscaled images, see nd2_loading.downscale
+    """
+
+    def __init__(self, full_shape, downscale_factor, num_channels=3, dtype=np.float64):
+        self.full_shape = tuple(full_shape)
+        self.downscale_factor = downscale_factor
+        self.num_channels = num_channels
+        self.dtype = np.dtype(dtype)
+        self.small_shape = tuple(-(-size // downscale_factor) for size in full_shape)
+        self._buffers = {}
+        # Downscaled images of the current field and their block sums
+        self.planes = []
+        self._block_sums = []
+
+    def _buffer(self, name, shape, dtype):
+        # Allocated on first use, e.g. the figure buffer only with figures on
+        buffer = self._buffers.get(name)
+        if buffer is None:
+            buffer = self._buffers[name] = np.zeros(shape, dtype=dtype)
+        return buffer
+
+    def downscale(self, planes):
+        """Local mean downscaling of the full resolution planes of one field.
+        Every plane is reduced to its block sums and released before the next
+        plane is taken from planes, so a generator of planes keeps only one
+        full resolution plane in memory.
+
+        Returns
+        -------
+        downscaled: list with one downscaled image per plane
+        """
+        factor = self.downscale_factor
+        row_sums = self._buffer(
+            "row_sums", (self.small_shape[0], self.full_shape[1]), np.uint32
+        )
+        all_sums = self._buffer(
+            "block_sums", (self.num_channels, *self.small_shape), np.uint32
+        )
+        all_downscaled = self._buffer(
+            "downscaled", (self.num_channels, *self.small_shape), self.dtype
+        )
+        scale = self.dtype.type(factor * factor)
+
+        num_planes = 0
+        for plane in planes:
+            assert num_planes < self.num_channels, "One plane per channel expected"
+            sums = all_sums[num_planes]
+            downscaled = all_downscaled[num_planes]
+            num_planes += 1
+            # Rows and columns past the image edge are missing from the last
+            # blocks, as zero padding adds nothing to their sums
+            np.copyto(row_sums, plane[::factor])
+            for offset in range(1, factor):
+                rows = plane[offset::factor]
+                np.add(row_sums[: len(rows)], rows, out=row_sums[: len(rows)])
+            np.copyto(sums, row_sums[:, ::factor])
+            for offset in range(1, factor):
+                cols = row_sums[:, offset::factor]
+                width = cols.shape[1]
+                np.add(sums[:, :width], cols, out=sums[:, :width])
+            np.divide(sums, scale, out=downscaled, dtype=self.dtype)
+            # Released before the next plane is read
+            plane = rows = None
+        assert num_planes == self.num_channels, "One plane per channel expected"
+
+        self.planes = list(all_downscaled)
+        self._block_sums = list(all_sums)
+        return list(self.planes)
+
+    def histogram(self, img):
+        """IntensityHistogram of a downscaled image of the current field, from
+        its block sums. Other images are rounded back to their block sums, as
+        IntensityHistogram.from_downscaled does."""
+        for downscaled, sums in zip(self.planes, self._block_sums):
+            if img is downscaled:
+                return IntensityHistogram.from_block_sums(
+                    sums, self.downscale_factor**2, np.mean(img), self.dtype
+                )
+        return IntensityHistogram.from_downscaled(img, self.downscale_factor)
+
+    def smooth(self, img):
+        """Gaussian smoothing (sigma 1) of a downscaled image, as segment_nuclei
+        smooths the nuclei channel."""
+        smoothed = self._buffer("smoothed", self.small_shape, img.dtype)
+        return gaussian(img, 1, preserve_range=True, out=smoothed)
+
+    @staticmethod
+    def normalize(img, histogram, out, low_per=1, high_per=99):
+        """normalize_img of img with its histogram, written to out."""
+        # The steps of skimage's rescale_intensity to the range (0, 1)
+        low, high = (float(histogram.percentile(q)) for q in (low_per, high_per))
+        np.clip(img, low, high, out=out)
+        if low != high:
+            np.subtract(out, low, out=out)
+            np.divide(out, high - low, out=out)
+        else:
+            np.clip(out, 0.0, 1.0, out=out)
+        return out
+
+    def rgb(self, red, green, red_histogram, green_histogram, high_per=98):
+        """Segmentation figure image of the current field: the senescent and
+        quiescent channels normalized to their 1st and high_per percentiles as
+        its red and green planes, and a black blue plane."""
+        rgb = self._buffer("rgb", (*self.small_shape, 3), red.dtype)
+        self.normalize(red, red_histogram, rgb[..., 0], high_per=high_per)
+        self.normalize(green, green_histogram, rgb[..., 1], high_per=high_per)
+        return rgb
+
+
+_local = threading.local()
+
+
+def field_preprocessor(full_shape, downscale_factor, num_channels=3, dtype=np.float64):
+    """The FieldPreprocessor of this thread for fields of full_shape. It is
+    created on the first call and reused as long as the fields keep the same
+    size and options, e.g. for every image of a plate analyzed by a worker."""
+    preprocessor = getattr(_local, "preprocessor", None)
+    if preprocessor is None or (
+        preprocessor.full_shape,
+        preprocessor.downscale_factor,
+        preprocessor.num_channels,
+        preprocessor.dtype,
+    ) != (tuple(full_shape), downscale_factor, num_channels, np.dtype(dtype)):
+        preprocessor = _local.preprocessor = FieldPreprocessor(
+            full_shape, downscale_factor, num_channels, dtype
+        )
+    return preprocessor
@@ -0,0 +1,374 @@
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import socket
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+from results_sink import shard_name
+
+TRACE_DIRNAME = ".senolysis_trace"
+TRACE_NAME = "Senolysis_trace"
+
+# Returned by Profiler.stage while profiling and stage timing are off, so a
+# disabled stage costs a few attribute lookups and an empty with block
+_DISABLED = nullcontext()
+
+
+def _add_time(stage_times, name, wall):
+    stage_times[name] = stage_times.get(name, 0.0) + wall
+
+
+class _TimedStage:
+    # Wall time only, for the stage timings of Profiler.timed without profiling
+    def __init__(self, stage_times, name):
+        self.stage_times = stage_times
+        self.name = name
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _add_time(self.stage_times, self.name, time.perf_counter() - self.wall_start)
+        return False
+
+
+class _Stage:
+    def __init__(self, profiler, name, context):
+        self.profiler = profiler
+        self.name = name
+        self.context = context
+
+    def __enter__(self):
+        profiler = self.profiler
+        self.outer_context = profiler.context
+        profiler.context = {**profiler.context, **self.context}
+
+        # Peak memory of the enclosing stage so far, before the peak is reset
+        current, peak = tracemalloc.get_traced_memory()
+        if profiler._stack:
+            parent = profiler._stack[-1]
+            parent.peak = max(parent.peak, peak)
+        tracemalloc.reset_peak()
+        self.memory_start = current
+        self.peak = current
+        profiler._stack.append(self)
+
+        self.start = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        profiler = self.profiler
+        if profiler.stage_times is not None:
+            _add_time(profiler.stage_times, self.name, wall)
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        profiler._stack.pop()
+        if profiler._stack:
+            parent = profiler._stack[-1]
+            parent.peak = max(parent.peak, self.peak)
+
+        profiler.records.append(
+            {
+                "name": self.name,
+                **profiler.context,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "thread": threading.get_ident(),
+                "depth": len(profiler._stack),
+                "start": self.start,
+                "wall": wall,
+                "cpu": cpu,
+                "peak_mb": (self.peak - self.memory_start) / 2**20,
+                "error": None if exc_type is None else exc_type.__name__,
+            }
+        )
+        profiler.context = self.outer_context
+        return False
+
+
+class _ThreadState(threading.local):
+    # Profiling session and stage timings of one thread
+    def __init__(self):
+        self.enabled = False
+        self.trace_dir = None
+        self.records = []
+        self.context = {}
+        self.stack = []
+        self.stage_times = None
+
+
+class Profiler:
+    """Records the wall time, CPU time and peak memory of the analysis stages
+    of one process.
+
+    Stages are marked with ``with profiler.stage(name):``, which does nothing
+    until start is called. Between start and stop every stage appends a record,
+    with the keyword arguments of the enclosing stages (e.g. the image) as
+    context. Peak memory is the largest amount of memory allocated during the
+    stage above what was allocated at its start, as traced by tracemalloc; CPU
+    time includes all threads of the process. stop appends the records to this
+    process's trace shard in the results folder, merge_trace combines the
+    shards of all workers.
+
+    Every thread starts and stops its own recording, with its own stages and
+    context. The threads of a process share the memory traced by tracemalloc,
+    so the peak memory of stages overlapping those of other threads is only
+    approximate.
+
+    Independently of profiling, timed sums the wall time of the stages of a
+    task by stage name, e.g. for the run status of the telemetry module.
+    """
+
+    def __init__(self):
+        # Profiling sessions and stage timings are per thread, the reader and
+        # writer threads of the pipelined executor record their own stages
+        self._local = _ThreadState()
+        # tracemalloc and the trace shard are shared by the threads of the process
+        self._lock = threading.Lock()
+        self._sessions = 0
+        self._started_tracing = False
+
+    @property
+    def enabled(self):
+        return self._local.enabled
+
+    @property
+    def records(self):
+        return self._local.records
+
+    @property
+    def context(self):
+        return self._local.context
+
+    @context.setter
+    def context(self, context):
+        self._local.context = context
+
+    @property
+    def _stack(self):
+        return self._local.stack
+
+    @property
+    def stage_times(self):
+        return self._local.stage_times
+
+    @contextmanager
+    def timed(self):
+        """Sums the wall time of the stages of this thread by name while the
+        with block runs, with or without profiling. Yields the dict of seconds
+        per stage name."""
+        outer = self.stage_times
+        stage_times = self._local.stage_times = {}
+        try:
+            yield stage_times
+        finally:
+            self._local.stage_times = outer
+
+    def start(self, save_path):
+        """Starts recording the stages of this thread."""
+        local = self._local
+        if local.enabled:
+            return
+        local.enabled = True
+        local.trace_dir = os.path.join(save_path, TRACE_DIRNAME)
+        with self._lock:
+            self._sessions += 1
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+
+    def stop(self):
+        """Stops recording the stages of this thread and appends its records
+        to the trace shard of the process."""
+        local = self._local
+        if not local.enabled:
+            return
+        local.enabled = False
+        with self._lock:
+            self._sessions -= 1
+            if self._sessions == 0 and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+            if local.records:
+                os.makedirs(local.trace_dir, exist_ok=True)
+                with open(
+                    os.path.join(local.trace_dir, shard_name("trace")),
+                    "a",
+                    encoding="utf-8",
+                ) as f:
+                    for record in local.records:
+                        f.write(json.dumps(record) + "\n")
+        local.records = []
+        local.context = {}
+        local.stack = []
+
+    def stage(self, name, **context):
+        if not self.enabled:
+            stage_times = self.stage_times
+            if stage_times is None:
+                return _DISABLED
+            return _TimedStage(stage_times, name)
+        return _Stage(self, name, context)
+
+
+# Shared by all stages of the same (worker) process
+profiler = Profiler()
+
+
+def read_trace(save_path):
+    """All stage records of a results folder: those of the merged trace file
+    and of the trace shards not merged yet."""
+    paths = []
+    merged_path = os.path.join(save_path, TRACE_NAME + ".jsonl")
+    if os.path.isfile(merged_path):
+        paths.append(merged_path)
+    trace_dir = os.path.join(save_path, TRACE_DIRNAME)
+    if os.path.isdir(trace_dir):
+        paths += [
+            os.path.join(trace_dir, name) for name in sorted(os.listdir(trace_dir))
+        ]
+
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Line cut short by a worker that was killed mid-write
+                    continue
+    return sorted(records, key=lambda record: record["start"])
+
+
+def chrome_trace(records):
+    """The stage records as a Chrome trace (chrome://tracing, Perfetto), with
+    one track per worker process and thread."""
+    origin = min((record["start"] for record in records), default=0)
+    processes = {}
+    events = []
+    for record in records:
+        pid = processes.setdefault((record["host"], record["pid"]), len(processes) + 1)
+        args = {
+            key: value
+            for key, value in record.items()
+            if key not in ("name", "host", "pid", "thread", "start", "wall", "depth")
+        }
+        events.append(
+            {
+                "name": record["name"],
+                "cat": "senolysis",
+                "ph": "X",
+                "ts": (record["start"] - origin) * 1e6,
+                "dur": record["wall"] * 1e6,
+                "pid": pid,
+                "tid": record["thread"],
+                "args": args,
+            }
+        )
+    for (host, worker_pid), pid in processes.items():
+        events.append(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "args": {"name": f"{host} worker {worker_pid}"},
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def merge_trace(save_path, cleanup=True):
+    """Merges the trace shards of all workers in save_path into
+    Senolysis_trace.jsonl and its Chrome trace Senolysis_trace.json.
+
+    Returns
+    -------
+    records: list of all stage records, ordered by start time
+    """
+    records = read_trace(save_path)
+    if not records:
+        return records
+
+    with open(
+        os.path.join(save_path, TRACE_NAME + ".jsonl"), "w", encoding="utf-8"
+    ) as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    with open(os.path.join(save_path, TRACE_NAME + ".json"), "w") as f:
+        json.dump(chrome_trace(records), f)
+
+    trace_dir = os.path.join(save_path, TRACE_DIRNAME)
+    if cleanup and os.path.isdir(trace_dir):
+        for name in os.listdir(trace_dir):
+            os.remove(os.path.join(trace_dir, name))
+        os.rmdir(trace_dir)
+
+    return records
+
+
+def trace_summary(records, num_slowest=5):
+    """Summary tables of stage records.
+
+    Returns
+    -------
+    stages: count, total and mean wall time, total CPU time and largest peak
+        memory of every stage
+    workers: images, busy time and largest peak memory of every worker process
+    slowest: the num_slowest slowest images
+    """
+    trace = pd.DataFrame.from_records(records)
+    stages = (
+        trace.groupby("name", sort=False)
+        .agg(
+            count=("wall", "size"),
+            wall_s=("wall", "sum"),
+            mean_wall_s=("wall", "mean"),
+            cpu_s=("cpu", "sum"),
+            peak_mb=("peak_mb", "max"),
+        )
+        .sort_values("wall_s", ascending=False)
+    )
+
+    # Outermost stages of the analyzed images, one per image or, in the
+    # pipelined executor, the read, compute and write stage of every field
+    if "image" not in trace:
+        # Only cached images, nothing was analyzed
+        return stages, pd.DataFrame(), pd.DataFrame()
+    analyzed = trace[(trace["depth"] == 0) & trace["image"].notna()]
+    workers = analyzed.groupby(["host", "pid"]).agg(
+        images=("image", "nunique"),
+        wall_s=("wall", "sum"),
+        cpu_s=("cpu", "sum"),
+        peak_mb=("peak_mb", "max"),
+    )
+    slowest = (
+        analyzed.groupby("image")
+        .agg(wall_s=("wall", "sum"), cpu_s=("cpu", "sum"), peak_mb=("peak_mb", "max"))
+        .nlargest(num_slowest, "wall_s")
+        .reset_index()
+    )
+    return stages, workers, slowest
+
+
+def print_trace_summary(records):
+    if not records:
+        print("No analysis stages were recorded")
+        return
+    stages, workers, slowest = trace_summary(records)
+    with pd.option_context("display.float_format", "{:.3f}".format):
+        print("Time per stage:")
+        print(stages.to_string())
+        if not workers.empty:
+            print("Time per worker:")
+            print(workers.to_string())
+            print("Slowest images:")
+            print(slowest.to_string(index=False))
@@ -0,0 +1,123 @@
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.filters import gaussian
+
+from nuclei_table import nearest_indices
+
+# Radius of the sigma 1 gaussian smoothing at full resolution
+GAUSSIAN_HALO = 4
+
+
+class RefinedNuclei:
+    """Full resolution boundaries and measures of the nuclei of a NucleiTable.
+
+    Every nucleus found on the downscaled image is segmented again at full
+    resolution, inside its bounding box grown by one downscaled pixel. The full
+    resolution nuclei channel is smoothed and thresholded at the same threshold
+    as the downscaled image, within the pixels closer to this nucleus than to
+    any other (and at most one downscaled pixel outside it). Nuclei with no
+    pixel above the threshold at full resolution keep their upsampled
+    downscaled mask.
+
+    Parameters
+    ----------
+    nuclei: NucleiTable found on the downscaled image
+    planes: dict of channel name to full resolution plane, must include "nuclei"
+    is_nucleus: function thresholding the smoothed nuclei channel
+    full_shape: (height, width) of the original image
+    downscale_factor: downscale factor of the nuclei table
+    """
+
+    def __init__(self, nuclei, planes, is_nucleus, full_shape, downscale_factor):
+        small_shape = nuclei.labels.shape
+        row_map = nearest_indices(small_shape[0], full_shape[0])
+        col_map = nearest_indices(small_shape[1], full_shape[1])
+
+        num_nuclei = len(nuclei)
+        self.windows = []
+        self.masks = []
+        self.areas = np.zeros(num_nuclei)
+        self.centroids = np.zeros((num_nuclei, 2))
+        self.means = {name: np.zeros(num_nuclei) for name in planes}
+        self.integrated_intensities = {name: np.zeros(num_nuclei) for name in planes}
+
+        for row, (label_id, bbox) in enumerate(zip(nuclei.label_ids, nuclei.bboxes)):
+            # Full resolution rows and columns of the bounding box plus one
+            # downscaled pixel, from the nearest neighbour mapping
+            r0, c0, r1, c1 = bbox
+            window = (
+                slice(*np.searchsorted(row_map, [r0 - 1, r1 + 1])),
+                slice(*np.searchsorted(col_map, [c0 - 1, c1 + 1])),
+            )
+            upscaled_labels = nuclei.labels[
+                np.ix_(row_map[window[0]], col_map[window[1]])
+            ]
+
+            # Pixels closest to this nucleus, at most one downscaled pixel away
+            distance, (nearest_rows, nearest_cols) = ndi.distance_transform_edt(
+                upscaled_labels == 0, return_indices=True
+            )
+            candidates = (upscaled_labels[nearest_rows, nearest_cols] == label_id) & (
+                distance <= downscale_factor
+            )
+
+            smoothed = self._smoothed_window(planes["nuclei"], window, full_shape)
+            mask = candidates & is_nucleus(smoothed)
+            mask = ndi.binary_fill_holes(mask) & candidates
+            if not mask.any():
+                mask = upscaled_labels == label_id
+
+            self.windows.append(window)
+            self.masks.append(mask)
+            self.areas[row] = np.count_nonzero(mask)
+            mask_rows, mask_cols = np.nonzero(mask)
+            self.centroids[row] = (
+                mask_rows.mean() + window[0].start,
+                mask_cols.mean() + window[1].start,
+            )
+            for name, plane in planes.items():
+                values = np.asarray(plane[window], dtype=np.float64)[mask]
+                self.integrated_intensities[name][row] = values.sum()
+                self.means[name][row] = values.mean()
+
+    @staticmethod
+    def _smoothed_window(plane, window, full_shape):
+        # Read with a halo, so the smoothing equals that of the whole plane
+        rows, cols = window
+        halo_window = (
+            slice(
+                max(rows.start - GAUSSIAN_HALO, 0),
+                min(rows.stop + GAUSSIAN_HALO, full_shape[0]),
+            ),
+            slice(
+                max(cols.start - GAUSSIAN_HALO, 0),
+                min(cols.stop + GAUSSIAN_HALO, full_shape[1]),
+            ),
+        )
+        smoothed = gaussian(
+            np.asarray(plane[halo_window], dtype=np.float64), 1, preserve_range=True
+        )
+        return smoothed[
+            rows.start - halo_window[0].start : rows.stop - halo_window[0].start,
+            cols.start - halo_window[1].start : cols.stop - halo_window[1].start,
+        ]
+
+    def select(self, keep):
+        """Keep only the rows where keep is True (as NucleiTable.select)."""
+        self.windows = [w for w, k in zip(self.windows, keep) if k]
+        self.masks = [m for m, k in zip(self.masks, keep) if k]
+        self.areas = self.areas[keep]
+        self.centroids = self.centroids[keep]
+        self.means = {name: values[keep] for name, values in self.means.items()}
+        self.integrated_intensities = {
+            name: values[keep] for name, values in self.integrated_intensities.items()
+        }
+        return self
+
+    def mask(self, full_shape, selection=None):
+        """Full resolution boolean mask of the selected rows (all if None)."""
+        mask = np.zeros(full_shape, dtype=bool)
+        for row, (window, nucleus_mask) in enumerate(zip(self.windows, self.masks)):
+            if selection is None or selection[row]:
+                mask[window] |= nucleus_mask
+        return mask
@@ -0,0 +1,105 @@
+import json
+import os
+import socket
+
+import pandas as pd
+
+SHARD_DIRNAME = ".senolysis_shards"
+
+
+def shard_name(prefix="measures"):
+    # One shard per process (and host) so parallel workers never share a file
+    return f"{prefix}_{socket.gethostname()}_{os.getpid()}.jsonl"
+
+
+class ResultsSink:
+    """Append-only store for per-image result rows.
+
+    Every process appends its rows as JSON lines to its own shard inside
+    save_path, so the cost per image is constant and parallel workers cannot
+    overwrite each other's rows. merge_results combines the shards into the
+    final workbook once all images are analyzed.
+
+    Parameters
+    ----------
+    save_path: results directory the rows belong to
+    """
+
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.shard_dir = os.path.join(save_path, SHARD_DIRNAME)
+
+    def append(self, pandas_dataframe):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        lines = pandas_dataframe.to_json(
+            orient="records", lines=True, force_ascii=False
+        ).rstrip("\n")
+        with open(
+            os.path.join(self.shard_dir, shard_name()), "a", encoding="utf-8"
+        ) as f:
+            f.write(lines + "\n")
+        return
+
+
+def read_shards(save_path):
+    """Reads all result rows appended to save_path as a single dataframe."""
+    shard_dir = os.path.join(save_path, SHARD_DIRNAME)
+    if not os.path.isdir(shard_dir):
+        return pd.DataFrame()
+
+    records = []
+    for name in sorted(os.listdir(shard_dir)):
+        with open(os.path.join(shard_dir, name), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Line cut short by a worker that was killed mid-write
+                    continue
+
+    return pd.DataFrame.from_records(records)
+
+
+def merge_results(
+    save_path, image_order=None, filename="Senolysis_measures.xlsx", cleanup=True
+):
+    """Merges the result shards in save_path into one Excel workbook.
+
+    Parameters
+    ----------
+    save_path: results directory containing the shards
+    image_order: optional list of image names, rows are sorted in this order
+    filename: name of the workbook written to save_path
+    cleanup: remove the shards once the workbook is written
+
+    Returns
+    -------
+    merged: dataframe that was written to the workbook
+    """
+    merged = read_shards(save_path)
+    if merged.empty:
+        return merged
+
+    # A task interrupted after writing its rows is analyzed again on resume
+    row_key = [c for c in ("Image", "Timepoint", "Position") if c in merged]
+    merged = merged.drop_duplicates(subset=row_key, keep="last")
+
+    if image_order is not None:
+        order = {name: i for i, name in enumerate(image_order)}
+        # Fields of the same image may be appended by different workers
+        field_columns = [c for c in ("Timepoint", "Position") if c in merged]
+        merged = merged.sort_values(
+            ["Image"] + field_columns,
+            key=lambda column: column.map(order) if column.name == "Image" else column,
+            kind="stable",
+        ).reset_index(drop=True)
+
+    merged.to_excel(os.path.join(save_path, filename), index=False)
+
+    if cleanup:
+        shard_dir = os.path.join(save_path, SHARD_DIRNAME)
+        for name in os.listdir(shard_dir):
+            os.remove(os.path.join(shard_dir, name))
+        os.rmdir(shard_dir)
+
+    return merged
@@ -0,0 +1,168 @@
+from dataclasses import dataclass
+import os
+
+from nd2_loading import ND2File
+from tiled_analysis import BYTES_PER_FULL_PIXEL, needs_tiling
+
+# Memory of a worker process before it reads an image: the interpreter and the
+# imported numpy, scikit-image and pandas
+WORKER_OVERHEAD_MB = 250
+# Fraction of the available memory the workers may use together, the rest is
+# left for the main process, the page cache and other programs
+MEMORY_HEADROOM = 0.8
+
+
+def available_memory():
+    """Memory available to new processes in bytes, None if it can not be
+    determined on this system."""
+    try:
+        import psutil
+    except ImportError:
+        pass
+    else:
+        return psutil.virtual_memory().available
+
+    # Linux: free memory plus reclaimable page cache
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def image_shapes(img_paths):
+    """(height, width, number of fields) of every image, read from the .nd2
+    metadata without reading any pixels. Images whose metadata cannot be read
+    are left out, their analysis reports the error."""
+    shapes = {}
+    for img_path in img_paths:
+        try:
+            with ND2File(img_path) as nd2_file:
+                shapes[img_path] = (
+                    nd2_file.height,
+                    nd2_file.width,
+                    len(nd2_file.fields),
+                )
+        except Exception:
+            continue
+    return shapes
+
+
+def field_memory(full_shape, memory_budget):
+    """Expected peak memory in bytes of analyzing one field of full_shape. Fields
+    over the memory budget are analyzed in tiles within the budget."""
+    if needs_tiling(full_shape, memory_budget):
+        return memory_budget * 2**20
+    return full_shape[0] * full_shape[1] * BYTES_PER_FULL_PIXEL
+
+
+@dataclass
+class WorkerPlan:
+    """Number of workers chosen for a run and what it is based on."""
+
+    num_jobs: int
+    limited_by: str
+    cpu_count: int
+    worker_mb: float
+    available_mb: float = None
+    largest_image: str = None
+    largest_shape: tuple = None
+
+    def describe(self):
+        lines = [
+            f"Running {self.num_jobs} images in parallel (limited by {self.limited_by})"
+        ]
+        if self.largest_image is not None:
+            height, width = self.largest_shape
+            lines.append(
+                f"Largest image: {os.path.basename(self.largest_image)} "
+                f"({height} x {width} pixels)"
+            )
+        lines.append(f"Expected memory per worker: {self.worker_mb:.0f} MB")
+        if self.available_mb is None:
+            lines.append("Available memory: unknown")
+        else:
+            lines.append(f"Available memory: {self.available_mb:.0f} MB")
+            if self.worker_mb > self.available_mb * MEMORY_HEADROOM:
+                lines.append(
+                    "The largest image may not fit in memory, consider setting a "
+                    "memory budget to analyze it in tiles"
+                )
+        lines.append(f"CPUs: {self.cpu_count}")
+        return "\n".join(lines)
+
+
+def plan_workers(shapes, params, num_tasks=None):
+    """Chooses the number of parallel workers from the image sizes and the
+    available memory.
+
+    Every worker may be analyzing the largest image at the same time, so the
+    number of workers is the number of times the expected peak memory of the
+    largest field, plus the worker's own overhead, fits in MEMORY_HEADROOM of
+    the available memory. It is at most the number of CPUs and of tasks.
+
+    Parameters
+    ----------
+    shapes: image_shapes of the images of the run
+    params: AnalysisParameters of the run
+    num_tasks: number of tasks of the run, default one per field
+
+    Returns
+    -------
+    plan: WorkerPlan
+    """
+    cpu_count = os.cpu_count() or 1
+    limits = {"CPUs": cpu_count}
+    if num_tasks is None:
+        # Fields of multi-field files are analyzed in parallel too
+        num_tasks = sum(num_fields for _, _, num_fields in shapes.values())
+    if num_tasks > 0:
+        limits["number of images"] = num_tasks
+
+    largest_image = max(
+        shapes,
+        key=lambda img_path: shapes[img_path][0] * shapes[img_path][1],
+        default=None,
+    )
+    largest_shape = None
+    image_bytes = 0
+    if largest_image is not None:
+        largest_shape = shapes[largest_image][:2]
+        image_bytes = field_memory(largest_shape, params.memory_budget)
+    worker_bytes = image_bytes + WORKER_OVERHEAD_MB * 2**20
+
+    available = available_memory()
+    if available is not None:
+        limits["memory"] = int(available * MEMORY_HEADROOM // worker_bytes)
+
+    limited_by = min(limits, key=limits.get)
+    return WorkerPlan(
+        num_jobs=max(1, limits[limited_by]),
+        limited_by=limited_by,
+        cpu_count=cpu_count,
+        worker_mb=worker_bytes / 2**20,
+        available_mb=None if available is None else available / 2**20,
+        largest_image=largest_image,
+        largest_shape=largest_shape,
+    )
+
+
+def largest_first(tasks, shapes):
+    """Orders (img_path, fields) tasks by decreasing number of pixels to
+    analyze, so the largest images do not start last and hold up the end of the
+    run while the other workers are idle. Tasks of equal size keep their
+    order, images missing from shapes go last."""
+
+    def pixels(task):
+        img_path, fields = task
+        height, width, num_fields = shapes.get(img_path, (0, 0, 0))
+        return height * width * (num_fields if fields is None else len(fields))
+
+    return sorted(tasks, key=pixels, reverse=True)
@@ -1,110 +1,513 @@
-from skimage.transform import downscale_local_mean
 from skimage.filters import gaussian
 from senolysis_functions import *
-from skimage.morphology import remove_small_objects, remove_small_holes
-from skimage.transform import resize
+from skimage.morphology import remove_small_holes
 from skimage import io
+from nd2_loading import ND2File
+from tiled_analysis import needs_tiling, tiled_field_analysis
+from refinement import RefinedNuclei
+from well_mask import ring_margin
+from nuclei_features import features_dataframe
+from intensity_histogram import QC_SUFFIX, IntensityHistogram, save_qc
+from label_outputs import LABELS_SUFFIX, save_labels
+from preprocessing import field_preprocessor
+from profiling import profiler
+from dataclasses import dataclass
+from functools import partial
+import threading
 
+# Serializes create_figure when fields are written from several threads
+FIGURE_LOCK = threading.Lock()
 
-def senolysis_analysis(img_path, program_start_time, gui):
 
-    red, green, blue = nd2_import(img_path, gui)
+def senolysis_analysis(img_path, program_start_time, params, fields=None):
+    """Analyzes every (timepoint, position) field of an .nd2 file, or only the
+    given fields. Fields are read and analyzed one at a time, each writing its
+    own result row. Fields too large for params.memory_budget are analyzed tile
+    by tile. With params.refine_nuclei, the nuclei found on the downscaled
+    images are segmented again at full resolution. With params.profile, the
+    analysis stages are recorded to the trace of the results folder.
 
-    # downscale the images for faster computation
-    downscale_factor = 4
-    blue_downscaled = downscale_local_mean(
-        blue, factors=(downscale_factor, downscale_factor)
-    )
-    green_downscaled = downscale_local_mean(
-        green, factors=(downscale_factor, downscale_factor)
-    )
-    red_downscaled = downscale_local_mean(
-        red, factors=(downscale_factor, downscale_factor)
+    Returns
+    -------
+    results: list with the results dataframe of every analyzed field
+    output_paths: paths of all images saved for the analyzed fields
+    """
+    if params.profile != 1:
+        return analyze_image(img_path, program_start_time, params, fields)
+
+    profiler.start(get_save_path(img_path, program_start_time))
+    try:
+        with profiler.stage("image", image=os.path.basename(img_path)):
+            return analyze_image(img_path, program_start_time, params, fields)
+    finally:
+        profiler.stop()
+
+
+def analyze_image(img_path, program_start_time, params, fields=None):
+    # The analysis of senolysis_analysis, without profiling setup
+
+    # downscale the images for faster computation, the full resolution planes
+    # are only read one at a time and not kept
+    downscale_factor = params.downscale_factor
+    channels = (
+        params.scenescent_channel,
+        params.quiescent_channel,
+        params.nuclei_chanel,
     )
 
-    #rescale to 0 - 98th percentiles 
-    red_normalized, green_normalized, blue_normalized = (
-        normalize_img(red_downscaled, high_per=98),
-        normalize_img(green_downscaled, high_per=98),
-        normalize_img(blue_downscaled, high_per=98),
-    )   
+    results = []
+    output_paths = []
+    with ND2File(img_path) as nd2_file:
+        all_fields = nd2_file.fields
+        full_shape = (nd2_file.height, nd2_file.width)
+
+        tiled = needs_tiling(full_shape, params.memory_budget)
+        if tiled and params.refine_nuclei == 1:
+            warnings.warn(
+                f"{os.path.basename(img_path)} is analyzed in tiles, nuclei are "
+                "not refined at full resolution"
+            )
+
+        for field in all_fields if fields is None else fields:
+            # Single field files keep the plain per-image output
+            result_field = field if len(all_fields) > 1 else None
+            if tiled:
+                with profiler.stage("tiled_field_analysis", field=result_field):
+                    results_dataframe, field_paths = tiled_field_analysis(
+                        nd2_file,
+                        field,
+                        downscale_factor,
+                        img_path=img_path,
+                        program_start_time=program_start_time,
+                        params=params,
+                        result_field=result_field,
+                    )
+            else:
+                with profiler.stage("nd2_import", field=result_field):
+                    # Buffers are reused for every field of the same size
+                    preprocessor = field_preprocessor(
+                        full_shape,
+                        downscale_factor,
+                        len(channels),
+                        params.intensity_dtype,
+                    )
+                    downscaled = preprocessor.downscale(
+                        (nd2_file.plane(channel, field) for channel in channels)
+                    )
+                full_planes = None
+                if params.refine_nuclei == 1:
+                    full_planes = full_resolution_planes(nd2_file, channels, field)
+                with profiler.stage("field_analysis", field=result_field):
+                    results_dataframe, field_paths = field_analysis(
+                        *downscaled,
+                        full_shape=full_shape,
+                        downscale_factor=downscale_factor,
+                        img_path=img_path,
+                        program_start_time=program_start_time,
+                        params=params,
+                        field=result_field,
+                        full_planes=full_planes,
+                        preprocessor=preprocessor,
+                    )
+            results.append(results_dataframe)
+            output_paths.extend(field_paths)
+
+    return results, output_paths
+
+
+def full_resolution_planes(nd2_file, channels, field):
+    """Memory-mapped senescent, quiescent and nuclei planes of a field, keyed by
+    their channel name. Only the windows around nuclei are read from disk when
+    nuclei are refined."""
+    return {
+        name: nd2_file.plane(channel, field)
+        for name, channel in zip(("scenescent", "quiescent", "nuclei"), channels)
+    }
 
-    blue_smoothed = gaussian(blue_downscaled, 1,preserve_range = True)
 
-    if gui.remove_well_ring == 1:
+def segment_nuclei(
+    blue_downscaled, downscale_factor, params, position=None, preprocessor=None
+):
+    """Segments and size filters the nuclei of one downscaled nuclei channel.
+    position identifies the well position of multi-position files. With a
+    FieldPreprocessor the smoothed channel is written to its buffer.
+
+    Returns
+    -------
+    nuclei: NucleiTable of the nuclei
+    is_nucleus: function thresholding smoothed nuclei channel images the way
+        the downscaled image was thresholded
+    """
+
+    with profiler.stage("gaussian"):
+        if preprocessor is None:
+            blue_smoothed = gaussian(blue_downscaled, 1,preserve_range = True)
+        else:
+            blue_smoothed = preprocessor.smooth(blue_downscaled)
+
+    if params.remove_well_ring == 1:
+        with profiler.stage("remove_well_rings"):
             blue_smoothed = remove_well_rings(
-                blue_smoothed, max_size=gui.max_nuclei_size
+                blue_smoothed,
+                max_size=scale_area(params.max_nuclei_size, downscale_factor),
+                well_masks=well_mask_cache if params.reuse_well_mask == 1 else None,
+                position=position,
+                margin=ring_margin(downscale_factor),
             )
         
     # Threshold Nuclei
-    if gui.thresholding_method == 'Otsu':
-        
-        nuclei_thresholded = threshold_with_otsu(blue_smoothed)
+    with profiler.stage("threshold"):
+        is_nucleus = nuclei_thresholder(
+            blue_smoothed, params.thresholding_method, params.nuclei_threshold
+        )
+        nuclei_thresholded = is_nucleus(blue_smoothed)
+
+        nuclei_thresholded = remove_small_holes(
+            nuclei_thresholded, area_threshold=scale_area(100, downscale_factor)
+        )
+
+    # Label nuclei once, all further measures are read from this table
+    with profiler.stage("label"):
+        min_nuclei_area = int(params.min_nuclei_size / downscale_factor**2)
+        max_nuclei_area = int(params.max_nuclei_size / downscale_factor**2)
+        nuclei = NucleiTable(nuclei_thresholded, min_area=min_nuclei_area)
+        if params.thresholding_method == 'Otsu':
+            nuclei = discard_otsu_noise(nuclei)
 
-    elif gui.thresholding_method == 'Global':
+        # Size filter threshold nuclei
+        nuclei.filter_by_area(min_area=min_nuclei_area, max_area=max_nuclei_area)
 
-        nuclei_thresholded = blue_smoothed >= gui.nuclei_threshold
-    else: 
-        raise ValueError('Could not identify nuclei thresholding method')
+    return nuclei, is_nucleus
 
-    nuclei_thresholded = remove_small_holes(nuclei_thresholded, area_threshold=100)
 
-    # Size filter threshold nuclei
-    min_nuclei_area = int(gui.min_nuclei_size / downscale_factor**2)
-    max_nuclei_area = int(gui.max_nuclei_size / downscale_factor**2)
-    nuclei_thresholded = remove_small_objects(
-        nuclei_thresholded, min_size=min_nuclei_area
+def measure_nuclei(
+    nuclei,
+    is_nucleus,
+    red_downscaled,
+    green_downscaled,
+    full_shape,
+    downscale_factor,
+    params,
+    full_planes=None,
+):
+    """Per-nucleus channel means and full resolution areas of the segmented
+    nuclei. Given the full resolution planes, nuclei are refined at full
+    resolution first: the means and areas are those of the refined nuclei and
+    the size limits are applied to the refined areas.
+
+    Returns
+    -------
+    means: dict of "scenescent" and "quiescent" to per-nucleus means
+    areas: per-nucleus areas in full resolution pixels
+    refined: RefinedNuclei with the same rows as nuclei, None if not refined
+    """
+    if full_planes is None:
+        means = {
+            "scenescent": nuclei.add_channel("scenescent", red_downscaled),
+            "quiescent": nuclei.add_channel("quiescent", green_downscaled),
+        }
+        areas = nuclei.weighted_areas(upscale_weights(nuclei.labels.shape, full_shape))
+        return means, areas, None
+
+    refined = RefinedNuclei(
+        nuclei, full_planes, is_nucleus, full_shape, downscale_factor
     )
-    nuclei_thresholded = remove_large_nuclei(
-        nuclei_thresholded, max_size=max_nuclei_area
+    keep = (refined.areas >= params.min_nuclei_size) & (
+        refined.areas <= params.max_nuclei_size
     )
+    nuclei.select(keep)
+    refined.select(keep)
+    means = {name: refined.means[name] for name in ("scenescent", "quiescent")}
+    return means, refined.areas, refined
 
-    # Determine if each nuclei belongs to scenescent or quiescent cell
-    scenescent_downscaled, quiescent_downscaled = classify_nuclei(
-        mask=nuclei_thresholded,
-        red=red_downscaled,
-        green=green_downscaled,
-        red_threshold=gui.scenescent_threshold,
-    )
 
-    # Upsample segmentation results back to orignal image size
-    scenescent_upscaled = resize(scenescent_downscaled, output_shape=red.shape)
-    quiescent_upscaled = resize(quiescent_downscaled, output_shape=green.shape)
+@dataclass
+class FieldOutput:
+    """Everything field_analysis saves for one field, computed by
+    compute_field and written by write_field. Masks are kept at the analysis
+    resolution and only upsampled when they are written. With the Labels mask
+    format the label image and label ids of the nuclei are kept as well."""
+
+    img_path: str
+    field: tuple
+    full_shape: tuple
+    results_dataframe: pd.DataFrame
+    scenescent_downscaled: np.ndarray
+    quiescent_downscaled: np.ndarray
+    is_scenescent: np.ndarray
+    refined: RefinedNuclei = None
+    features: pd.DataFrame = None
+    RGB: np.ndarray = None
+    histograms: dict = None
+    labels: np.ndarray = None
+    label_ids: np.ndarray = None
+
 
-    # Measures counts and nuclei mean size + std
-    results_dataframe = analyze_nuclei(
-        scenescent_upscaled, quiescent_upscaled, img_path
+def field_analysis(
+    red_downscaled,
+    green_downscaled,
+    blue_downscaled,
+    full_shape,
+    downscale_factor,
+    img_path,
+    program_start_time,
+    params,
+    field=None,
+    full_planes=None,
+    preprocessor=None,
+):
+    output = compute_field(
+        red_downscaled,
+        green_downscaled,
+        blue_downscaled,
+        full_shape,
+        downscale_factor,
+        img_path,
+        params,
+        field=field,
+        full_planes=full_planes,
+        preprocessor=preprocessor,
     )
+    return write_field(output, program_start_time, params)
 
-    img_dirname = os.path.dirname(img_path)
-    save_path = os.path.join(img_dirname, f"Results_{program_start_time}")
 
-    if os.path.exists(save_path) is False:
-        os.mkdir(save_path)
+def compute_field(
+    red_downscaled,
+    green_downscaled,
+    blue_downscaled,
+    full_shape,
+    downscale_factor,
+    img_path,
+    params,
+    field=None,
+    full_planes=None,
+    preprocessor=None,
+):
+    """Segments, classifies and measures the nuclei of one field, without
+    writing anything. Given the FieldPreprocessor the downscaled images were
+    read with, the smoothing, histograms and figure image use its buffers, and
+    the figure image is only valid until its next field.
 
-    saveExcel(results_dataframe, os.path.join(save_path, "Senolysis_measures.xlsx"))
+    Returns
+    -------
+    output: FieldOutput of the field
+    """
+    nuclei, is_nucleus = segment_nuclei(
+        blue_downscaled,
+        downscale_factor,
+        params,
+        position=None if field is None else field[1],
+        preprocessor=preprocessor,
+    )
+    with profiler.stage("classify_nuclei"):
+        means, full_resolution_areas, refined = measure_nuclei(
+            nuclei,
+            is_nucleus,
+            red_downscaled,
+            green_downscaled,
+            full_shape,
+            downscale_factor,
+            params,
+            full_planes=full_planes,
+        )
 
-    #Save Image with no DAPI Channel
-    zeros = np.zeros(blue_normalized.shape)
-    RGB = np.dstack([red_normalized, green_normalized, zeros])
+        # Determine if each nuclei belongs to scenescent or quiescent cell
+        is_scenescent = classify_nuclei(
+            means, red_threshold=params.scenescent_threshold
+        )
+        scenescent_downscaled = nuclei.mask(is_scenescent)
+        quiescent_downscaled = nuclei.mask(~is_scenescent)
 
-    img_name = os.path.split(img_path)[-1]
-    img_name = os.path.splitext(img_name)[0]
+    # Measures counts and nuclei mean size + std at orignal image size
+    with profiler.stage("analyze_nuclei"):
+        results_dataframe = analyze_nuclei(
+            full_resolution_areas[is_scenescent],
+            full_resolution_areas[~is_scenescent],
+            img_path,
+            field=field,
+        )
 
-    create_figure(
-        RGB,
+    output = FieldOutput(
+        img_path,
+        field,
+        full_shape,
+        results_dataframe,
         scenescent_downscaled,
         quiescent_downscaled,
-        save_path,
-        img_name,
-        gui.scenescent_threshold,
+        is_scenescent,
+        refined=refined,
     )
+    if params.mask_format == "Labels":
+        output.labels, output.label_ids = nuclei.labels, nuclei.label_ids
+
+    if params.feature_export != "Off":
+        with profiler.stage("feature_table"):
+            if refined is None:
+                output.features = feature_table(
+                    nuclei,
+                    is_scenescent,
+                    channels={
+                        "scenescent": red_downscaled,
+                        "quiescent": green_downscaled,
+                        "nuclei": blue_downscaled,
+                    },
+                    full_shape=full_shape,
+                    img_path=img_path,
+                    field=field,
+                )
+            else:
+                output.features = features_dataframe(
+                    nuclei.label_ids,
+                    refined.centroids,
+                    refined.areas,
+                    refined.means,
+                    refined.integrated_intensities,
+                    is_scenescent,
+                    img_path,
+                    field=field,
+                )
+
+    if params.figure_mode != "Off" or params.qc_export == 1:
+        # One histogram per channel for the figure percentiles and the QC
+        with profiler.stage("intensity_histograms"):
+            if preprocessor is None:
+                histogram = partial(
+                    IntensityHistogram.from_downscaled,
+                    downscale_factor=downscale_factor,
+                )
+            else:
+                histogram = preprocessor.histogram
+            output.histograms = {
+                "scenescent": histogram(red_downscaled),
+                "quiescent": histogram(green_downscaled),
+            }
+            if params.qc_export == 1:
+                output.histograms["nuclei"] = histogram(blue_downscaled)
+
+    if params.figure_mode != "Off" and preprocessor is not None:
+        with profiler.stage("normalize_img"):
+            output.RGB = preprocessor.rgb(
+                red_downscaled,
+                green_downscaled,
+                output.histograms["scenescent"],
+                output.histograms["quiescent"],
+                high_per=98,
+            )
+    elif params.figure_mode != "Off":
+        with profiler.stage("normalize_img"):
+            #rescale to 0 - 98th percentiles
+            red_normalized, green_normalized = (
+                normalize_img(
+                    red_downscaled,
+                    high_per=98,
+                    histogram=output.histograms["scenescent"],
+                ),
+                normalize_img(
+                    green_downscaled,
+                    high_per=98,
+                    histogram=output.histograms["quiescent"],
+                ),
+            )
+
+            #Save Image with no DAPI Channel
+            zeros = np.zeros(blue_downscaled.shape, dtype=red_normalized.dtype)
+            output.RGB = np.dstack([red_normalized, green_normalized, zeros])
+
+    return output
+
+
+def write_field(output, program_start_time, params):
+    """Saves the result row, feature table, figure and masks of a field.
+
+    Returns
+    -------
+    results_dataframe: result row of the field
+    output_paths: paths of the saved files
+    """
+    img_path, field, full_shape = output.img_path, output.field, output.full_shape
+    save_path = get_save_path(img_path, program_start_time)
+    os.makedirs(save_path, exist_ok=True)
+
+    with profiler.stage("save_results"):
+        ResultsSink(save_path).append(output.results_dataframe)
+
+    img_name = get_img_name(img_path, field)
+
+    output_paths = []
+    if output.features is not None:
+        with profiler.stage("save_features"):
+            output_paths.append(
+                save_features(
+                    output.features,
+                    os.path.join(save_path, img_name + FEATURES_SUFFIX),
+                    params.feature_export,
+                )
+            )
+
+    if params.qc_export == 1 and output.histograms is not None:
+        with profiler.stage("save_qc"):
+            output_paths.append(
+                save_qc(
+                    output.histograms,
+                    img_path,
+                    os.path.join(save_path, img_name + QC_SUFFIX),
+                    field=field,
+                )
+            )
+
+    if output.RGB is not None:
+        with profiler.stage("figure"):
+            output_paths.append(os.path.join(save_path, img_name + ".png"))
+
+            if params.figure_mode == "Matplotlib":
+                # pyplot keeps global state, figures are drawn one at a time
+                with FIGURE_LOCK:
+                    create_figure(
+                        output.RGB,
+                        output.scenescent_downscaled,
+                        output.quiescent_downscaled,
+                        save_path,
+                        img_name,
+                        params.scenescent_threshold,
+                    )
+            else:
+                save_overlay(
+                    output.RGB,
+                    output.scenescent_downscaled,
+                    output.quiescent_downscaled,
+                    os.path.join(save_path, img_name + ".png"),
+                    params.scenescent_threshold,
+                    mode=params.figure_mode,
+                )
+
+    with profiler.stage("save_masks"):
+        if params.mask_format == "Labels":
+            output_paths.append(
+                save_labels(
+                    os.path.join(save_path, img_name + LABELS_SUFFIX),
+                    output.labels,
+                    output.label_ids,
+                    output.is_scenescent,
+                    full_shape,
+                    refined=output.refined,
+                )
+            )
+            return output.results_dataframe, output_paths
+
+        #Save Binary Mask as well
+        scenescent_mask_path = os.path.join(save_path,img_name+'_scenescent_mask.png')
+        quiescent_mask_path = os.path.join(save_path,img_name+'_quiescent_mask.png')
 
-    #Save Binary Mask as well
-    scenescent_mask_path = os.path.join(save_path,img_name+'_scenescent_mask.png')
-    quiescent_mask_path = os.path.join(save_path,img_name+'_quiescent_mask.png')
+        # Upsample segmentation results back to orignal image size
+        if output.refined is None:
+            scenescent_upscaled = upscale_mask(output.scenescent_downscaled, full_shape)
+            quiescent_upscaled = upscale_mask(output.quiescent_downscaled, full_shape)
+        else:
+            scenescent_upscaled = output.refined.mask(full_shape, output.is_scenescent)
+            quiescent_upscaled = output.refined.mask(full_shape, ~output.is_scenescent)
 
-    io.imsave(scenescent_mask_path,np.uint8(scenescent_upscaled*255),check_contrast=False)
-    io.imsave(quiescent_mask_path,np.uint8(quiescent_upscaled*255),check_contrast=False)
+        io.imsave(scenescent_mask_path,np.uint8(scenescent_upscaled)*255,check_contrast=False)
+        io.imsave(quiescent_mask_path,np.uint8(quiescent_upscaled)*255,check_contrast=False)
+        output_paths += [scenescent_mask_path, quiescent_mask_path]
 
-    return
+    return output.results_dataframe, output_paths
@@ -1,17 +1,20 @@
 import numpy as np
-from nd2reader import ND2Reader
+from nd2_loading import list_fields
 import os
-import matplotlib.pyplot as plt
-from skimage.measure import label, regionprops
-from skimage.filters import threshold_otsu
+from nuclei_table import NucleiTable, upscale_mask, upscale_weights
+from results_sink import ResultsSink, merge_results
+from overlay import FIGURE_MODES, save_overlay
+from well_mask import RING_MARGIN, well_mask_cache, well_removal_mask
+from intensity_histogram import IntensityHistogram
+from nuclei_features import (
+    FEATURES_SUFFIX,
+    feature_table,
+    merge_features,
+    save_features,
+)
 import pandas as pd
-from skimage.segmentation import mark_boundaries
-from matplotlib.lines import Line2D
 import warnings
-from skimage.filters import threshold_mean
 from skimage.exposure import rescale_intensity
-from skimage.morphology import binary_dilation, disk
-from skimage.segmentation import flood_fill
 import csv
 
 
@@ -55,147 +58,80 @@ def standardize_strings(names):
         raise ValueError("names should be a string or list of strings")
 
 
-def nd2_import(image_path, gui):
-
-    # # List of possible image names
-    # hoechst_possbile_names = standardize_strings(
-    #     ["senolysis hoechst", "hoechst", "kinetix single hoechst"]
-    # )
-    # senolysis_possible_names = standardize_strings(
-    #     ["senolysis", " Kinetix Single band tdTomato", "tdTomato"]
-    # )
-    # EGFP_possible_namess = standardize_strings(
-    #     ["senolysis egfp", " Kinetix Single band senolysis  EGFP1", "egfp1", "egfp"]
-    # )
-
-    with ND2Reader(image_path) as nd2_object:
-
-        red = nd2_object[gui.scenescent_channel]
-        green = nd2_object[gui.quiescent_channel]
-        blue = nd2_object[gui.nuclei_chanel]
-
-        # # Get channel names
-        # metadata = nd2_object.metadata
-        # channels = standardize_strings(metadata["channels"])
-
-        # # Return channels in correct order
-        # for i, channel in enumerate(channels):
-
-        #     if channel in hoechst_possbile_names:
-        #         ind_hoechst = i
-        #     elif channel.lower() in senolysis_possible_names:
-        #         ind_senolysis = i
-        #     elif channel.lower() in EGFP_possible_namess:
-        #         ind_EGFP = i
-        #     else:
-        #         ind_senolysis = 0
-        #         ind_EGFP = 1
-        #         ind_hoechst = 2
-
-        #         warnings.warn(
-        #             """Naming of .nd2 channels cannot be resolved. Assuming the
-        #                             channel order is Senescent, Quiescent then Nuclei stain.
-        #             """
-
-        # return nd2_object[ind_senolysis], nd2_object[ind_EGFP], nd2_object[ind_hoechst]
-
-    return red, green, blue
-
-
-def normalize_img(img, low_per=1, high_per=99):
-    low = np.percentile(img, low_per)
-    high = np.percentile(img, high_per)
+def normalize_img(img, low_per=1, high_per=99, histogram=None):
+    # Percentiles from the IntensityHistogram of img if given, which equal
+    # np.percentile for exact histograms
+    if histogram is None:
+        low = np.percentile(img, low_per)
+        high = np.percentile(img, high_per)
+    else:
+        low = histogram.percentile(low_per)
+        high = histogram.percentile(high_per)
     rescaled = rescale_intensity(img, in_range=(low, high), out_range=(0, 1))
     return rescaled
 
 
-def remove_well_rings(img, max_size=300):
-
-    thresh = threshold_mean(img)
-    binary = img > thresh
-    regions = regionprops(label(binary))
-    # Generate inverted mask of regions falling between the low_size and min_size
-    removal_mask = np.zeros(img.shape, dtype="bool")
-    for region in regions:
-        if max_size < region.area:
-            removal_mask[tuple(region.coords.T.tolist())] = 1
-
-    # Dilate slightly to ensure well-edge is completely removed
-    removal_mask = binary_dilation(removal_mask, disk(15))
-
-    # fill corners of image (Outside of well)
-    removal_mask = flood_fill(removal_mask, (0, 0), 1)
-    removal_mask = flood_fill(removal_mask, (-1, 0), 1)
-    removal_mask = flood_fill(removal_mask, (0, -1), 1)
-    removal_mask = flood_fill(removal_mask, (-1, -1), 1)
-
-    # check that mask i
-
-    # invert mask
-    removal_mask = np.abs(removal_mask - 1)
+def remove_well_rings(
+    img, max_size=300, well_masks=None, position=None, margin=RING_MARGIN
+):
+    """Sets the well outline (objects larger than max_size), a margin around it
+    and everything outside the well to zero.
 
-    out = removal_mask * img
-    return out
+    If a WellMaskCache is given, the mask of an earlier image of the same well
+    position is reused when it still fits img.
+    """
+    if well_masks is None:
+        removal_mask = well_removal_mask(img, max_size, margin)
+    else:
+        removal_mask = well_masks.removal_mask(img, max_size, position, margin)
 
+    return np.where(removal_mask, 0, img)
 
-def remove_large_nuclei(binary, max_size=7000):
 
-    regions = regionprops(label(binary))
+def nuclei_thresholder(img, thresholding_method, nuclei_threshold):
+    """Function thresholding nuclei channel images the way img is thresholded:
+    above the Otsu threshold of img, or at or above the global threshold."""
 
-    removal_mask = np.ones(binary.shape)
-    for region in regions:
-        if max_size < region.area:
-            removal_mask[tuple(region.coords.T.tolist())] = 0
+    if thresholding_method == "Otsu":
+        thresh = IntensityHistogram.from_image(img).otsu()
+        return lambda image: image > thresh
+    elif thresholding_method == "Global":
+        return lambda image: image >= nuclei_threshold
+    else:
+        raise ValueError("Could not identify nuclei thresholding method")
 
-    return removal_mask * binary
 
+def scale_area(area, downscale_factor):
+    """Converts an area in pixels of an image downscaled by a factor of 4, the
+    factor the segmentation settings were chosen at, to pixels of an image
+    downscaled by downscale_factor."""
+    return int(area * (4 / downscale_factor) ** 2)
 
-def threshold_with_otsu(img):
 
-    thresh = threshold_otsu(img)
-    thresholded = img > thresh
+def discard_otsu_noise(nuclei_table, max_nuclei=50000):
 
     # Zero out thresholding if over 50,000 nuclei detected
     # Done as if no nuclei present, otsu will theshold noise
-    labelled = label(thresholded)
-    if np.amax(labelled) > 50000:
-        thresholded = np.zeros(thresholded.shape)
+    if nuclei_table.num_objects > max_nuclei:
+        nuclei_table.select(np.zeros(len(nuclei_table), dtype=bool))
         warnings.warn("No nuclei detected.")
 
-    return thresholded
-
-
-def classify_nuclei(mask, red, green, red_threshold):
-
-    nuclei_regions = regionprops(label(mask))
-
-    scenescent = np.zeros(mask.shape)
-    quiescent = np.zeros(mask.shape)
-    for nuclei in nuclei_regions:
-        nuclei_coordinates = nuclei.coords
-        red_value = np.mean(red[tuple(nuclei_coordinates.T)])
-        green_value = np.mean(green[tuple(nuclei_coordinates.T)])
+    return nuclei_table
 
-        # if red_value > green_value:
-        if red_value >= red_threshold:
-            scenescent[tuple(nuclei_coordinates.T)] = 1
-        else:
-            quiescent[tuple(nuclei_coordinates.T)] = 1
 
-    return np.bool_(scenescent), np.bool_(quiescent)
+def classify_nuclei(means, red_threshold):
+    """Boolean array, True for senescent nuclei, from the per-nucleus channel
+    means."""
 
+    # if red_value > green_value:
+    return means["scenescent"] >= red_threshold
 
-def determine_count_and_area(mask):
 
-    labelled = label(mask)
-    count = np.amax(labelled)
+def determine_count_and_area(areas):
 
-    region = regionprops(labelled)
+    count = len(areas)
 
-    if len(region) > 0:
-        areas = []
-        for i in range(len(region)):
-            areas.append(region[i].area)
+    if count > 0:
         mean_size = round(np.mean(areas), 2)
         std_size = round(np.std(areas), 2)
     else:
@@ -205,10 +141,10 @@ def determine_count_and_area(mask):
     return count, mean_size, std_size
 
 
-def analyze_nuclei(scenescent_mask, quiescent_mask, img_path):
+def analyze_nuclei(scenescent_areas, quiescent_areas, img_path, field=None):
 
-    count_q, area_q, std_q = determine_count_and_area(quiescent_mask)
-    count_s, area_s, std_s = determine_count_and_area(scenescent_mask)
+    count_q, area_q, std_q = determine_count_and_area(quiescent_areas)
+    count_s, area_s, std_s = determine_count_and_area(scenescent_areas)
 
     if count_s > 0:
         ratio = round(count_q / count_s, 3)
@@ -238,6 +174,10 @@ def analyze_nuclei(scenescent_mask, quiescent_mask, img_path):
         "senescence mean area \u00B1 std(pixels^2)",
     ]
 
+    # Fields of multi-position / multi-timepoint files get their own row
+    if field is not None:
+        storage_df["Timepoint"], storage_df["Position"] = field
+
     return storage_df
 
 
@@ -245,6 +185,10 @@ def analyze_nuclei(scenescent_mask, quiescent_mask, img_path):
 def create_figure(
     RGB, scenescent, quinescent, save_path, img_name, scenescent_threshold
 ):
+    # Imported here, as only the Matplotlib figure mode needs them
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+    from skimage.segmentation import mark_boundaries
 
     # Plot Images
     plt.figure(figsize=(5, 5))
@@ -275,31 +219,18 @@ def create_figure(
     return
 
 
-def write_csv(pandas_dataframe, directory):
-    # Writes the CSV file of  pandas dataframe to specified directory
-    if os.path.exists(directory) is False:
-        with open(directory, "a") as f:
-            pandas_dataframe.to_csv(f, header=True, index=False)
-    else:
-        existing = pd.read_csv(directory)
-        new_file = pd.concat([existing, pandas_dataframe], axis=0, ignore_index=False)
-        new_file.to_csv(directory, header=True, index=False)
-    return
-
-
-def saveExcel(pandas_dataframe, directory):
-
-    if os.path.exists(directory):
-        existing_excel = pd.read_excel(directory)
-        new_excel = pd.concat(
-            [existing_excel, pandas_dataframe], axis=0, ignore_index=True
-        )
-        new_excel.to_excel(directory, index=False)
+def get_save_path(img_path, program_start_time):
+    # Results are stored next to the analyzed images, one folder per run
+    img_dirname = os.path.dirname(img_path)
+    return os.path.join(img_dirname, f"Results_{program_start_time}")
 
-    else:
-        pandas_dataframe.to_excel(directory, index=False)
 
-    return
+def get_img_name(img_path, field=None):
+    # Output name of an image, fields of multi-field files get a suffix
+    img_name = os.path.splitext(os.path.basename(img_path))[0]
+    if field is not None:
+        img_name += "_t{}_p{}".format(*field)
+    return img_name
 
 
 # def save_user_parameters(gui,program_start_time):
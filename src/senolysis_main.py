@@ -1,54 +1,614 @@
+from time import perf_counter
+
+import_start = perf_counter()
 print("Importing Modules...")
 from senolysis_analysis import *
+from parameters import AnalysisParameters, parse_num_jobs
+from profiling import merge_trace, print_trace_summary, profiler
+from intensity_histogram import merge_qc
+from incremental import RunManifest, image_tasks, remaining_tasks, run_task
+from job_queue import JobQueue, work, worker_name
+from pipeline import run_pipelined
+from scheduling import image_shapes, largest_first, plan_workers
+from telemetry import (
+    FAILURES_NAME,
+    STATUS_INTERVAL,
+    RunStatus,
+    StatusWriter,
+    write_failure_logs,
+)
+from watch_folder import SETTLE_TIME, FolderWatcher, run_streaming
+from threshold_sweep import (
+    load_intensities,
+    measure_intensities,
+    parse_thresholds,
+    write_sweep,
+)
+from worker_pool import shutdown_worker_pools, warm_up_times, worker_pool
 from time import strftime, localtime
-from joblib import Parallel, delayed
 from multiprocessing import cpu_count
-from tqdm_joblib import tqdm_joblib
 from tqdm import tqdm
 from time import sleep
-from gui_senolysis import *
+from contextlib import nullcontext
+from dataclasses import replace
+from functools import partial
+import argparse
+
+# Seconds spent importing the modules above, printed to keep startup time in view
+IMPORT_TIME = perf_counter() - import_start
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="senolysisprogram",
+        description="Senolysis quantification using nuclei segmentation",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Run without the GUI, parameters are read from --config",
+    )
+    parser.add_argument(
+        "--config", help="TOML file with the analysis parameters (headless mode)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last unfinished run with the same parameters",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Analyze every image again instead of reusing cached results",
+    )
+    parser.add_argument(
+        "--sweep",
+        metavar="THRESHOLDS",
+        help="Count nuclei at several senescent thresholds instead of the single "
+        "threshold, e.g. 100,200,300 or 100:1000:50 (start:stop:step)",
+    )
+    parser.add_argument(
+        "--sweep-from",
+        metavar="RESULTS_DIR",
+        help="Repeat a threshold sweep from the nuclei intensities saved in a "
+        "results folder of an earlier sweep, without analyzing the images",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="Read, analyze and save images in overlapping stages",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep watching the directory and analyze new images as soon as "
+        "they are completely written, e.g. during acquisition",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="With --watch, stop after this many seconds without new images "
+        "(default: watch until Ctrl+C)",
+    )
+    parser.add_argument(
+        "--settle-time",
+        type=float,
+        default=SETTLE_TIME,
+        metavar="SECONDS",
+        help="With --watch, seconds a new image must stop growing before it is "
+        f"analyzed (default: {SETTLE_TIME:g})",
+    )
+    parser.add_argument(
+        "--enqueue",
+        action="store_true",
+        help="Queue the images for worker processes started with --worker, on "
+        "any host that can access the directory, instead of analyzing them",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Analyze images of the last run queued with --enqueue in the "
+        "directory, together with the workers on other hosts",
+    )
+    parser.add_argument(
+        "--jobs",
+        metavar="N",
+        help="With --worker, number of images analyzed in parallel on this "
+        "host, or auto (default: num_jobs of the queued run)",
+    )
+    parser.add_argument(
+        "--finalize",
+        action="store_true",
+        help="Merge the results of the last queued run in the directory once "
+        "all its images are analyzed",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Record the time and memory of every analysis stage to a trace "
+        "file in the results folder and print a summary at the end",
+    )
+    parser.add_argument(
+        "--status-dir",
+        metavar="DIR",
+        help="Write the live status of the run (throughput, stage times, worker "
+        "memory, failures and remaining tasks) to Senolysis_status.json and "
+        "Senolysis_status.prom in this folder, e.g. for the textfile collector "
+        "of the Prometheus node exporter",
+    )
+    parser.add_argument(
+        "--status-interval",
+        type=float,
+        default=STATUS_INTERVAL,
+        metavar="SECONDS",
+        help=f"With --status-dir, seconds between status updates "
+        f"(default: {STATUS_INTERVAL:g})",
+    )
+    parser.add_argument(
+        "directory",
+        nargs="?",
+        help="Directory containing the images, overrides the config file",
+    )
+    args = parser.parse_args(argv)
+
+    queue_modes = [
+        flag
+        for flag, used in (
+            ("--enqueue", args.enqueue),
+            ("--worker", args.worker),
+            ("--finalize", args.finalize),
+        )
+        if used
+    ]
+    if len(queue_modes) > 1:
+        parser.error(f"{' and '.join(queue_modes)} cannot be combined")
+    if queue_modes and (args.watch or args.sweep is not None or args.resume):
+        parser.error(
+            f"{queue_modes[0]} cannot be combined with --watch, --sweep or --resume"
+        )
+    if (args.worker or args.finalize) and args.directory is None:
+        parser.error(f"{queue_modes[0]} requires the image directory")
+    if args.jobs is not None and not args.worker:
+        parser.error("--jobs is only used with --worker")
+    if args.status_dir is not None and (queue_modes or args.sweep is not None):
+        parser.error("--status-dir cannot be combined with --sweep or the queue modes")
+    if args.status_interval <= 0:
+        parser.error("--status-interval must be positive")
+    if args.worker or args.finalize:
+        # The parameters are those of the queued run
+        return args
 
+    if args.headless and args.config is None and args.sweep_from is None:
+        parser.error("--headless requires --config")
+    if args.sweep_from is not None and args.sweep is None:
+        parser.error("--sweep-from requires --sweep")
+    if args.watch and args.sweep is not None:
+        parser.error("--watch cannot be combined with --sweep")
 
-def main():
+    return args
+
+
+def get_parameters(args):
+    if args.headless:
+        return AnalysisParameters.from_toml(args.config, directory=args.directory)
+
+    # tkinter is only needed (and only available with a display) in GUI mode
+    from gui_senolysis import GUI
 
     gui = GUI()
     gui.mainloop()
-    assert (
-        gui.max_nuclei_size > gui.min_nuclei_size
-    ), "Maximum nuclei area must be larger than minimum nuclei area"
+    return AnalysisParameters.from_gui(gui)
 
-    print(f"Scenescent Threshold: {gui.scenescent_threshold}")
-    remove_well = "True" if gui.remove_well_ring == 1 else "False"
-    print(f"Remove Well Ring: {remove_well}")
-    print(f"Max Nuclei: {gui.max_nuclei_size}")
-    print(f"Min Nuclei: {gui.min_nuclei_size}")
 
+def run_threshold_sweep(img_paths, program_start_time, params, thresholds):
+    # Segment every image once, then count nuclei at all thresholds
+    if params.num_jobs > 1:
+        with tqdm(desc="Progress", total=len(img_paths)) as progress_bar:
+            records = worker_pool(params.num_jobs).run(
+                measure_intensities,
+                [(img_path, program_start_time, params) for img_path in img_paths],
+                on_done=progress_bar.update,
+            )
+    else:
+        records = [
+            measure_intensities(img_path, program_start_time, params)
+            for img_path in tqdm(img_paths)
+        ]
+
+    records_per_folder = {}
+    for img_path, image_records in zip(img_paths, records):
+        save_path = get_save_path(img_path, program_start_time)
+        records_per_folder.setdefault(save_path, []).extend(image_records)
+
+    for save_path, folder_records in records_per_folder.items():
+        write_sweep(save_path, folder_records, thresholds)
+
+    return
+
+
+def print_worker_startup():
+    for num_jobs, seconds in warm_up_times().items():
+        print(f"Started {num_jobs} workers in {seconds:.1f} s")
+
+
+def plan_jobs(img_paths, params):
+    # Chooses the number of jobs if it is auto. The image sizes are also used
+    # to order the tasks of parallel runs.
+    shapes = {}
+    if params.num_jobs == "auto" or params.num_jobs > 1:
+        shapes = image_shapes(img_paths)
+    if params.num_jobs == "auto":
+        plan = plan_workers(shapes, params)
+        print(plan.describe())
+        params = replace(params, num_jobs=plan.num_jobs)
+        if params.num_jobs > 1:
+            worker_pool(params.num_jobs)
+    return params, shapes
+
+
+def merge_outputs(img_paths, program_start_time, params, final=True):
+    # Merge the rows appended by every worker into one workbook per folder.
+    # Intermediate merges of a watched run, and merges of runs left unfinished
+    # for --resume, keep the shards and skip the feature tables and trace.
+    image_order = [os.path.basename(img_path) for img_path in img_paths]
+    for save_path in sorted(
+        {get_save_path(img_path, program_start_time) for img_path in img_paths}
+    ):
+        if not final:
+            merge_results(save_path, image_order=image_order, cleanup=False)
+            continue
+        if params.profile == 1:
+            profiler.start(save_path)
+        with profiler.stage("merge_results"):
+            merge_results(save_path, image_order=image_order)
+        if params.feature_export != "Off":
+            with profiler.stage("merge_features"):
+                merge_features(
+                    save_path, params.feature_export, image_order=image_order
+                )
+        if params.qc_export == 1:
+            with profiler.stage("merge_qc"):
+                merge_qc(save_path, image_order=image_order)
+        profiler.stop()
+        if params.profile == 1:
+            trace = merge_trace(save_path)
+            print(f"Saved stage trace to {save_path}")
+            print_trace_summary(trace)
+
+
+def run_status(args, run, program_start_time, num_tasks):
+    # Writes the status files of the run while the with block runs, if
+    # --status-dir is given. Yields the RunStatus, or None.
+    if args.status_dir is None:
+        return nullcontext()
+    print(f"Writing the run status to {args.status_dir}")
+    return StatusWriter(
+        RunStatus(run.path, program_start_time, num_tasks),
+        args.status_dir,
+        args.status_interval,
+    )
+
+
+def report_failures(run, img_paths, program_start_time):
+    # Writes the failed tasks to a failure log in their results folder.
+    # Returns True if no task failed.
+    failures = run.failures()
+    save_paths = {
+        img_path: get_save_path(img_path, program_start_time)
+        for img_path in img_paths + [record["image"] for record in failures]
+    }
+    write_failure_logs(failures, save_paths)
+    for record in failures:
+        task = os.path.basename(record["image"])
+        if record["fields"] is not None:
+            task += f" {record['fields']}"
+        print(f"Failed: {task}: {record['error'].strip().splitlines()[-1]}")
+    if failures:
+        print(
+            f"{len(failures)} tasks failed, see {FAILURES_NAME} in the results "
+            f"folder. Analyze them again with --resume"
+        )
+    return not failures
+
+
+def watch_directory(args, run, program_start_time, params, run_options):
+    completed = run.completed()
+    with run_status(args, run, program_start_time, 0) as status, FolderWatcher(
+        params.directory, settle_time=args.settle_time
+    ) as watcher:
+        mode = "polling" if watcher.polling else "file events"
+        print(f"Watching {params.directory} for new images ({mode})")
+        if args.idle_timeout > 0:
+            print(f"Stopping after {args.idle_timeout:g} s without new images")
+        else:
+            print(f"Press Ctrl+C to stop watching")
+
+        with tqdm(desc="Progress", total=0) as progress_bar:
+
+            def add_image(img_path, num_tasks):
+                progress_bar.total += num_tasks
+                progress_bar.refresh()
+                if status is not None:
+                    status.add_tasks(num_tasks)
+
+            def task_done(img_path, fields):
+                # The bar stays open between images, show every update
+                progress_bar.update()
+                progress_bar.refresh()
+
+            img_paths, finished = run_streaming(
+                watcher,
+                program_start_time,
+                params,
+                completed=completed,
+                idle_timeout=args.idle_timeout,
+                on_image=add_image,
+                on_task_done=task_done,
+                on_results=lambda img_paths: merge_outputs(
+                    img_paths, program_start_time, params, final=False
+                ),
+                **run_options,
+            )
+
+    if watcher.pending:
+        print(
+            "Not analyzed, still being written or unreadable: "
+            + ", ".join(sorted(watcher.pending))
+        )
+    print(f"Total number of images analyzed: {len(img_paths)}")
+    succeeded = report_failures(run, img_paths, program_start_time)
+    # The shards of an unfinished run hold the rows a resumed run merges again
+    merge_outputs(img_paths, program_start_time, params, final=finished and succeeded)
+    if not finished:
+        print(f"Stopped before all images were analyzed, continue with --resume")
+    elif succeeded:
+        run.finish()
+    return img_paths
+
+
+def enqueue_run(img_paths, params):
+    # Every field is its own task, so fields of a multi-field file are spread
+    # over the hosts as well
     program_start_time = strftime("%Y-%m-%d %H-%M-%S", localtime())
+    tasks = [
+        task
+        for img_path in img_paths
+        for task in image_tasks(img_path, params, list_fields, split_fields=True)
+    ]
+    tasks = largest_first(tasks, image_shapes(img_paths))
+    queue = JobQueue.create(params, program_start_time, img_paths, tasks)
+    print(f"Queued {len(tasks)} tasks in {queue.path}")
+    print(f"Start workers on any host with access to the directory:")
+    print(f'  senolysisprogram --worker "{params.directory}"')
+    return queue
+
+
+def finalize_queue(queue):
+    # Merges the results of a queued run, once all its tasks are finished
+    status = queue.status()
+    if not queue.all_finished():
+        print(
+            f"Not finalized, {status['running']} tasks are being analyzed and "
+            f"{status['waiting']} are waiting for a worker"
+        )
+        return False
+    merge_outputs(queue.img_paths, queue.program_start_time, queue.params)
+    queue.finish()
+    for img_path, fields, error in queue.failures():
+        task = os.path.basename(img_path) + ("" if fields is None else f" {fields}")
+        print(f"Failed: {task}\n{error}")
+    print(f"Merged the results of {status['done']} tasks ({status['failed']} failed)")
+    return True
+
+
+def run_queue_worker(args):
+    queue = JobQueue.latest(args.directory)
+    if queue is None:
+        print(f"No queued run in {args.directory}, queue one with --enqueue")
+        return None
+    if args.finalize:
+        finalize_queue(queue)
+        return None
+
+    params = queue.params
+    if args.jobs is not None:
+        params = replace(params, num_jobs=parse_num_jobs(args.jobs))
+    if params.num_jobs == "auto":
+        params, _ = plan_jobs(queue.img_paths, params)
+    print(f"Worker {worker_name()}: analyzing {params.num_jobs} images in parallel")
+    print(f"Queue: {queue.path}")
+
+    # Workers stop after their current image once this file exists
+    stop_path = os.path.join(queue.path, f"stop_{worker_name()}")
+    use_cache = not args.no_cache
+    with tqdm(desc="Progress", total=len(queue.tasks)) as progress_bar:
+
+        def update_progress(*_):
+            status = queue.status()
+            progress_bar.n = status["done"] + status["failed"]
+            progress_bar.refresh()
+
+        try:
+            if params.num_jobs > 1:
+                pool = worker_pool(params.num_jobs)
+                workers = [
+                    pool.submit(work, queue.path, use_cache, stop_path)
+                    for _ in range(params.num_jobs)
+                ]
+                while not all(worker.done() for worker in workers):
+                    update_progress()
+                    sleep(1)
+                for worker in workers:
+                    worker.result()
+            else:
+                work(queue.path, use_cache, stop_path, on_task_done=update_progress)
+            update_progress()
+        except KeyboardInterrupt:
+            print(f"Stopping after the images being analyzed")
+            open(stop_path, "w").close()
+            shutdown_worker_pools()
+            os.remove(stop_path)
+            return None
+
+    print_worker_startup()
+    if queue.claim_finalization():
+        finalize_queue(queue)
+        print(f"Finished Analysis")
+    else:
+        print(f"Finished, the results are merged by the last worker or --finalize")
+    return None
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    try:
+        return run_analysis(args)
+    finally:
+        # Tasks that did not start yet when the run stopped are not analyzed
+        shutdown_worker_pools()
+
+
+def run_analysis(args):
+    print(f"Imported modules in {IMPORT_TIME:.1f} s")
+    thresholds = None if args.sweep is None else parse_thresholds(args.sweep)
 
-    img_paths = find_images(gui.directory)
+    if args.sweep_from is not None:
+        write_sweep(args.sweep_from, load_intensities(args.sweep_from), thresholds)
+        print(f"Finished Threshold Sweep")
+        return None
+
+    if args.worker or args.finalize:
+        return run_queue_worker(args)
+
+    params = get_parameters(args).validate()
+    if args.profile:
+        params = replace(params, profile=1)
+    if args.pipelined:
+        params = replace(params, pipelined=1)
+    if params.num_jobs != "auto" and (
+        params.num_jobs > 1 or params.pipelined == 1 or args.watch
+    ):
+        # Workers start and import the analysis modules while the images are
+        # found and the parameters are printed
+        worker_pool(params.num_jobs)
+
+    print(f"Scenescent Threshold: {params.scenescent_threshold}")
+    remove_well = "True" if params.remove_well_ring == 1 else "False"
+    print(f"Remove Well Ring: {remove_well}")
+    if params.remove_well_ring == 1 and params.reuse_well_mask == 1:
+        print(f"Reusing well outlines between images")
+    print(f"Max Nuclei: {params.max_nuclei_size}")
+    print(f"Min Nuclei: {params.min_nuclei_size}")
+    print(f"Segmentation Figure: {params.figure_mode}")
+    print(f"Downscale Factor: {params.downscale_factor}")
+    if params.refine_nuclei == 1:
+        print(f"Refining nuclei at full resolution")
+    if params.memory_budget > 0:
+        print(f"Memory Budget: {params.memory_budget} MB per image")
+    if params.compact_dtypes == 1:
+        print(f"Compact float32 intensities")
+    if params.qc_export == 1:
+        print(f"Saving intensity QC")
+    print(f"Nuclei Features: {params.feature_export}")
+    print(f"Mask Output: {params.mask_format}")
+    if params.profile == 1:
+        print(f"Profiling analysis stages")
+
+    if thresholds is not None:
+        program_start_time = strftime("%Y-%m-%d %H-%M-%S", localtime())
+        img_paths = find_images(params.directory)
+        print(f"Senescent thresholds: {', '.join(str(t) for t in thresholds)}")
+        print(f"Total number of images to analyze: {len(img_paths)}")
+        params, _ = plan_jobs(img_paths, params)
+        run_threshold_sweep(img_paths, program_start_time, params, thresholds)
+        print_worker_startup()
+        print(f"Finished Threshold Sweep")
+        return None
+
+    if args.enqueue:
+        enqueue_run(find_images(params.directory), params)
+        return None
+
+    run = RunManifest.find_unfinished(params) if args.resume else None
+    if run is None:
+        program_start_time = strftime("%Y-%m-%d %H-%M-%S", localtime())
+        run = RunManifest.create(params, program_start_time)
+    else:
+        program_start_time = run.program_start_time
+        print(f"Resuming run from {program_start_time}")
+
+    run_options = dict(manifest_path=run.path, use_cache=not args.no_cache)
+    if args.watch:
+        # Sized on the images that are already there
+        params, _ = plan_jobs(find_images(params.directory), params)
+        print(f"Analyzing {params.num_jobs} images in parallel")
+        watch_directory(args, run, program_start_time, params, run_options)
+        print_worker_startup()
+        print(f"Finished Analysis")
+        return None
+
+    img_paths = find_images(params.directory)
 
     num_images = len(img_paths)
     print(f"Total number of images to analyze: {num_images}")
+    params, shapes = plan_jobs(img_paths, params)
+
+    tasks = [
+        task
+        for img_path in img_paths
+        for task in image_tasks(img_path, params, list_fields)
+    ]
 
-    assert (
-        gui.num_jobs > 0 and gui.num_jobs <= os.cpu_count()
-    ), f"Number of jobs shoulder be integer value be between 1 and {os.cpu_count()}"
-    print(f"Analyzing {gui.num_jobs} images in parallel")
+    tasks = remaining_tasks(tasks, run.completed(), list_fields)
+    if args.resume:
+        print(f"Remaining tasks: {len(tasks)}")
+    if params.num_jobs > 1:
+        tasks = largest_first(tasks, shapes)
+        print(f"Scheduling the largest images first")
+
+    print(f"Analyzing {params.num_jobs} images in parallel")
 
     # Parallelize image analsyis with progress bar
-    if gui.num_jobs > 1:
-        with tqdm_joblib(tqdm(desc="Progress", total=len(img_paths))) as progress_bar:
-            Parallel(n_jobs=gui.num_jobs)(
-                delayed(senolysis_analysis)(img_path, program_start_time, gui)
-                for img_path in img_paths
-            )
+    with run_status(args, run, program_start_time, len(tasks)):
+        if params.pipelined == 1:
+            print(f"Reading, analyzing and saving images in overlapping stages")
+            with tqdm(desc="Progress", total=len(tasks)) as progress_bar:
+                run_pipelined(
+                    tasks,
+                    program_start_time,
+                    params,
+                    on_task_done=lambda img_path, fields: progress_bar.update(),
+                    **run_options,
+                )
 
-    elif gui.num_jobs == 1:
-        print(f"Number of jobs = 1, processing images in series.")
-        [
-            senolysis_analysis(img_path, program_start_time, gui)
-            for img_path in tqdm(img_paths)
-        ]
+        elif params.num_jobs > 1:
+            with tqdm(desc="Progress", total=len(tasks)) as progress_bar:
+                # Every worker takes the next task as soon as it is free
+                worker_pool(params.num_jobs).run(
+                    partial(run_task, **run_options),
+                    [
+                        (img_path, program_start_time, params, fields)
+                        for img_path, fields in tasks
+                    ],
+                    on_done=progress_bar.update,
+                )
+
+        elif params.num_jobs == 1:
+            print(f"Number of jobs = 1, processing images in series.")
+            [
+                run_task(img_path, program_start_time, params, fields, **run_options)
+                for img_path, fields in tqdm(tasks)
+            ]
+
+        succeeded = report_failures(run, img_paths, program_start_time)
+        # Failed tasks leave the run unfinished, the shards hold the rows a
+        # resumed run merges again
+        merge_outputs(img_paths, program_start_time, params, final=succeeded)
+    if succeeded:
+        run.finish()
+    print_worker_startup()
 
     # #Record folder path chosen and red-threshold used
     # save_user_parameters(gui,program_start_time)
@@ -0,0 +1,400 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+STATUS_NAME = "Senolysis_status"
+FAILURES_NAME = "Senolysis_failures.csv"
+# Seconds between writes of the status files
+STATUS_INTERVAL = 10.0
+# Seconds of the recent throughput, next to that of the whole run
+THROUGHPUT_WINDOW = 60.0
+QUANTILES = (0.5, 0.9, 0.99)
+# Failures listed in the JSON status
+RECENT_FAILURES = 10
+
+
+def process_memory():
+    """Resident memory of this process in bytes, None if it can not be
+    determined on this system."""
+    try:
+        import psutil
+    except ImportError:
+        pass
+    else:
+        return psutil.Process().memory_info().rss
+
+    # Linux: resident pages
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def worker_stats():
+    """Name and resident memory of this worker process."""
+    return {
+        "worker": f"{socket.gethostname()}_{os.getpid()}",
+        "rss": process_memory(),
+    }
+
+
+def task_stats(start, stage_times, cached=False, worker=None):
+    """Telemetry of one finished task, stored with its run manifest record.
+
+    Parameters
+    ----------
+    start: time.time() when the task started
+    stage_times: seconds per analysis stage, from profiler.timed
+    cached: True if the results were restored from the cache
+    worker: worker_stats of the process that analyzed the task, default this
+        process
+    """
+    end = time.time()
+    return {
+        "start": start,
+        "end": end,
+        "wall": end - start,
+        "cached": cached,
+        "stages": stage_times,
+        **(worker_stats() if worker is None else worker),
+    }
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{_label_value(value)}"' for name, value in labels.items())
+
+
+def _error_line(error):
+    # Last line of a traceback, e.g. "ValueError: ..."
+    lines = error.strip().splitlines()
+    return lines[-1] if lines else ""
+
+
+def _write_atomic(path, text):
+    # Collectors reading the file never see it half written
+    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+class RunStatus:
+    """Live status of an analysis run, from the task records that workers
+    append to the run manifest.
+
+    Only tasks finished since the status was created count, so a resumed run
+    reports its remaining tasks. New records are read incrementally, every
+    update only reads what was appended since the last one.
+
+    Parameters
+    ----------
+    manifest_path: folder of the RunManifest of the run
+    program_start_time: name of the run
+    total_tasks: number of tasks to analyze, see add_tasks
+    """
+
+    def __init__(self, manifest_path, program_start_time, total_tasks=0):
+        self.manifest_path = manifest_path
+        self.program_start_time = program_start_time
+        self.total_tasks = total_tasks
+        self.start = time.time()
+        self.state = "running"
+        self.done = []
+        self.failed = []
+        self._offsets = {}
+
+    def add_tasks(self, num_tasks):
+        """Counts tasks added while the run goes on, e.g. new watched images."""
+        self.total_tasks += num_tasks
+
+    def _new_records(self, pattern):
+        records = []
+        for path in glob.glob(os.path.join(self.manifest_path, pattern)):
+            offset = self._offsets.get(path, 0)
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            # A line without its newline is still being written
+            complete = data[: data.rfind(b"\n") + 1]
+            self._offsets[path] = offset + len(complete)
+            for line in complete.splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("end", 0) >= self.start:
+                    records.append(record)
+        return records
+
+    def update(self):
+        self.done += self._new_records("done_*.jsonl")
+        self.failed += self._new_records("failed_*.jsonl")
+
+    def summary(self, now=None):
+        """Status of the run as a dict, as saved to the JSON status file."""
+        now = time.time() if now is None else now
+        elapsed = max(now - self.start, 1e-9)
+        finished = self.done + self.failed
+        analyzed = [record for record in self.done if not record["cached"]]
+        remaining = max(self.total_tasks - len(finished), 0)
+
+        recent = sum(record["end"] >= now - THROUGHPUT_WINDOW for record in finished)
+        throughput = {
+            "run": len(finished) / elapsed,
+            "recent": recent / min(THROUGHPUT_WINDOW, elapsed),
+        }
+        rate = throughput["recent"] or throughput["run"]
+        # Tasks finished in every minute of the run, for the trend
+        history = np.bincount(
+            [int((record["end"] - self.start) // 60) for record in finished],
+            minlength=int(elapsed // 60) + 1,
+        )
+
+        # Stages of analyzed tasks, cached tasks only restore their outputs
+        stage_samples = {"task": [record["wall"] for record in analyzed]}
+        for record in analyzed:
+            for name, seconds in record["stages"].items():
+                stage_samples.setdefault(name, []).append(seconds)
+        stages = {
+            name: {
+                "count": len(samples),
+                "sum": float(np.sum(samples)),
+                **{f"p{q * 100:g}": float(np.quantile(samples, q)) for q in QUANTILES},
+            }
+            for name, samples in stage_samples.items()
+            if samples
+        }
+
+        # Latest memory of every worker, records are in order per worker
+        workers = {}
+        for record in sorted(finished, key=lambda record: record["end"]):
+            worker = workers.setdefault(record["worker"], {"tasks": 0})
+            worker["tasks"] += 1
+            worker["last_task_end"] = record["end"]
+            if record.get("rss") is not None:
+                worker["rss_mb"] = record["rss"] / 2**20
+        main_rss = process_memory()
+
+        return {
+            "run": self.program_start_time,
+            "state": self.state,
+            "updated": now,
+            "elapsed_s": elapsed,
+            "tasks": {
+                "total": self.total_tasks,
+                "analyzed": len(analyzed),
+                "cached": len(self.done) - len(analyzed),
+                "failed": len(self.failed),
+                "remaining": remaining,
+            },
+            "throughput_tasks_per_s": {
+                "run": throughput["run"],
+                f"last_{THROUGHPUT_WINDOW:g}s": throughput["recent"],
+            },
+            "tasks_per_minute": history.tolist(),
+            "eta_s": remaining / rate if rate > 0 else None,
+            "stage_seconds": stages,
+            "workers": workers,
+            "main_rss_mb": None if main_rss is None else main_rss / 2**20,
+            "failures": [
+                {
+                    "image": os.path.basename(record["image"]),
+                    "fields": record["fields"],
+                    "worker": record["worker"],
+                    "error": _error_line(record["error"]),
+                }
+                for record in self.failed[-RECENT_FAILURES:]
+            ],
+        }
+
+    def prometheus(self, summary):
+        """The summary in the Prometheus text format, e.g. for the textfile
+        collector of the node exporter."""
+        run = {"run": self.program_start_time}
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append(f"# HELP senolysis_{name} {description}")
+            lines.append(f"# TYPE senolysis_{name} {kind}")
+            for suffix, labels, value in samples:
+                if value is not None:
+                    lines.append(
+                        f"senolysis_{name}{suffix}{{{_labels(**run, **labels)}}} "
+                        f"{float(value)!r}"
+                    )
+
+        metric(
+            "running",
+            "gauge",
+            "1 while the run is analyzing images, 0 once it stopped.",
+            [("", {}, float(summary["state"] == "running"))],
+        )
+        metric(
+            "tasks",
+            "gauge",
+            "Tasks (images or fields) of the run by state.",
+            [
+                ("", {"state": state}, summary["tasks"][state])
+                for state in ("analyzed", "cached", "failed", "remaining")
+            ],
+        )
+        metric(
+            "errors_total",
+            "counter",
+            "Tasks whose analysis raised an error.",
+            [("", {}, summary["tasks"]["failed"])],
+        )
+        metric(
+            "throughput_tasks_per_second",
+            "gauge",
+            "Finished tasks per second over the whole run and the last minute.",
+            [
+                ("", {"window": window}, value)
+                for window, value in summary["throughput_tasks_per_s"].items()
+            ],
+        )
+        metric(
+            "elapsed_seconds",
+            "gauge",
+            "Seconds since the run started.",
+            [("", {}, summary["elapsed_s"])],
+        )
+        metric(
+            "eta_seconds",
+            "gauge",
+            "Estimated seconds until all tasks are finished.",
+            [("", {}, summary["eta_s"])],
+        )
+        stage_samples = []
+        for stage, stats in summary["stage_seconds"].items():
+            for q in QUANTILES:
+                stage_samples.append(
+                    ("", {"stage": stage, "quantile": f"{q:g}"}, stats[f"p{q * 100:g}"])
+                )
+            stage_samples.append(("_sum", {"stage": stage}, stats["sum"]))
+            stage_samples.append(("_count", {"stage": stage}, stats["count"]))
+        metric(
+            "stage_seconds",
+            "summary",
+            "Wall time of the analysis stages per analyzed task.",
+            stage_samples,
+        )
+        memory = [
+            ("", {"worker": name}, worker["rss_mb"] * 2**20)
+            for name, worker in summary["workers"].items()
+            if "rss_mb" in worker
+        ]
+        if summary["main_rss_mb"] is not None:
+            memory.append(("", {"worker": "main"}, summary["main_rss_mb"] * 2**20))
+        metric(
+            "worker_rss_bytes",
+            "gauge",
+            "Resident memory of every worker after its last task, and of the "
+            "main process.",
+            memory,
+        )
+        metric(
+            "status_timestamp_seconds",
+            "gauge",
+            "Time this status was written.",
+            [("", {}, summary["updated"])],
+        )
+        return "\n".join(lines) + "\n"
+
+
+class StatusWriter:
+    """Writes the RunStatus of a run to STATUS_NAME.json and STATUS_NAME.prom
+    in status_dir every interval seconds from a background thread, and once
+    more when the run stops.
+
+    Parameters
+    ----------
+    status: RunStatus of the run
+    status_dir: folder of the status files
+    interval: seconds between writes
+    """
+
+    def __init__(self, status, status_dir, interval=STATUS_INTERVAL):
+        self.status = status
+        self.status_dir = status_dir
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def write(self):
+        self.status.update()
+        summary = self.status.summary()
+        path = os.path.join(self.status_dir, STATUS_NAME)
+        _write_atomic(path + ".json", json.dumps(summary, indent=2))
+        _write_atomic(path + ".prom", self.status.prometheus(summary))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def __enter__(self):
+        os.makedirs(self.status_dir, exist_ok=True)
+        self.write()
+        self._thread.start()
+        return self.status
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.status.state = "finished" if exc_type is None else "stopped"
+        self.write()
+        return False
+
+
+def write_failure_logs(failures, save_paths):
+    """Writes the failed tasks of a run to FAILURES_NAME in the results folder
+    of their image, one row per task. Failure logs of earlier attempts are
+    removed from the folders without failures.
+
+    Parameters
+    ----------
+    failures: failed task records of RunManifest.failures
+    save_paths: dict of image path to results folder, for every image of the
+        run
+
+    Returns
+    -------
+    paths: the failure logs written
+    """
+    rows = {}
+    for record in failures:
+        save_path = save_paths[record["image"]]
+        rows.setdefault(save_path, []).append(
+            {
+                "Image": os.path.basename(record["image"]),
+                "Fields": ""
+                if record["fields"] is None
+                else " ".join(f"t{t}_p{p}" for t, p in record["fields"]),
+                "Error": _error_line(record["error"]),
+                "Worker": record.get("worker", ""),
+                "Traceback": record["error"],
+            }
+        )
+
+    paths = []
+    for save_path in sorted(set(save_paths.values())):
+        path = os.path.join(save_path, FAILURES_NAME)
+        if save_path in rows:
+            os.makedirs(save_path, exist_ok=True)
+            pd.DataFrame.from_records(rows[save_path]).to_csv(path, index=False)
+            paths.append(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    return paths
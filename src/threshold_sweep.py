@@ -0,0 +1,176 @@
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from nd2_loading import ND2File
+from senolysis_analysis import full_resolution_planes, measure_nuclei, segment_nuclei
+from senolysis_functions import get_img_name, get_save_path
+
+SWEEP_FILENAME = "Senolysis_threshold_sweep.xlsx"
+INTENSITIES_SUFFIX = "_nuclei_intensities.npz"
+
+
+def parse_thresholds(spec):
+    """Senescent thresholds from a comma separated list ("100,200,300") or an
+    inclusive range ("start:stop:step") with a positive step."""
+    message = (
+        f"Could not read the thresholds {spec}, use e.g. 100,200,300 or 100:1000:50"
+    )
+    try:
+        if ":" in spec:
+            start, stop, step = (float(x) for x in spec.split(":"))
+            if step <= 0 or stop < start:
+                raise ValueError(message)
+            thresholds = np.arange(start, stop + step / 2, step)
+        else:
+            thresholds = np.array([float(x) for x in spec.split(",")])
+    except ValueError:
+        raise ValueError(message)
+    if thresholds.size == 0:
+        raise ValueError(message)
+
+    # Keep integer thresholds as integers in the result tables
+    if np.all(thresholds == np.round(thresholds)):
+        thresholds = thresholds.astype(int)
+    return np.unique(thresholds)
+
+
+def measure_intensities(img_path, program_start_time, params, fields=None):
+    """Segments every field of an .nd2 file once and saves the mean senescent
+    and quiescent intensity of every nucleus to the results folder.
+
+    Returns
+    -------
+    records: one dict per field with the image name, field and the per-nucleus
+        mean intensities
+    """
+    channels = (
+        params.scenescent_channel,
+        params.quiescent_channel,
+        params.nuclei_chanel,
+    )
+    save_path = get_save_path(img_path, program_start_time)
+    os.makedirs(save_path, exist_ok=True)
+
+    records = []
+    with ND2File(img_path) as nd2_file:
+        all_fields = nd2_file.fields
+        for field in all_fields if fields is None else fields:
+            red, green, blue = nd2_file.downscaled_planes(
+                channels, params.downscale_factor, field, params.intensity_dtype
+            )
+            full_planes = None
+            if params.refine_nuclei == 1:
+                full_planes = full_resolution_planes(nd2_file, channels, field)
+            field = field if len(all_fields) > 1 else None
+            nuclei, is_nucleus = segment_nuclei(
+                blue,
+                params.downscale_factor,
+                params,
+                position=None if field is None else field[1],
+            )
+            means, _, _ = measure_nuclei(
+                nuclei,
+                is_nucleus,
+                red,
+                green,
+                (nd2_file.height, nd2_file.width),
+                params.downscale_factor,
+                params,
+                full_planes=full_planes,
+            )
+            record = {
+                "image": os.path.basename(img_path),
+                "field": field,
+                "scenescent": means["scenescent"],
+                "quiescent": means["quiescent"],
+            }
+            save_intensities(
+                os.path.join(
+                    save_path, get_img_name(img_path, field) + INTENSITIES_SUFFIX
+                ),
+                record,
+            )
+            records.append(record)
+
+    return records
+
+
+def save_intensities(path, record):
+    field = (-1, -1) if record["field"] is None else record["field"]
+    np.savez_compressed(
+        path,
+        image=record["image"],
+        field=np.array(field),
+        scenescent=record["scenescent"],
+        quiescent=record["quiescent"],
+    )
+
+
+def load_intensities(save_path):
+    """Reads all per-nucleus intensities saved in a results folder."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(save_path, "*" + INTENSITIES_SUFFIX))):
+        with np.load(path) as saved:
+            field = tuple(int(x) for x in saved["field"])
+            records.append(
+                {
+                    "image": str(saved["image"]),
+                    "field": None if field == (-1, -1) else field,
+                    "scenescent": saved["scenescent"],
+                    "quiescent": saved["quiescent"],
+                }
+            )
+    return records
+
+
+def sweep_counts(scenescent_means, thresholds):
+    """Senescent and quiescent counts of one image for every threshold. The
+    means are sorted once, after which every threshold is a binary search."""
+    sorted_means = np.sort(scenescent_means)
+    # Nuclei with a mean >= threshold are senescent, as in classify_nuclei
+    quiescent = np.searchsorted(sorted_means, thresholds, side="left")
+    scenescent = len(sorted_means) - quiescent
+    return scenescent, quiescent
+
+
+def sweep_tables(records, thresholds):
+    """Image x threshold tables of the senescent count, quiescent count and
+    quiescence / senescence ratio."""
+    thresholds = np.asarray(thresholds)
+    scenescent = np.empty((len(records), len(thresholds)), dtype=int)
+    quiescent = np.empty_like(scenescent)
+    for i, record in enumerate(records):
+        scenescent[i], quiescent[i] = sweep_counts(record["scenescent"], thresholds)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(scenescent > 0, quiescent / scenescent, np.inf).round(3)
+
+    index = pd.DataFrame({"Image": [record["image"] for record in records]})
+    if any(record["field"] is not None for record in records):
+        index["Timepoint"] = [
+            (record["field"] or (None, None))[0] for record in records
+        ]
+        index["Position"] = [(record["field"] or (None, None))[1] for record in records]
+
+    def table(values):
+        return pd.concat(
+            [index, pd.DataFrame(values, columns=list(thresholds))], axis=1
+        )
+
+    return {
+        "senescence count": table(scenescent),
+        "quiescence count": table(quiescent),
+        "quiescence senescence ratio": table(ratio),
+    }
+
+
+def write_sweep(save_path, records, thresholds):
+    """Writes the sweep tables of all records to one workbook in save_path."""
+    tables = sweep_tables(records, thresholds)
+    with pd.ExcelWriter(os.path.join(save_path, SWEEP_FILENAME)) as writer:
+        for sheet_name, table in tables.items():
+            table.to_excel(writer, sheet_name=sheet_name, index=False)
+    return tables
@@ -0,0 +1,536 @@
+import os
+import tempfile
+
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.filters import gaussian
+
+from intensity_histogram import QC_SUFFIX, IntensityHistogram, save_qc
+from label_outputs import LABELS_SUFFIX, write_label_image
+from nuclei_features import FEATURES_SUFFIX, features_dataframe, save_features
+from nuclei_table import nearest_indices, upscale_coordinates
+from overlay import THUMBNAIL_SIZE, save_overlay
+from results_sink import ResultsSink
+from senolysis_functions import (
+    analyze_nuclei,
+    discard_otsu_noise,
+    get_img_name,
+    get_save_path,
+    scale_area,
+    normalize_img,
+)
+from tiling import StreamingPNGWriter, TiledLabels, TileGrid, scratch_array
+from well_mask import RING_MARGIN, ring_margin
+
+# Peak memory of analyzing a whole field at once, per full resolution pixel
+BYTES_PER_FULL_PIXEL = 8
+# Memory per downscaled pixel of a tile, besides the full resolution pixels
+# read for it (the uint16 window and its padded copy)
+BYTES_PER_TILE_PIXEL = 64
+MIN_TILE_SIZE = 64
+# Radius of the sigma 1 gaussian smoothing (truncated at 4 sigma)
+GAUSSIAN_HALO = 4
+
+
+def needs_tiling(full_shape, memory_budget):
+    """True if analyzing a field of full_shape at once is expected to exceed the
+    memory budget in MB (0 for no limit)."""
+    if memory_budget <= 0:
+        return False
+    peak = full_shape[0] * full_shape[1] * BYTES_PER_FULL_PIXEL
+    return peak > memory_budget * 2**20
+
+
+def tile_size(downscale_factor, memory_budget):
+    """Side length in downscaled pixels of tiles that, including their halo, fit
+    in half of the memory budget (MB). The other half is left for the
+    per-nucleus tables and the row blocks of the output masks."""
+    per_pixel = 4 * downscale_factor**2 + BYTES_PER_TILE_PIXEL
+    side = int(np.sqrt(memory_budget * 2**20 / 2 / per_pixel))
+    side -= 2 * ring_margin(downscale_factor)
+    return max(side, MIN_TILE_SIZE)
+
+
+def smooth_tiles(read, grid, directory, dtype=np.float64):
+    """Gaussian smoothed nuclei channel, written tile by tile to a disk-backed
+    array of dtype. Tiles are read with a halo, so the result equals smoothing
+    the whole image."""
+    smoothed = scratch_array(directory, "smoothed", grid.shape, dtype)
+    for tile in grid:
+        window, core = grid.window(tile, GAUSSIAN_HALO)
+        smoothed[tile] = gaussian(read(window), 1, preserve_range=True)[core]
+    return smoothed
+
+
+def remove_well_rings_tiled(
+    smoothed, grid, directory, max_size=300, margin=RING_MARGIN
+):
+    """Tiled version of remove_well_rings, sets the well outline, a margin
+    around it and everything outside the well to zero in smoothed."""
+    mean = sum(float(smoothed[tile].sum()) for tile in grid) / smoothed.size
+    outline = TiledLabels(
+        lambda tile: smoothed[tile] > mean, grid, directory, "outline"
+    )
+    is_outline = outline.areas > max_size
+    is_outline[0] = False
+
+    removal_mask = scratch_array(directory, "removal_mask", grid.shape, bool)
+    for tile in grid:
+        window, core = grid.window(tile, margin)
+        outline_window = is_outline[outline.window(window)]
+        if outline_window.any():
+            distance = ndi.distance_transform_edt(~outline_window)
+            removal_mask[tile] = (distance <= margin)[core]
+        else:
+            removal_mask[tile] = False
+
+    # fill corners of image (Outside of well)
+    inside = TiledLabels(lambda tile: ~removal_mask[tile], grid, directory, "inside")
+    corner_labels = inside.lut[inside.tile_labels[[0, -1, 0, -1], [0, 0, -1, -1]]]
+    is_outside = np.zeros(inside.num_labels + 1, dtype=bool)
+    is_outside[corner_labels] = True
+    is_outside[0] = False
+
+    for tile in grid:
+        remove = removal_mask[tile] | is_outside[inside.window(tile)]
+        smoothed[tile] = np.where(remove, 0, smoothed[tile])
+
+
+def threshold_otsu_tiled(img, grid, nbins=256):
+    """threshold_otsu of an image that is read tile by tile, from a histogram
+    accumulated over the tiles."""
+    low = min(img[tile].min() for tile in grid)
+    high = max(img[tile].max() for tile in grid)
+    if low == high:
+        return low
+
+    histogram = None
+    for tile in grid:
+        tile_histogram = IntensityHistogram.from_image(img[tile], nbins, (low, high))
+        histogram = tile_histogram if histogram is None else histogram + tile_histogram
+    return histogram.otsu()
+
+
+def segment_nuclei_tiled(
+    smoothed, grid, directory, params, hole_area_threshold=100, min_area=0
+):
+    """Thresholds the smoothed nuclei channel, fills holes smaller than
+    hole_area_threshold pixels as remove_small_holes(area_threshold=...) does
+    with scikit-image 0.19, and removes fragments smaller than min_area as
+    nuclei_table.small_fragments does.
+
+    Returns
+    -------
+    nuclei: TiledLabels of the nuclei
+    num_objects: number of objects before small fragments were removed
+    """
+    if params.thresholding_method == "Otsu":
+        threshold = threshold_otsu_tiled(smoothed, grid)
+        thresholded = lambda tile: smoothed[tile] > threshold
+    elif params.thresholding_method == "Global":
+        thresholded = lambda tile: smoothed[tile] >= params.nuclei_threshold
+    else:
+        raise ValueError("Could not identify nuclei thresholding method")
+
+    background = TiledLabels(
+        lambda tile: ~thresholded(tile), grid, directory, "background", connectivity=1
+    )
+    is_hole = background.areas < hole_area_threshold
+    is_hole[0] = False
+
+    def is_nucleus(tile):
+        return thresholded(tile) | is_hole[background.window(tile)]
+
+    nuclei = TiledLabels(is_nucleus, grid, directory, "nuclei")
+    num_objects = nuclei.num_labels
+    if min_area > 1:
+        fragments = TiledLabels(
+            is_nucleus, grid, directory, "fragments", connectivity=1
+        )
+        is_small = fragments.areas < min_area
+        is_small[0] = False
+        if is_small.any():
+            nuclei = TiledLabels(
+                lambda tile: is_nucleus(tile) & ~is_small[fragments.window(tile)],
+                grid,
+                directory,
+                "large_nuclei",
+            )
+    return nuclei, num_objects
+
+
+class TiledNucleiTable:
+    """Per-nucleus table of a TiledLabels labelling, with the row selection of
+    NucleiTable. Per-nucleus measures are accumulated one tile at a time by
+    measure and are indexed by label id.
+
+    Parameters
+    ----------
+    labels: TiledLabels of the nuclei
+    num_objects: objects before small fragments were removed, default the
+        number of nuclei
+    """
+
+    def __init__(self, labels, num_objects=None):
+        self.labels = labels
+        self.num_labels = labels.num_labels
+        self.num_objects = self.num_labels if num_objects is None else num_objects
+        self.label_ids = np.arange(1, self.num_labels + 1)
+        self.areas = labels.areas[1:]
+        self.sums = {}
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def select(self, keep):
+        """Keep only the rows where keep is True."""
+        self.label_ids = self.label_ids[keep]
+        self.areas = self.areas[keep]
+        return self
+
+    def filter_by_area(self, min_area=0, max_area=np.inf):
+        """Drop nuclei with an area outside [min_area, max_area]."""
+        return self.select((self.areas >= min_area) & (self.areas <= max_area))
+
+    def lookup_table(self, selection=None):
+        """Boolean lookup table from label id to membership of the selected rows."""
+        lut = np.zeros(self.num_labels + 1, dtype=bool)
+        if selection is None:
+            lut[self.label_ids] = True
+        else:
+            lut[self.label_ids[selection]] = True
+        return lut
+
+    def measure(
+        self, read_channels, full_shape, thumbnail_step=None, downscale_factor=None
+    ):
+        """Accumulates the full resolution area and centroid and, for every
+        channel, the sum and full resolution integral of the intensity of all
+        nuclei.
+
+        read_channels(window) returns a dict of channel name to the downscaled
+        window of that channel. If thumbnail_step is given, every
+        thumbnail_step-th pixel of every channel is collected in
+        self.thumbnails. If the downscale_factor of the windows is given, the
+        IntensityHistogram of every channel is collected in self.histograms.
+        """
+        grid = self.labels.grid
+        small_shape = grid.shape
+        row_map = nearest_indices(small_shape[0], full_shape[0])
+        col_map = nearest_indices(small_shape[1], full_shape[1])
+        row_counts = np.bincount(row_map, minlength=small_shape[0])
+        col_counts = np.bincount(col_map, minlength=small_shape[1])
+        row_coords = upscale_coordinates(small_shape[0], full_shape[0])
+        col_coords = upscale_coordinates(small_shape[1], full_shape[1])
+
+        self.sums = {}
+        self.thumbnails = {}
+        self.histograms = {}
+
+        def add(name, labels, values):
+            sums = np.bincount(
+                labels, weights=values.ravel(), minlength=self.num_labels + 1
+            )
+            self.sums[name] = self.sums.get(name, 0) + sums
+
+        for tile in grid:
+            rows, cols = tile
+            labels = self.labels.window(tile).ravel()
+            weights = np.outer(row_counts[rows], col_counts[cols])
+            add("area", labels, weights)
+            add("row", labels, weights * row_coords[rows, np.newaxis])
+            add("col", labels, weights * col_coords[np.newaxis, cols])
+
+            for name, img in read_channels(tile).items():
+                add(name, labels, img)
+                # Downscaled pixels hold the mean of the full resolution pixels
+                add(name + " integrated", labels, weights * img)
+
+                if downscale_factor is not None:
+                    histogram = IntensityHistogram.from_downscaled(
+                        img, downscale_factor
+                    )
+                    if name in self.histograms:
+                        histogram = self.histograms[name] + histogram
+                    self.histograms[name] = histogram
+
+                if thumbnail_step is not None:
+                    if name not in self.thumbnails:
+                        self.thumbnails[name] = np.zeros(
+                            [-(-size // thumbnail_step) for size in small_shape]
+                        )
+                    first_row = -rows.start % thumbnail_step
+                    first_col = -cols.start % thumbnail_step
+                    sample = img[first_row::thumbnail_step, first_col::thumbnail_step]
+                    r0 = (rows.start + first_row) // thumbnail_step
+                    c0 = (cols.start + first_col) // thumbnail_step
+                    self.thumbnails[name][
+                        r0 : r0 + sample.shape[0], c0 : c0 + sample.shape[1]
+                    ] = sample
+
+    def means(self, name):
+        """Mean intensity of the channel name within every nucleus."""
+        return self.sums[name][self.label_ids] / np.maximum(self.areas, 1)
+
+    def full_resolution_areas(self):
+        return self.sums["area"][self.label_ids]
+
+    def centroids(self):
+        """Full resolution centroid (row, col) of every nucleus."""
+        sums = np.column_stack([self.sums["row"], self.sums["col"]])
+        return sums[self.label_ids] / self.full_resolution_areas()[:, np.newaxis]
+
+
+def save_masks_tiled(labels, lookup_tables, paths, full_shape, memory_budget):
+    """Upsamples label lookups to full resolution and writes them as 8-bit PNG
+    masks, a block of rows at a time.
+
+    Parameters
+    ----------
+    labels: TiledLabels of the nuclei
+    lookup_tables: boolean lookup table from label id to mask value, per mask
+    paths: output path per mask
+    full_shape: (height, width) of the original image
+    memory_budget: MB available for the row blocks
+    """
+    small_shape = labels.grid.shape
+    row_map = nearest_indices(small_shape[0], full_shape[0])
+    col_map = nearest_indices(small_shape[1], full_shape[1])
+
+    # Downscaled labels and two full resolution copies of every mask per row
+    scale = full_shape[0] / small_shape[0]
+    bytes_per_row = small_shape[1] * 16 + len(paths) * 2 * scale * full_shape[1]
+    block_rows = max(1, int(memory_budget * 2**20 / 2 / bytes_per_row))
+
+    writers = [StreamingPNGWriter(path, full_shape) for path in paths]
+    try:
+        for r0 in range(0, small_shape[0], block_rows):
+            r1 = min(r0 + block_rows, small_shape[0])
+            block = labels.window((slice(r0, r1), slice(None)))
+            full_rows = row_map[(row_map >= r0) & (row_map < r1)] - r0
+            for lut, writer in zip(lookup_tables, writers):
+                upscaled = lut[block][np.ix_(full_rows, col_map)]
+                writer.write_rows(np.uint8(upscaled) * 255)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def save_labels_tiled(
+    path, labels, label_ids, is_scenescent, full_shape, memory_budget
+):
+    """Writes the label image and nuclei classification of a field as
+    label_outputs.save_labels does, a block of rows at a time.
+
+    Parameters
+    ----------
+    path: output file, ending in LABELS_SUFFIX
+    labels: TiledLabels of the nuclei
+    label_ids: label id of every nucleus of the TiledNucleiTable
+    is_scenescent: boolean array, True for the senescent nuclei
+    full_shape: (height, width) of the original image
+    memory_budget: MB available for the row blocks
+    """
+    small_shape = labels.grid.shape
+    # Global labels and their copy in the label dtype
+    block_rows = max(1, int(memory_budget * 2**20 / 2 / (small_shape[1] * 12)))
+    blocks = (
+        labels.window((slice(r0, r0 + block_rows), slice(None)))
+        for r0 in range(0, small_shape[0], block_rows)
+    )
+    return write_label_image(
+        path,
+        blocks,
+        small_shape,
+        labels.num_labels,
+        label_ids=label_ids,
+        is_scenescent=is_scenescent,
+        full_shape=np.array(full_shape),
+    )
+
+
+def tiled_field_analysis(
+    nd2_file,
+    field,
+    downscale_factor,
+    img_path,
+    program_start_time,
+    params,
+    result_field=None,
+):
+    """Analyzes one field of an .nd2 file tile by tile, so that peak memory
+    stays within params.memory_budget regardless of the image size.
+
+    Gives the same segmentation, measures and masks as field_analysis.
+    Intermediate images are kept in disk-backed arrays in a temporary folder of
+    the results directory, and nuclei crossing tile seams are merged before they
+    are measured. The segmentation figure is always saved as a thumbnail.
+
+    Returns
+    -------
+    results_dataframe: result row of the field
+    output_paths: paths of the saved images
+    """
+    full_shape = (nd2_file.height, nd2_file.width)
+    small_shape = tuple(-(-size // downscale_factor) for size in full_shape)
+    grid = TileGrid(small_shape, tile_size(downscale_factor, params.memory_budget))
+
+    def read(channel, window):
+        return nd2_file.downscaled_window(
+            channel, downscale_factor, window, field, params.intensity_dtype
+        )
+
+    save_path = get_save_path(img_path, program_start_time)
+    os.makedirs(save_path, exist_ok=True)
+    img_name = get_img_name(img_path, result_field)
+
+    with tempfile.TemporaryDirectory(dir=save_path, prefix=".tiles_") as directory:
+        smoothed = smooth_tiles(
+            lambda window: read(params.nuclei_chanel, window),
+            grid,
+            directory,
+            params.intensity_dtype,
+        )
+        if params.remove_well_ring == 1:
+            remove_well_rings_tiled(
+                smoothed,
+                grid,
+                directory,
+                max_size=scale_area(params.max_nuclei_size, downscale_factor),
+                margin=ring_margin(downscale_factor),
+            )
+
+        min_area = int(params.min_nuclei_size / downscale_factor**2)
+        nuclei = TiledNucleiTable(
+            *segment_nuclei_tiled(
+                smoothed,
+                grid,
+                directory,
+                params,
+                hole_area_threshold=scale_area(100, downscale_factor),
+                min_area=min_area,
+            )
+        )
+        if params.thresholding_method == "Otsu":
+            nuclei = discard_otsu_noise(nuclei)
+        nuclei.filter_by_area(
+            min_area=min_area,
+            max_area=int(params.max_nuclei_size / downscale_factor**2),
+        )
+
+        channels = {
+            "scenescent": params.scenescent_channel,
+            "quiescent": params.quiescent_channel,
+        }
+        if params.feature_export != "Off" or params.qc_export == 1:
+            channels["nuclei"] = params.nuclei_chanel
+        thumbnail_step = None
+        if params.figure_mode != "Off":
+            thumbnail_step = -(-max(small_shape) // THUMBNAIL_SIZE)
+        nuclei.measure(
+            lambda window: {
+                name: read(channel, window) for name, channel in channels.items()
+            },
+            full_shape,
+            thumbnail_step=thumbnail_step,
+            downscale_factor=downscale_factor if params.qc_export == 1 else None,
+        )
+
+        # Determine if each nuclei belongs to scenescent or quiescent cell
+        is_scenescent = nuclei.means("scenescent") >= params.scenescent_threshold
+        full_resolution_areas = nuclei.full_resolution_areas()
+        results_dataframe = analyze_nuclei(
+            full_resolution_areas[is_scenescent],
+            full_resolution_areas[~is_scenescent],
+            img_path,
+            field=result_field,
+        )
+        ResultsSink(save_path).append(results_dataframe)
+
+        output_paths = []
+        if params.feature_export != "Off":
+            features = features_dataframe(
+                nuclei.label_ids,
+                nuclei.centroids(),
+                full_resolution_areas,
+                {name: nuclei.means(name) for name in channels},
+                {
+                    name: nuclei.sums[name + " integrated"][nuclei.label_ids]
+                    for name in channels
+                },
+                is_scenescent,
+                img_path,
+                field=result_field,
+            )
+            output_paths.append(
+                save_features(
+                    features,
+                    os.path.join(save_path, img_name + FEATURES_SUFFIX),
+                    params.feature_export,
+                )
+            )
+
+        if params.qc_export == 1:
+            output_paths.append(
+                save_qc(
+                    nuclei.histograms,
+                    img_path,
+                    os.path.join(save_path, img_name + QC_SUFFIX),
+                    field=result_field,
+                )
+            )
+
+        scenescent_lut = nuclei.lookup_table(is_scenescent)
+        quiescent_lut = nuclei.lookup_table(~is_scenescent)
+
+        if params.figure_mode != "Off":
+            thumbnail_labels = nuclei.labels.window(
+                (slice(None, None, thumbnail_step), slice(None, None, thumbnail_step))
+            )
+            RGB = np.dstack(
+                [
+                    normalize_img(nuclei.thumbnails["scenescent"], high_per=98),
+                    normalize_img(nuclei.thumbnails["quiescent"], high_per=98),
+                    np.zeros(thumbnail_labels.shape),
+                ]
+            )
+            figure_path = os.path.join(save_path, img_name + ".png")
+            save_overlay(
+                RGB,
+                scenescent_lut[thumbnail_labels],
+                quiescent_lut[thumbnail_labels],
+                figure_path,
+                params.scenescent_threshold,
+                mode="Thumbnail",
+            )
+            output_paths.append(figure_path)
+
+        if params.mask_format == "Labels":
+            output_paths.append(
+                save_labels_tiled(
+                    os.path.join(save_path, img_name + LABELS_SUFFIX),
+                    nuclei.labels,
+                    nuclei.label_ids,
+                    is_scenescent,
+                    full_shape,
+                    params.memory_budget,
+                )
+            )
+        else:
+            mask_paths = [
+                os.path.join(save_path, img_name + "_scenescent_mask.png"),
+                os.path.join(save_path, img_name + "_quiescent_mask.png"),
+            ]
+            save_masks_tiled(
+                nuclei.labels,
+                [scenescent_lut, quiescent_lut],
+                mask_paths,
+                full_shape,
+                params.memory_budget,
+            )
+            output_paths += mask_paths
+
+        # Release the disk-backed arrays before the folder is removed
+        del smoothed, nuclei
+
+    return results_dataframe, output_paths
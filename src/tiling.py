@@ -0,0 +1,231 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+class TileGrid:
+    """Split of a 2D image into non-overlapping tiles of at most tile_size x
+    tile_size pixels, in raster order.
+
+    Parameters
+    ----------
+    shape: (height, width) of the image
+    tile_size: side length of the tiles in pixels
+    """
+
+    def __init__(self, shape, tile_size):
+        self.shape = tuple(shape)
+        self.tile_size = int(tile_size)
+        self.row_starts = list(range(0, self.shape[0], self.tile_size))
+        self.col_starts = list(range(0, self.shape[1], self.tile_size))
+
+    def __iter__(self):
+        for r0 in self.row_starts:
+            for c0 in self.col_starts:
+                yield (
+                    slice(r0, min(r0 + self.tile_size, self.shape[0])),
+                    slice(c0, min(c0 + self.tile_size, self.shape[1])),
+                )
+
+    def __len__(self):
+        return len(self.row_starts) * len(self.col_starts)
+
+    def window(self, tile, halo):
+        """The tile grown by halo pixels on every side (clipped to the image),
+        and the position of the tile within that window.
+
+        Returns
+        -------
+        window: (rows, cols) slices of the grown tile in the image
+        core: (rows, cols) slices of the tile within the window
+        """
+        rows, cols = tile
+        window = (
+            slice(max(rows.start - halo, 0), min(rows.stop + halo, self.shape[0])),
+            slice(max(cols.start - halo, 0), min(cols.stop + halo, self.shape[1])),
+        )
+        core = (
+            slice(rows.start - window[0].start, rows.stop - window[0].start),
+            slice(cols.start - window[1].start, cols.stop - window[1].start),
+        )
+        return window, core
+
+
+def scratch_array(directory, name, shape, dtype):
+    """Disk-backed array for intermediate images that do not need to stay in
+    memory, created in directory."""
+    return np.lib.format.open_memmap(
+        os.path.join(directory, name + ".npy"), mode="w+", dtype=dtype, shape=shape
+    )
+
+
+def _seam_pairs(before, after, connectivity):
+    # Labels that touch across a seam, before and after are the pixel lines on
+    # either side of it
+    shifts = (0,) if connectivity == 1 else (0, 1, -1)
+    pairs = []
+    for shift in shifts:
+        if shift == 0:
+            a, b = before, after
+        elif shift == 1:
+            a, b = before[:-1], after[1:]
+        else:
+            a, b = before[1:], after[:-1]
+        touching = (a > 0) & (b > 0)
+        pairs.append((a[touching], b[touching]))
+    return pairs
+
+
+class TiledLabels:
+    """Connected component labelling of a mask that is produced one tile at a
+    time.
+
+    Every tile is labelled on its own and the tile labels are written to a
+    disk-backed array. Components that continue across tile seams are then
+    merged, and the merged components are numbered in raster order of their
+    first pixel, so the global labels equal those of labelling the whole mask at
+    once (as skimage.measure.label does).
+
+    Parameters
+    ----------
+    tile_mask: function returning the boolean mask of a (rows, cols) tile
+    grid: TileGrid the mask is produced on
+    directory: folder for the disk-backed tile labels
+    name: file name of the tile labels in directory
+    connectivity: 1 for 4-connectivity, 2 for 8-connectivity
+    """
+
+    def __init__(self, tile_mask, grid, directory, name, connectivity=2):
+        structure = ndi.generate_binary_structure(2, connectivity)
+        width = grid.shape[1]
+        self.grid = grid
+        self.tile_labels = scratch_array(directory, name, grid.shape, np.int32)
+
+        # Index 0 is the background in all per label arrays
+        tile_areas = [np.zeros(1, dtype=np.intp)]
+        first_pixels = [np.zeros(1, dtype=np.int64)]
+        num_tile_labels = 0
+        for tile in grid:
+            labelled, num_labels = ndi.label(tile_mask(tile), structure=structure)
+            flat_labels = labelled.ravel()
+            tile_areas.append(np.bincount(flat_labels, minlength=num_labels + 1)[1:])
+
+            # First pixel of every label, as a flat index into the whole image
+            _, first = np.unique(flat_labels, return_index=True)
+            first = first[-num_labels:] if num_labels else first[:0]
+            tile_width = labelled.shape[1]
+            first_pixels.append(
+                (first // tile_width + tile[0].start) * np.int64(width)
+                + first % tile_width
+                + tile[1].start
+            )
+
+            labelled[labelled > 0] += num_tile_labels
+            self.tile_labels[tile] = labelled
+            num_tile_labels += num_labels
+
+        tile_areas = np.concatenate(tile_areas)
+        first_pixels = np.concatenate(first_pixels)
+
+        # Merge the tile labels that touch across seams
+        pairs = []
+        for r in grid.row_starts[1:]:
+            pairs += _seam_pairs(
+                self.tile_labels[r - 1], self.tile_labels[r], connectivity
+            )
+        for c in grid.col_starts[1:]:
+            pairs += _seam_pairs(
+                self.tile_labels[:, c - 1], self.tile_labels[:, c], connectivity
+            )
+        a = np.concatenate([a for a, b in pairs] + [np.zeros(0, dtype=np.int32)])
+        b = np.concatenate([b for a, b in pairs] + [np.zeros(0, dtype=np.int32)])
+        graph = coo_matrix(
+            (np.ones(len(a), dtype=np.int8), (a, b)),
+            shape=(num_tile_labels + 1, num_tile_labels + 1),
+        )
+        num_components, components = connected_components(graph, directed=False)
+
+        # Number the components in raster order of their first pixel
+        component_first = np.full(num_components, np.iinfo(np.int64).max)
+        np.minimum.at(component_first, components[1:], first_pixels[1:])
+        component_first[components[0]] = -1
+        rank = np.empty(num_components, dtype=np.int64)
+        rank[np.argsort(component_first, kind="stable")] = np.arange(num_components)
+
+        # Lookup table from tile label to global label
+        self.lut = rank[components]
+        self.num_labels = num_components - 1
+        self.areas = np.bincount(
+            self.lut, weights=tile_areas, minlength=self.num_labels + 1
+        ).astype(np.intp)
+        self.areas[0] = 0
+
+    def window(self, window):
+        """Global labels of a (rows, cols) window of the image."""
+        return self.lut[self.tile_labels[window]]
+
+
+class StreamingPNGWriter:
+    """Writes an 8-bit grayscale PNG row block by row block, so the full image
+    never has to be held in memory.
+
+    Parameters
+    ----------
+    path: output file
+    shape: (height, width) of the image
+    compress_level: zlib compression level
+    """
+
+    def __init__(self, path, shape, compress_level=6):
+        self.path = path
+        self.height, self.width = shape
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._file = open(path, "wb")
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bit depth, grayscale, no interlacing
+        self._chunk(
+            b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 0, 0, 0, 0)
+        )
+
+    def _chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        crc = zlib.crc32(data, zlib.crc32(chunk_type))
+        self._file.write(struct.pack(">I", crc & 0xFFFFFFFF))
+
+    def write_rows(self, rows):
+        """Appends a (num_rows, width) uint8 block below the rows written so far."""
+        rows = np.asarray(rows, dtype=np.uint8)
+        # Every row starts with its filter type, 0 (no filter)
+        filtered = np.zeros((rows.shape[0], self.width + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self.rows_written != self.height:
+            self._file.close()
+            raise ValueError(
+                f"{self.path}: wrote {self.rows_written} of {self.height} rows"
+            )
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # Polling only
+    FileSystemEventHandler = object
+    Observer = None
+
+from incremental import image_tasks, remaining_tasks, run_task
+from nd2_loading import list_fields
+from worker_pool import worker_pool
+
+# Seconds between directory scans while polling or while images are being
+# written, and between scans as a safety net when file events are available
+POLL_INTERVAL = 2.0
+EVENT_RESCAN_INTERVAL = 60.0
+# Seconds an image must keep the same size and modification time before it is
+# considered completely written
+SETTLE_TIME = 10.0
+# Seconds between updates of the results workbook while images are analyzed
+MERGE_INTERVAL = 60.0
+
+
+class _WakeOnImage(FileSystemEventHandler):
+    def __init__(self, wakeup):
+        self.wakeup = wakeup
+
+    def on_any_event(self, event):
+        paths = (event.src_path, getattr(event, "dest_path", ""))
+        if any(str(path).endswith(".nd2") for path in paths):
+            self.wakeup.set()
+
+
+class FolderWatcher:
+    """Finds the .nd2 images that appear in a directory tree, once they are
+    completely written.
+
+    The tree is scanned like find_images. An image is ready when its size and
+    modification time have not changed for settle_time seconds and it can be
+    opened as an .nd2 file, which fails until the acquisition software has
+    written the file's metadata at its end. With the optional watchdog package
+    file events wake up the scan right away, otherwise the tree is polled every
+    poll_interval seconds.
+
+    Parameters
+    ----------
+    directory: directory containing the images or folders of images
+    settle_time: seconds an image must stay unchanged before it is ready
+    poll_interval: seconds between scans while polling
+    """
+
+    def __init__(self, directory, settle_time=SETTLE_TIME, poll_interval=POLL_INTERVAL):
+        self.directory = os.path.normpath(directory)
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.observer = None
+        self.seen = set()
+        # path -> (size, mtime, time the size and mtime were last seen to change)
+        self.pending = {}
+        self.last_change = time.monotonic()
+
+    def start(self):
+        """Starts watching for file events, falls back to polling if watchdog
+        is not installed or the directory cannot be watched."""
+        if Observer is None:
+            return self
+        observer = Observer()
+        try:
+            observer.schedule(_WakeOnImage(self.wakeup), self.directory, recursive=True)
+            observer.start()
+        except OSError:
+            # e.g. inotify watch limit reached, or a network share
+            return self
+        self.observer = observer
+        return self
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def polling(self):
+        return self.observer is None
+
+    def _scan(self):
+        now = time.monotonic()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if not name.endswith(".nd2") or path in self.seen:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed or renamed since the directory was listed
+                    self.pending.pop(path, None)
+                    continue
+                state = (stat.st_size, stat.st_mtime)
+                previous = self.pending.get(path)
+                if previous is None or previous[:2] != state:
+                    self.pending[path] = (*state, now)
+                    self.last_change = now
+
+    def ready_images(self):
+        """Images that became ready since the last call, in acquisition order."""
+        self._scan()
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime, changed) in list(self.pending.items()):
+            if size == 0 or now - changed < self.settle_time:
+                continue
+            try:
+                list_fields(path)
+            except Exception:
+                # Still being written, check again after another settle_time
+                self.pending[path] = (size, mtime, now)
+                continue
+            del self.pending[path]
+            self.seen.add(path)
+            ready.append((mtime, path))
+        return [path for _, path in sorted(ready)]
+
+    def wait(self, timeout=None):
+        """Waits until a file event, wake() or the next scan is due, or at most
+        timeout seconds."""
+        interval = (
+            self.poll_interval
+            if self.polling or self.pending
+            else EVENT_RESCAN_INTERVAL
+        )
+        if timeout is not None:
+            interval = min(interval, timeout)
+        self.wakeup.wait(interval)
+        self.wakeup.clear()
+
+    def wake(self):
+        self.wakeup.set()
+
+
+def run_streaming(
+    watcher,
+    program_start_time,
+    params,
+    manifest_path=None,
+    use_cache=True,
+    completed=(),
+    idle_timeout=0,
+    on_image=None,
+    on_task_done=None,
+    on_results=None,
+):
+    """Analyzes the images found by a FolderWatcher as they are acquired.
+
+    Every ready image is split into tasks as in a normal run and queued for
+    the worker_pool of params.num_jobs processes, skipping the tasks in
+    completed. While images are analyzed, on_results is called at most every
+    MERGE_INTERVAL seconds and whenever the queue runs empty, so the results so
+    far can be merged. Watching ends after idle_timeout seconds without new images or
+    analyzed tasks (0 to watch until interrupted) or with Ctrl+C, after which
+    the tasks already started are finished.
+
+    Parameters
+    ----------
+    watcher: started FolderWatcher of the analyzed directory
+    program_start_time: name of the run
+    params: AnalysisParameters of the run
+    manifest_path: run manifest completed tasks are recorded in
+    use_cache: reuse and store cached results
+    completed: (img_path, field) completed in an earlier, resumed run
+    idle_timeout: seconds without activity after which watching ends
+    on_image: called with every ready image and its number of tasks
+    on_task_done: called with every finished (img_path, fields) task
+    on_results: called with all ready images so far
+
+    Returns
+    -------
+    img_paths: all images that were ready, in acquisition order
+    finished: False if watching was interrupted before all queued tasks ran
+    """
+    img_paths = []
+    futures = {}
+    last_activity = time.monotonic()
+    last_merge = time.monotonic()
+    unmerged = False
+    finished = True
+
+    pool = worker_pool(params.num_jobs)
+    try:
+        while True:
+            for img_path in watcher.ready_images():
+                img_paths.append(img_path)
+                tasks = remaining_tasks(
+                    image_tasks(img_path, params, list_fields),
+                    completed,
+                    list_fields,
+                )
+                if on_image is not None:
+                    on_image(img_path, len(tasks))
+                for _, fields in tasks:
+                    future = pool.submit(
+                        run_task,
+                        img_path,
+                        program_start_time,
+                        params,
+                        fields,
+                        manifest_path=manifest_path,
+                        use_cache=use_cache,
+                    )
+                    future.add_done_callback(lambda _: watcher.wake())
+                    futures[future] = (img_path, fields)
+                last_activity = time.monotonic()
+
+            for future in [future for future in futures if future.done()]:
+                img_path, fields = futures.pop(future)
+                future.result()
+                if on_task_done is not None:
+                    on_task_done(img_path, fields)
+                unmerged = True
+                last_activity = time.monotonic()
+
+            now = time.monotonic()
+            if unmerged and (not futures or now - last_merge > MERGE_INTERVAL):
+                if on_results is not None:
+                    on_results(img_paths)
+                unmerged = False
+                last_merge = now
+
+            timeout = None
+            if idle_timeout > 0 and not futures:
+                idle_since = max(last_activity, watcher.last_change)
+                timeout = idle_since + idle_timeout - now
+                if timeout <= 0:
+                    break
+            watcher.wait(timeout)
+    except KeyboardInterrupt:
+        # Tasks not started yet are left for --resume
+        for future in futures:
+            if future.cancel():
+                finished = False
+        for future, (img_path, fields) in futures.items():
+            if not future.cancelled():
+                future.result()
+                if on_task_done is not None:
+                    on_task_done(img_path, fields)
+
+    return img_paths, finished
@@ -0,0 +1,118 @@
+import numpy as np
+from scipy import ndimage as ndi
+from skimage.filters import threshold_mean
+
+# Pixels within this distance of the well outline are removed as well, in
+# pixels at a downscale factor of 4
+RING_MARGIN = 15
+# 8-connectivity, as skimage label and flood_fill use for 2D images
+FULL_CONNECTIVITY = np.ones((3, 3), dtype=bool)
+
+
+def ring_margin(downscale_factor):
+    """RING_MARGIN at the resolution of an image downscaled by downscale_factor."""
+    return max(1, round(RING_MARGIN * 4 / downscale_factor))
+
+
+def well_outline(img, max_size=300):
+    """Bright objects larger than max_size pixels (the well outline and anything
+    touching it) in an image thresholded at its mean."""
+    binary = img > threshold_mean(img)
+    labelled, num_labels = ndi.label(binary, structure=FULL_CONNECTIVITY)
+    is_large = np.bincount(labelled.ravel(), minlength=num_labels + 1) > max_size
+    is_large[0] = False
+    return is_large[labelled]
+
+
+def outline_removal_mask(outline, margin=RING_MARGIN):
+    """Removal mask of a well outline: the outline dilated by margin pixels plus
+    the regions outside it that touch an image corner."""
+    if outline.any():
+        # Same as a binary dilation with disk(margin), at a cost independent of
+        # the margin
+        removal_mask = ndi.distance_transform_edt(~outline) <= margin
+    else:
+        removal_mask = outline.copy()
+
+    # fill corners of image (Outside of well)
+    labelled, _ = ndi.label(~removal_mask, structure=FULL_CONNECTIVITY)
+    corner_labels = labelled[[0, -1, 0, -1], [0, 0, -1, -1]]
+    outside = np.zeros(labelled.max() + 1, dtype=bool)
+    outside[corner_labels] = True
+    outside[0] = False
+    return removal_mask | outside[labelled]
+
+
+def well_removal_mask(img, max_size=300, margin=RING_MARGIN):
+    """Boolean mask of the pixels remove_well_rings sets to zero."""
+    return outline_removal_mask(well_outline(img, max_size), margin)
+
+
+class WellMask:
+    """Removal mask of one well together with what is needed to test whether it
+    still fits another image of the same well position.
+
+    Parameters
+    ----------
+    outline: boolean mask of the well outline (see well_outline)
+    margin: dilation of the outline in pixels
+    """
+
+    def __init__(self, outline, margin=RING_MARGIN):
+        self.outline = outline
+        self.removal_mask = outline_removal_mask(outline, margin)
+        self.outline_size = int(outline.sum())
+
+        # Inside of the well next to the removal mask, a shifted outline shows up
+        # as bright pixels here
+        inside = ~self.removal_mask
+        self.border = inside & (ndi.distance_transform_edt(inside) <= margin)
+        self.border_size = int(self.border.sum())
+
+    def fits(self, img, min_coverage=0.5, max_border_fraction=0.5):
+        """Quick validity test of the mask for img, using only the mean threshold
+        of img: the outline must still be bright and the border just inside the
+        removal mask must stay mostly dark."""
+        if img.shape != self.outline.shape or self.outline_size == 0:
+            return False
+
+        binary = img > threshold_mean(img)
+        coverage = np.count_nonzero(binary & self.outline) / self.outline_size
+        if coverage < min_coverage:
+            return False
+
+        if self.border_size == 0:
+            return True
+        border_fraction = np.count_nonzero(binary & self.border) / self.border_size
+        return border_fraction <= max_border_fraction
+
+
+class WellMaskCache:
+    """Well masks of the images analyzed so far, keyed on the well position.
+
+    Images of a plate acquired at fixed stage positions share their well
+    outline, so the mask computed for the first image of a position is reused
+    for the following images as long as WellMask.fits accepts it, and
+    recomputed otherwise.
+    """
+
+    def __init__(self):
+        self.masks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def removal_mask(self, img, max_size=300, position=None, margin=RING_MARGIN):
+        key = (img.shape, max_size, position, margin)
+        well_mask = self.masks.get(key)
+        if well_mask is not None and well_mask.fits(img):
+            self.hits += 1
+            return well_mask.removal_mask
+
+        self.misses += 1
+        well_mask = WellMask(well_outline(img, max_size), margin)
+        self.masks[key] = well_mask
+        return well_mask.removal_mask
+
+
+# Shared by all images analyzed in the same (worker) process
+well_mask_cache = WellMaskCache()
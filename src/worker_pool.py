@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import importlib
+import os
+import signal
+import time
+
+# Imported by every worker when it starts, so the first image of a worker does
+# not pay for them. nd2reader brings in matplotlib through pims.
+WARM_MODULES = ("nd2reader", "senolysis_analysis", "incremental", "threshold_sweep")
+
+
+def _warm_up():
+    # Ctrl+C stops the run in the main process, workers finish their images
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name in WARM_MODULES:
+        importlib.import_module(name)
+
+
+def _ready():
+    return os.getpid()
+
+
+class WorkerPool:
+    """Process pool shared by all parallel analysis stages of a run.
+
+    The workers are started and import the analysis modules as soon as the
+    pool is created, so this happens while the main process is still finding
+    and planning the images. Tasks are taken by the workers one at a time in
+    the order they are submitted. Workers ignore Ctrl+C: the main process
+    cancels the tasks that did not start yet and the workers finish the images
+    they are analyzing.
+
+    Parameters
+    ----------
+    num_jobs: number of worker processes
+    mp_context: multiprocessing context of the workers, default the platform's
+    """
+
+    def __init__(self, num_jobs, mp_context=None):
+        self.num_jobs = num_jobs
+        self.start_time = time.perf_counter()
+        self.executor = ProcessPoolExecutor(
+            num_jobs, mp_context=mp_context, initializer=_warm_up
+        )
+        # One task per worker, each finishes once its worker has warmed up
+        self._ready_times = []
+        self._warming = [self.executor.submit(_ready) for _ in range(num_jobs)]
+        for future in self._warming:
+            future.add_done_callback(
+                lambda _: self._ready_times.append(time.perf_counter())
+            )
+
+    def submit(self, function, *args, **kwargs):
+        return self.executor.submit(function, *args, **kwargs)
+
+    def wait_ready(self):
+        """Waits until all workers are warm, returns the seconds from creating
+        the pool until then."""
+        for future in self._warming:
+            future.result()
+        return max(self._ready_times) - self.start_time
+
+    def run(self, function, tasks, on_done=None):
+        """Calls function(*task) for every task in the workers.
+
+        Tasks start in the given order, each on the next free worker. The first
+        error cancels the tasks that did not start yet and is raised.
+
+        Parameters
+        ----------
+        function: picklable function run in the workers
+        tasks: argument tuples of function
+        on_done: called without arguments after every finished task, e.g. to
+            update a progress bar
+
+        Returns
+        -------
+        results: return values of function, in the order of tasks
+        """
+        futures = [self.submit(function, *task) for task in tasks]
+        try:
+            # on_done runs as soon as each task finishes, in order of completion
+            for future in as_completed(futures):
+                future.result()
+                if on_done is not None:
+                    on_done()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+_pools = {}
+
+
+def worker_pool(num_jobs):
+    """The warm WorkerPool of num_jobs workers of this process, started on the
+    first call and reused by every later analysis, sweep or watch run."""
+    pool = _pools.get(num_jobs)
+    if pool is None:
+        pool = _pools[num_jobs] = WorkerPool(num_jobs)
+    return pool
+
+
+def warm_up_times():
+    """Seconds until all workers were warm, for every pool started so far, by
+    number of workers."""
+    return {num_jobs: pool.wait_ready() for num_jobs, pool in _pools.items()}
+
+
+def shutdown_worker_pools():
+    while _pools:
+        _pools.popitem()[1].shutdown()